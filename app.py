@@ -2,38 +2,76 @@ from fastapi import FastAPI, HTTPException, File, Form, UploadFile, Query, WebSo
 from fastapi.middleware.cors import CORSMiddleware
 from schemas import UserCreate
 from services import *
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi.responses import RedirectResponse, JSONResponse, Response
 from auth import *
 from spotify_service import *
+from db import database
+from token_refresher import token_refresher
+from jobs import job_queue, JOBS_MODE
+from connections import manager
+import asyncio
 import logging
 from typing import Set, Dict
 
 app = FastAPI()
 
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, List[WebSocket]] = {}
+@app.on_event("startup")
+async def connect_database():
+    await database.connect()
 
-    async def connect(self, websocket: WebSocket, user_id: str):
-        await websocket.accept()
-        if user_id not in self.active_connections:
-            self.active_connections[user_id] = []
-        self.active_connections[user_id].append(websocket)
 
-    async def disconnect(self, websocket: WebSocket, user_id: str):
-        if user_id in self.active_connections:
-            self.active_connections[user_id].remove(websocket)
-            if not self.active_connections[user_id]:
-                del self.active_connections[user_id]
+@app.on_event("startup")
+async def start_token_refresher():
+    token_refresher.start()
 
-    async def send_message(self, message: dict, user_id: str):
-        if user_id in self.active_connections:
-            for connection in self.active_connections[user_id]:
-                await connection.send_json(message)
 
+@app.on_event("shutdown")
+async def stop_token_refresher():
+    await token_refresher.stop()
+
+
+@app.on_event("startup")
+async def start_message_broker():
+    await manager.start()
+
+
+@app.on_event("shutdown")
+async def flush_message_batches():
+    await message_batcher.stop()
+
+
+@app.on_event("shutdown")
+async def flush_read_receipts():
+    # Before the broker stops, so the last receipts still reach the other users
+    await read_receipts.stop()
+
+
+@app.on_event("shutdown")
+async def stop_message_broker():
+    await manager.stop()
+
+
+@app.on_event("startup")
+async def start_unread_reconciliation():
+    unread_counters.start()
+
+
+@app.on_event("shutdown")
+async def stop_unread_reconciliation():
+    await unread_counters.stop()
+
+
+@app.on_event("startup")
+async def start_job_workers():
+    if JOBS_MODE == "inprocess":
+        job_queue.start()
+
+
+@app.on_event("shutdown")
+async def stop_job_workers():
+    await job_queue.stop()
 
-manager = ConnectionManager()
 
 # CORS configuration
 app.add_middleware(
@@ -42,9 +80,20 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Before-Cursor", "X-After-Cursor"],
 )
 
 
+@read_receipts.on_flush
+async def send_read_receipt(match_id: int, reader_id: int, other_user_id: int, read_at: datetime):
+    await manager.send_message({
+        "type": "read_receipt",
+        "match_id": match_id,
+        "reader_id": str(reader_id),
+        "read_at": read_at.isoformat()
+    }, str(other_user_id))
+
+
 @app.websocket("/ws/{token}")
 async def websocket_endpoint(websocket: WebSocket, token: str):
     try:
@@ -64,6 +113,7 @@ async def websocket_endpoint(websocket: WebSocket, token: str):
 
         await manager.connect(websocket, str(user_id)) # Ensure user_id is a string if used as key
         try:
+            await preload_user_matches(user_id)
             while True:
                 data = await websocket.receive_json()
 
@@ -88,17 +138,12 @@ async def websocket_endpoint(websocket: WebSocket, token: str):
                     await manager.send_message(message_response, str(recipient_id))
 
                 elif data.get('type') == 'read':
+                    # Coalesced per match; the other user gets the receipt from send_read_receipt
                     await mark_messages_as_read_service(data['match_id'], user_email)
-                    match_data = await get_match_by_id(data['match_id'])
-                    other_user_id = match_data['user1_id'] if match_data['user1_id'] != user_id else match_data['user2_id']
-                    await manager.send_message({
-                        "type": "read_receipt",
-                        "match_id": data['match_id'],
-                        "reader_id": str(user_id),
-                        "read_at": datetime.utcnow().isoformat()
-                    }, str(other_user_id))
 
         except WebSocketDisconnect:
+            pass
+        finally:
             await manager.disconnect(websocket, str(user_id))
 
     except HTTPException as e:
@@ -178,37 +223,56 @@ async def spotify_callback(
         current_user_email: str = Depends(get_current_user)
 ):
     try:
-        cache_path = f".cache-{current_user_email}"
-        if os.path.exists(cache_path):
-            os.remove(cache_path)
-
         spotify = await refresh_spotify_token(current_user_email)
 
-        token_info = spotify.auth_manager.get_access_token(request.code)
+        # Exchange the code even if an older token is stored for this user
+        token_info = await spotify_call(spotify.auth_manager.get_access_token, request.code, check_cache=False)
 
         if not token_info:
             raise HTTPException(status_code=400, detail="Failed to get access token")
 
         connection_data = await save_spotify_connection(current_user_email, spotify)
 
-        await fetch_and_process_top_artists(spotify, current_user_email)
-        await fetch_and_process_top_tracks(spotify, current_user_email)
-        await fetch_and_process_genres(spotify, current_user_email)
-
-        matches_result = await find_matches(current_user_email)
+        # Ingestion and matching run in the background; one job per user at a time
+        user_id = await get_user_id_from_email(current_user_email)
+        job = await job_queue.enqueue(
+            "ingest_and_match",
+            {"email": current_user_email},
+            dedupe_key=f"ingest_and_match:{user_id}"
+        )
 
-        return {
-            'code': 200,
-            'message': 'Successfully connected spotify.',
-            'matches_found': len(matches_result),
-            'top_matches': matches_result[:5]
-        }
+        return JSONResponse(status_code=202, content={
+            'code': 202,
+            'message': 'Successfully connected spotify. Matching is in progress.',
+            'job_id': job.job_id
+        })
+    except HTTPException as e:
+        raise e
     except Exception as e:
         import traceback
         print(f"Error in callback: {str(e)}")
         print(traceback.format_exc())
         raise HTTPException(status_code=500, detail=f"Spotify auth error: {str(e)}")
 
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str, current_user_email: str = Depends(get_current_user)):
+    """Progress and result of a background job started by the current user."""
+    job = await job_queue.get(job_id)
+    if not job or job.payload.get("email") != current_user_email:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return {
+        "job_id": job.job_id,
+        "name": job.name,
+        "status": job.status,
+        "progress": job.progress,
+        "attempts": job.attempts,
+        "result": job.result,
+        "error": job.error,
+        "created_at": job.created_at,
+        "updated_at": job.updated_at
+    }
+
 @app.get("/spotify/me", response_model=SpotifyProfile)
 async def get_spotify_profile(current_user_email: str = Depends(get_current_user)):
     """Get user's Spotify connection status"""
@@ -222,81 +286,16 @@ async def get_combined_genres(
     current_user_email: str = Depends(get_current_user),
 ):
     master_context = "aggregating genres"
-    all_genres: Set[str] = set()
-    all_artist_ids: Set[str] = set()
-    top_limit = 50
-    time_range = "medium_term"
 
     try:
         spotify = await refresh_spotify_token(current_user_email)
 
-        # --- 1. Process Saved Tracks ---
-        context = f"processing {top_limit} saved tracks"
-        logging.info(f"Starting: {context} for {current_user_email}")
-
-        saved_tracks_data = spotify.current_user_saved_tracks(limit=top_limit)
-        if saved_tracks_data and 'items' in saved_tracks_data:
-            for item in saved_tracks_data.get('items', []):
-                track = item.get('track')
-                if track and track.get('artists'):
-                    for artist in track['artists']:
-                        if artist and artist.get('id'):
-                            all_artist_ids.add(artist['id'])
-
-
-        # --- 2. Process Top Tracks ---
-        context = f"processing top {top_limit} tracks ({time_range})"
-        logging.info(f"Starting: {context} for {current_user_email}")
-
-        top_tracks_data = spotify.current_user_top_tracks(limit=top_limit, time_range=time_range)
-        if top_tracks_data and 'items' in top_tracks_data:
-            for track in top_tracks_data.get('items', []):
-                if track and track.get('artists'):
-                    for artist in track['artists']:
-                        if artist and artist.get('id'):
-                            all_artist_ids.add(artist['id'])
-
-        # --- 3. Process Top Artists (Direct Genre Addition + ID Collection) ---
-        context = f"processing top {top_limit} artists ({time_range})"
-        logging.info(f"Starting: {context} for {current_user_email}")
-
-        top_artists_data = spotify.current_user_top_artists(limit=top_limit, time_range=time_range)
-        if top_artists_data and 'items' in top_artists_data:
-            for artist in top_artists_data.get('items', []):
-                if artist:
-                    artist_id = artist.get('id')
-                    artist_genres = artist.get('genres')
-                    if artist_id:
-                        all_artist_ids.add(artist_id)
-                    if artist_genres:
-                        all_genres.update(artist_genres)
-
-
-
-        # --- 4. Fetch Details for All Collected Artist IDs ---
-        context = "fetching details for collected artist IDs"
-        if not all_artist_ids:
-            logging.info(f"No artist IDs collected from any source for {current_user_email}.")
-        else:
-            logging.info(f"Starting: {context} for {len(all_artist_ids)} unique IDs for {current_user_email}")
-            artist_ids_list = list(all_artist_ids)
-            batch_size = 50
-            for i in range(0, len(artist_ids_list), batch_size):
-                batch_ids = artist_ids_list[i:i + batch_size]
-                batch_context = f"{context} (batch {i//batch_size + 1})"
-                artists_details = spotify.artists(batch_ids)
-                if artists_details and artists_details.get('artists'):
-                    for artist in artists_details['artists']:
-                        if artist and artist.get('genres'):
-                            all_genres.update(artist['genres'])
-
-
-
-        # --- 5. Return Final Sorted List ---
-        sorted_genres = sorted(list(all_genres))
+        logging.info(f"Starting: fetching Spotify snapshot for {current_user_email}")
+        snapshot = await fetch_spotify_snapshot(spotify)
+
+        sorted_genres = await process_genres(spotify, snapshot, current_user_email)
         logging.info(f"Finished {master_context} for {current_user_email}. Found {len(sorted_genres)} unique genres.")
 
-        await genres_upload(sorted_genres, current_user_email)
         return {'code': 200, 'message': 'Successfully parsed and uploaded genres.'}
 
     except HTTPException as e:
@@ -310,19 +309,9 @@ async def get_top_artists(
     current_user_email: str = Depends(get_current_user)
 ):
         spotify = await refresh_spotify_token(current_user_email)
-        top_artists_data = spotify.current_user_top_artists(
-            limit=50,
-            time_range='medium_term'
-        )
-        parsed_artists = []
-        if top_artists_data and 'items' in top_artists_data:
-            for artist_item in top_artists_data['items']:
-                if isinstance(artist_item, dict) and 'id' in artist_item and 'name' in artist_item:
-                    parsed_artists.append(
-                        ArtistBasicInfo(id=artist_item['id'], name=artist_item['name'])
-                    )
+        snapshot = await fetch_spotify_snapshot(spotify, parts=("top_artists",))
 
-        await artists_upload(parsed_artists, current_user_email)
+        await process_top_artists(snapshot, current_user_email)
         return {'code': 200, 'message': 'Successfully parsed and uploaded artists.'}
 
 @app.get("/spotify/top-tracks")
@@ -330,21 +319,9 @@ async def get_top_tracks(
     current_user_email: str = Depends(get_current_user),
 ):
         spotify = await refresh_spotify_token(current_user_email)
+        snapshot = await fetch_spotify_snapshot(spotify, parts=("top_tracks",))
 
-        top_tracks_data = spotify.current_user_top_tracks(
-            limit=50,
-            time_range='medium_term'
-        )
-
-        parsed_tracks = []
-        if top_tracks_data and 'items' in top_tracks_data:
-            for track_item in top_tracks_data['items']:
-                if isinstance(track_item, dict) and 'id' in track_item and 'name' in track_item:
-                    parsed_tracks.append(
-                        TrackBasicInfo(id=track_item['id'], name=track_item['name'])
-                    )
-
-        await tracks_upload(parsed_tracks, current_user_email)
+        await process_top_tracks(snapshot, current_user_email)
         return {'code': 200, 'message': 'Successfully parsed and uploaded tracks.'}
 
 
@@ -356,38 +333,32 @@ async def get_user_matches(current_user_email: str = Depends(get_current_user)):
     """
     try:
         # Get the current user's ID
-        user_response = supabase.table("users").select("user_id").eq("email",
-                                                                     current_user_email).maybe_single().execute()
-        if not user_response.data:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        current_user_id = user_response.data.get("user_id")
+        current_user_id = await get_user_id_from_email(current_user_email)
 
         # Find all matches where the current user is either user1_id or user2_id
-        matches_as_user1 = supabase.table("matches") \
-            .select("match_id, user1_id, user2_id, match_score") \
-            .eq("user1_id", current_user_id) \
-            .execute()
-
-        matches_as_user2 = supabase.table("matches") \
-            .select("match_id, user1_id, user2_id, match_score") \
-            .eq("user2_id", current_user_id) \
+        matches_as_user1, matches_as_user2 = await asyncio.gather(
+            supabase.table("matches")
+            .select("match_id, user1_id, user2_id, match_score")
+            .eq("user1_id", current_user_id)
+            .execute(),
+            supabase.table("matches")
+            .select("match_id, user1_id, user2_id, match_score")
+            .eq("user2_id", current_user_id)
             .execute()
+        )
 
-        # Combine and process match data
-        detailed_matches = []
+        match_cache.remember(matches_as_user1.data + matches_as_user2.data)
 
-        # Process matches where current user is user1
-        for match in matches_as_user1.data:
-            match_details = await get_match_details(current_user_id, match["user2_id"], match["match_score"], match["match_id"])
-            if match_details:
-                detailed_matches.append(match_details)
+        # Collect both sides of the matches and build their details in one batch
+        matches = [
+            {"match_id": match["match_id"], "user_id": match["user2_id"], "match_score": match["match_score"]}
+            for match in matches_as_user1.data
+        ] + [
+            {"match_id": match["match_id"], "user_id": match["user1_id"], "match_score": match["match_score"]}
+            for match in matches_as_user2.data
+        ]
 
-        # Process matches where current user is user2
-        for match in matches_as_user2.data:
-            match_details = await get_match_details(current_user_id, match["user1_id"], match["match_score"], match["match_id"])
-            if match_details:
-                detailed_matches.append(match_details)
+        detailed_matches = await get_matches_details(current_user_id, matches)
 
         # Sort matches by score (highest first)
         detailed_matches.sort(key=lambda x: x["match_score"], reverse=True)
@@ -404,6 +375,20 @@ async def get_user_matches(current_user_email: str = Depends(get_current_user)):
         raise HTTPException(status_code=500, detail=f"Error fetching matches: {str(e)}")
 
 
+@app.get("/matches/top")
+async def get_top_matches(
+    current_user_email: str = Depends(get_current_user),
+    k: int = Query(5, ge=1, le=100),
+    min_score: float = Query(10, ge=0, le=100)
+):
+    """The current user's k best matches above min_score, computed from the taste index."""
+    top_matches = await find_top_matches(current_user_email, k, min_score)
+    return {
+        "matches_count": len(top_matches),
+        "matches": top_matches
+    }
+
+
 #-----------------------------------------------------------------------------------------------------------------------
 
 @app.post("/chat/messages", response_model=Message, status_code=201)
@@ -432,17 +417,27 @@ async def send_chat_message(
 @app.get("/chat/matches/{match_id}/messages", response_model=List[Message])
 async def get_chat_messages(
     match_id: int,
+    response: Response,
     current_user_email: str = Depends(get_current_user),
     page: int = Query(1, ge=1),
-    page_size: int = Query(20, ge=1, le=100) # Max 100 messages per page
+    page_size: int = Query(20, ge=1, le=100), # Max 100 messages per page
+    before: Optional[str] = Query(None),
+    after: Optional[str] = Query(None)
 ):
     """
-    Retrieve chat messages for a specific match (conversation).
-    Implements pagination.
+    Retrieve chat messages for a specific match (conversation), newest first.
+    Implements pagination: pass the X-Before-Cursor header of a page as
+    `before` to load older messages, or its X-After-Cursor as `after` to load
+    newer ones. `page` is only used without a cursor.
     """
     try:
         # The service function will handle verifying if the current user is part of the match
-        messages = await get_chat_messages_service(match_id, current_user_email, page, page_size)
+        messages = await get_chat_messages_service(match_id, current_user_email, page, page_size, before, after)
+        if messages:
+            response.headers["X-Before-Cursor"] = message_cursor(messages[-1])
+            response.headers["X-After-Cursor"] = message_cursor(messages[0])
+        elif after:
+            response.headers["X-After-Cursor"] = after
         return messages
     except HTTPException as e:
         raise e
@@ -468,6 +463,12 @@ async def mark_match_messages_as_read(
         logging.error(f"Error marking messages as read for match {match_id}: {str(e)}")
         raise HTTPException(status_code=500, detail="Could not mark messages as read.")
 
+@app.get("/chat/unread")
+async def get_unread_counts(current_user_email: str = Depends(get_current_user)):
+    """Unread message counts of the current user, in total and per match."""
+    return await get_unread_counts_service(current_user_email)
+
+
 @app.get("/chat/conversations", response_model=List[dict])
 async def get_my_conversations(
     current_user_email: str = Depends(get_current_user)
@@ -483,6 +484,26 @@ async def get_my_conversations(
         raise HTTPException(status_code=500, detail="Could not retrieve conversations.")
 
 
+@app.get("/metrics")
+async def get_metrics():
+    """Cache statistics of this worker."""
+    return {
+        "identity_cache": identity_cache.stats(),
+        "match_cache": match_cache.stats(),
+        "message_batcher": message_batcher.stats(),
+        "message_cache": message_cache.stats(),
+        "unread_counters": unread_counters.stats(),
+        "read_receipts": read_receipts.stats(),
+        "artist_genre_cache": artist_genre_cache.stats(),
+        "token_store": token_store.stats(),
+        "spotify_client_pool": spotify_client_pool.stats(),
+        "token_refresher": token_refresher.stats(),
+        "websockets": manager.stats(),
+        "taste_index": taste_index.stats(),
+        "match_engine": match_engine.stats(),
+        "lsh_index": lsh_index.stats()
+    }
+
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+from cache import TTLCache
+from spotify_executor import spotify_call
+
+# Shared by every worker of the host; point it at a writable location outside the checkout in production.
+ARTIST_GENRE_CACHE_PATH = os.getenv("ARTIST_GENRE_CACHE_PATH", ".artist_genre_cache.sqlite3")
+# How long a worker waits for another one's write lock before giving up.
+ARTIST_GENRE_CACHE_DB_TIMEOUT_SECONDS = float(os.getenv("ARTIST_GENRE_CACHE_DB_TIMEOUT_SECONDS", "30"))
+ARTIST_GENRE_CACHE_TTL_SECONDS = float(os.getenv("ARTIST_GENRE_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+ARTIST_GENRE_CACHE_MAX_SIZE = int(os.getenv("ARTIST_GENRE_CACHE_MAX_SIZE", "100000"))
+
+# spotify.artists() accepts at most 50 ids per call.
+SPOTIFY_ARTISTS_BATCH_SIZE = 50
+
+
+class ArtistGenreCache:
+    """
+    artist_id -> genres, shared by every user of this machine.
+
+    Lookups go to memory first, then to a SQLite file (shared by all workers
+    on the host and kept across restarts) and only the remaining misses are
+    requested from Spotify. Entries older than `ttl` are fetched again, so
+    genre changes on Spotify's side are picked up eventually. The file is
+    opened on first use, in WAL mode so readers do not block the writer.
+    """
+
+    def __init__(self, path: str, ttl: float, max_size: int, timeout: float = ARTIST_GENRE_CACHE_DB_TIMEOUT_SECONDS):
+        self.path = path
+        self.ttl = ttl
+        self.timeout = timeout
+        self.memory = TTLCache(max_size, ttl)
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self.disk_hits = 0
+        self.misses = 0
+        self.api_calls = 0
+        self.api_calls_saved = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        """The SQLite connection, opened on first use; call with `_db_lock` held."""
+        if self._db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False, timeout=self.timeout)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS artist_genres ("
+                "artist_id TEXT PRIMARY KEY, genres TEXT NOT NULL, fetched_at REAL NOT NULL)"
+            )
+            db.commit()
+            self._db = db
+        return self._db
+
+    def _load_from_disk(self, artist_ids: List[str]) -> Dict[str, List[str]]:
+        if not artist_ids:
+            return {}
+        oldest = time.time() - self.ttl
+        found = {}
+        with self._db_lock:
+            db = self._connection()
+            for i in range(0, len(artist_ids), 500):
+                batch = artist_ids[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = db.execute(
+                    f"SELECT artist_id, genres FROM artist_genres "
+                    f"WHERE fetched_at >= ? AND artist_id IN ({placeholders})",
+                    [oldest, *batch]
+                ).fetchall()
+                found.update((artist_id, json.loads(genres)) for artist_id, genres in rows)
+        return found
+
+    def _save_to_disk(self, genres_by_artist: Dict[str, List[str]]):
+        now = time.time()
+        with self._db_lock:
+            db = self._connection()
+            db.executemany(
+                "INSERT OR REPLACE INTO artist_genres (artist_id, genres, fetched_at) VALUES (?, ?, ?)",
+                [(artist_id, json.dumps(genres), now) for artist_id, genres in genres_by_artist.items()]
+            )
+            db.commit()
+
+    async def remember(self, artists: Iterable[dict]):
+        """Store full artist objects Spotify already returned elsewhere, e.g. top artists."""
+        genres_by_artist = {
+            artist["id"]: artist.get("genres") or []
+            for artist in artists
+            if artist and artist.get("id") and "genres" in artist
+        }
+        for artist_id, genres in genres_by_artist.items():
+            self.memory.set(artist_id, genres)
+        if genres_by_artist:
+            await asyncio.to_thread(self._save_to_disk, genres_by_artist)
+
+    async def get_genres(self, spotify, artist_ids: Iterable[str]) -> Dict[str, List[str]]:
+        """Genres of every artist in `artist_ids`, calling spotify.artists() for cache misses only."""
+        artist_ids = list(dict.fromkeys(artist_ids))
+        result = {}
+        missing = []
+        for artist_id in artist_ids:
+            genres = self.memory.get(artist_id)
+            if genres is None:
+                missing.append(artist_id)
+            else:
+                result[artist_id] = genres
+
+        from_disk = await asyncio.to_thread(self._load_from_disk, missing)
+        self.disk_hits += len(from_disk)
+        for artist_id, genres in from_disk.items():
+            self.memory.set(artist_id, genres)
+            result[artist_id] = genres
+
+        missing = [artist_id for artist_id in missing if artist_id not in from_disk]
+        self.misses += len(missing)
+
+        batches = await asyncio.gather(*(
+            spotify_call(spotify.artists, missing[i:i + SPOTIFY_ARTISTS_BATCH_SIZE])
+            for i in range(0, len(missing), SPOTIFY_ARTISTS_BATCH_SIZE)
+        ))
+        calls_made = len(batches)
+        self.api_calls += calls_made
+        self.api_calls_saved += math.ceil(len(artist_ids) / SPOTIFY_ARTISTS_BATCH_SIZE) - calls_made
+
+        fetched = {}
+        for artists_details in batches:
+            if artists_details and artists_details.get("artists"):
+                for artist in artists_details["artists"]:
+                    if artist and artist.get("id"):
+                        fetched[artist["id"]] = artist.get("genres") or []
+
+        for artist_id, genres in fetched.items():
+            self.memory.set(artist_id, genres)
+        if fetched:
+            await asyncio.to_thread(self._save_to_disk, fetched)
+        result.update(fetched)
+
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "memory": self.memory.stats(),
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "spotify_api_calls": self.api_calls,
+            "spotify_api_calls_saved": self.api_calls_saved
+        }
+
+
+artist_genre_cache = ArtistGenreCache(
+    ARTIST_GENRE_CACHE_PATH, ARTIST_GENRE_CACHE_TTL_SECONDS, ARTIST_GENRE_CACHE_MAX_SIZE
+)
@@ -0,0 +1,300 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+# "inprocess": one worker, messages are delivered directly.
+# "unix": workers on one machine exchange messages over unix datagram sockets
+# in BROKER_SOCKET_DIR, no outside service needed.
+BROKER_BACKEND = os.getenv("BROKER_BACKEND", "inprocess")
+BROKER_SOCKET_DIR = os.getenv("BROKER_SOCKET_DIR", "/tmp/spotydate-broker")
+# Users per presence datagram of a full presence sync.
+BROKER_PRESENCE_CHUNK = 500
+# Every node sends its full presence to all peers this often, which repairs
+# join/leave datagrams dropped on a full receive buffer.
+BROKER_PRESENCE_SECONDS = float(os.getenv("BROKER_PRESENCE_SECONDS", "30"))
+
+Deliver = Callable[[dict, str], Awaitable[None]]
+EventHandler = Callable[[dict], None]
+
+
+class InProcessBroker:
+    """Routes messages to the connections of this process only; there are no other workers to send events to."""
+
+    def __init__(self):
+        self.deliver: Optional[Deliver] = None
+        self.local_users: Set[str] = set()
+        self.published = 0
+        self.events_sent = 0
+
+    async def start(self, deliver: Deliver):
+        self.deliver = deliver
+
+    async def stop(self):
+        pass
+
+    def register(self, user_id: str):
+        self.local_users.add(user_id)
+
+    def unregister(self, user_id: str):
+        self.local_users.discard(user_id)
+
+    async def publish(self, user_id: str, message: dict):
+        self.published += 1
+        if user_id in self.local_users:
+            await self.deliver(message, user_id)
+
+    def subscribe(self, topic: str, handler: EventHandler):
+        pass
+
+    def broadcast(self, topic: str, data: dict):
+        self.events_sent += 1
+
+    def stats(self) -> dict:
+        return {
+            "backend": "inprocess",
+            "local_users": len(self.local_users),
+            "published": self.published,
+            "events_sent": self.events_sent
+        }
+
+
+class UnixSocketBroker:
+    """
+    Routes messages by user_id between the workers of one machine.
+
+    Every worker (node) binds a unix datagram socket in `socket_dir`. Nodes
+    announce which users they hold (join/leave) to every peer, and a new node
+    says hello to collect the peers' current presence, so `publish` only
+    sends a message to the nodes that hold the recipient. Datagrams can be
+    dropped, so every `presence_seconds` each node also sends its full
+    presence, in chunks; a peer replaces what it knew of the node once all
+    chunks of one sync arrived. Peers whose socket refuses datagrams are
+    considered gone.
+
+    `broadcast(topic, data)` sends an event to every other node, where the
+    handlers `subscribe`d to the topic run with `data`, e.g. to drop cache
+    entries another worker changed. Events are best effort.
+    """
+
+    def __init__(self, socket_dir: str, presence_seconds: float = BROKER_PRESENCE_SECONDS):
+        self.socket_dir = socket_dir
+        self.presence_seconds = presence_seconds
+        self.node_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.deliver: Optional[Deliver] = None
+        self.local_users: Set[str] = set()
+        # user_id -> nodes (other than this one) holding a connection of the user
+        self.presence: Dict[str, Set[str]] = {}
+        self.peers: Set[str] = set()
+        # node_id -> (sync id, users received so far, chunks received) of an incomplete sync
+        self._syncs: Dict[str, Tuple[str, Set[str], Set[int]]] = {}
+        self._socket: Optional[socket.socket] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._handlers: Dict[str, List[EventHandler]] = {}
+        self.published_local = 0
+        self.published_remote = 0
+        self.received = 0
+        self.send_failures = 0
+        self.syncs_sent = 0
+        self.syncs_applied = 0
+        self.events_sent = 0
+        self.events_received = 0
+
+    def _path(self, node_id: str) -> str:
+        return os.path.join(self.socket_dir, f"{node_id}.sock")
+
+    def _list_peers(self) -> Set[str]:
+        return {
+            name[:-len(".sock")] for name in os.listdir(self.socket_dir)
+            if name.endswith(".sock") and name[:-len(".sock")] != self.node_id
+        }
+
+    async def _run_heartbeat(self):
+        while True:
+            await asyncio.sleep(self.presence_seconds)
+            try:
+                # Also picks up peers whose hello was dropped.
+                self.peers |= self._list_peers()
+                for node_id in list(self.peers):
+                    self._send_presence(node_id)
+            except Exception as e:
+                logging.error(f"Broker presence sync failed: {e}")
+
+    def _send_presence(self, node_id: str):
+        """Send all local users to `node_id`; an empty sync clears what the peer knew of this node."""
+        users = sorted(self.local_users)
+        chunks = [users[i:i + BROKER_PRESENCE_CHUNK] for i in range(0, len(users), BROKER_PRESENCE_CHUNK)] or [[]]
+        sync_id = uuid.uuid4().hex[:8]
+        self.syncs_sent += 1
+        for index, chunk in enumerate(chunks):
+            self._send(node_id, {
+                "type": "presence", "sync": sync_id, "chunk": index, "chunks": len(chunks), "users": chunk
+            })
+
+    def _apply_presence(self, node_id: str, payload: dict):
+        sync_id, users, received = self._syncs.get(node_id, (None, None, None))
+        if sync_id != payload["sync"]:
+            # A newer sync supersedes one that lost a chunk.
+            sync_id, users, received = payload["sync"], set(), set()
+            self._syncs[node_id] = (sync_id, users, received)
+        users.update(payload["users"])
+        received.add(payload["chunk"])
+        if len(received) < payload["chunks"]:
+            return
+        del self._syncs[node_id]
+        self.syncs_applied += 1
+        for user_id in [user_id for user_id, nodes in self.presence.items() if node_id in nodes and user_id not in users]:
+            self._remove_presence(user_id, node_id)
+        for user_id in users:
+            self.presence.setdefault(user_id, set()).add(node_id)
+
+    async def start(self, deliver: Deliver):
+        self.deliver = deliver
+        os.makedirs(self.socket_dir, exist_ok=True)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self._path(self.node_id))
+        self._socket.setblocking(False)
+        asyncio.get_running_loop().add_reader(self._socket.fileno(), self._on_readable)
+
+        self.peers = self._list_peers()
+        self._broadcast({"type": "hello"})
+        if self.presence_seconds > 0:
+            self._heartbeat = asyncio.create_task(self._run_heartbeat())
+
+    async def stop(self):
+        if self._heartbeat:
+            self._heartbeat.cancel()
+            await asyncio.gather(self._heartbeat, return_exceptions=True)
+            self._heartbeat = None
+        if self._socket is None:
+            return
+        self._broadcast({"type": "bye"})
+        asyncio.get_running_loop().remove_reader(self._socket.fileno())
+        self._socket.close()
+        self._socket = None
+        try:
+            os.unlink(self._path(self.node_id))
+        except FileNotFoundError:
+            pass
+
+    def _send(self, node_id: str, payload: dict) -> bool:
+        if self._socket is None:
+            return False
+        payload["node"] = self.node_id
+        try:
+            self._socket.sendto(json.dumps(payload).encode(), self._path(node_id))
+            return True
+        except (ConnectionRefusedError, FileNotFoundError):
+            self._forget_node(node_id)
+            try:
+                os.unlink(self._path(node_id))
+            except OSError:
+                pass
+        except OSError as e:
+            # BlockingIOError: the peer's receive buffer is full.
+            logging.warning(f"Broker send to {node_id} failed: {e}")
+        self.send_failures += 1
+        return False
+
+    def _broadcast(self, payload: dict):
+        for node_id in list(self.peers):
+            self._send(node_id, dict(payload))
+
+    def _forget_node(self, node_id: str):
+        self.peers.discard(node_id)
+        self._syncs.pop(node_id, None)
+        for user_id in [user_id for user_id, nodes in self.presence.items() if node_id in nodes]:
+            self._remove_presence(user_id, node_id)
+
+    def _remove_presence(self, user_id: str, node_id: str):
+        nodes = self.presence.get(user_id)
+        if nodes is not None:
+            nodes.discard(node_id)
+            if not nodes:
+                del self.presence[user_id]
+
+    def register(self, user_id: str):
+        if user_id not in self.local_users:
+            self.local_users.add(user_id)
+            self._broadcast({"type": "join", "user_id": user_id})
+
+    def unregister(self, user_id: str):
+        if user_id in self.local_users:
+            self.local_users.discard(user_id)
+            self._broadcast({"type": "leave", "user_id": user_id})
+
+    async def publish(self, user_id: str, message: dict):
+        if user_id in self.local_users:
+            self.published_local += 1
+            await self.deliver(message, user_id)
+        for node_id in list(self.presence.get(user_id, ())):
+            self.published_remote += 1
+            self._send(node_id, {"type": "deliver", "user_id": user_id, "message": message})
+
+    def subscribe(self, topic: str, handler: EventHandler):
+        self._handlers.setdefault(topic, []).append(handler)
+
+    def broadcast(self, topic: str, data: dict):
+        self.events_sent += 1
+        self._broadcast({"type": "event", "topic": topic, "data": data})
+
+    def _on_readable(self):
+        while self._socket is not None:
+            try:
+                data = self._socket.recv(1 << 20)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                self._handle(json.loads(data))
+            except Exception as e:
+                logging.error(f"Broker could not handle a datagram: {e}")
+
+    def _handle(self, payload: dict):
+        kind = payload.get("type")
+        node_id = payload.get("node")
+        if node_id == self.node_id:
+            return
+        self.peers.add(node_id)
+
+        if kind == "deliver":
+            self.received += 1
+            user_id = payload["user_id"]
+            if user_id in self.local_users:
+                asyncio.get_running_loop().create_task(self.deliver(payload["message"], user_id))
+        elif kind == "event":
+            self.events_received += 1
+            for handler in self._handlers.get(payload["topic"], ()):
+                handler(payload["data"])
+        elif kind == "join":
+            self.presence.setdefault(payload["user_id"], set()).add(node_id)
+        elif kind == "leave":
+            self._remove_presence(payload["user_id"], node_id)
+        elif kind == "presence":
+            self._apply_presence(node_id, payload)
+        elif kind == "hello":
+            self._send_presence(node_id)
+        elif kind == "bye":
+            self._forget_node(node_id)
+
+    def stats(self) -> dict:
+        return {
+            "backend": "unix",
+            "node_id": self.node_id,
+            "peers": len(self.peers),
+            "local_users": len(self.local_users),
+            "remote_users": len(self.presence),
+            "published_local": self.published_local,
+            "published_remote": self.published_remote,
+            "received": self.received,
+            "send_failures": self.send_failures,
+            "presence_syncs_sent": self.syncs_sent,
+            "presence_syncs_applied": self.syncs_applied,
+            "events_sent": self.events_sent,
+            "events_received": self.events_received
+        }
+
+
+broker = UnixSocketBroker(BROKER_SOCKET_DIR) if BROKER_BACKEND == "unix" else InProcessBroker()
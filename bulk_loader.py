@@ -0,0 +1,101 @@
+import asyncio
+import os
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+from db import get_database
+from schemas import TasteProfile
+
+supabase = get_database()
+
+# Rows per request; PostgREST caps responses at 1000 rows by default.
+PAGE_SIZE = 1000
+# Values per `in_` filter, kept small enough for the query string.
+BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "200"))
+
+PROFILE_TABLES = {
+    "artist_ids": ("user_artists", "artist_id"),
+    "track_ids": ("user_tracks", "track_id"),
+    "genre_ids": ("user_genres", "genre_id"),
+}
+
+# Unique key per table, the tie-breaking order that keeps pages from
+# skipping or repeating rows.
+TABLE_KEYS = {
+    "users": ("user_id",),
+    "matches": ("match_id",),
+    "messages": ("message_id",),
+    "latest_messages": ("match_id",),
+    "artists": ("artist_id",),
+    "tracks": ("track_id",),
+    "genres": ("genre_id",),
+    "user_artists": ("user_id", "artist_id"),
+    "user_tracks": ("user_id", "track_id"),
+    "user_genres": ("user_id", "genre_id"),
+    "spotify_accounts": ("user_id",),
+}
+
+
+async def fetch_paged(make_query: Callable, order_by: Sequence[str]) -> List[dict]:
+    """
+    Run the query built by `make_query()` page by page until it is exhausted.
+    A new builder is needed for every page because `range` mutates it.
+
+    Every page is ordered by the `order_by` columns (after any order the
+    query already has), which must form a unique key: without a total order
+    Postgres may return rows in a different order for every page.
+    """
+    rows = []
+    start = 0
+    while True:
+        query = make_query()
+        for column in order_by:
+            query = query.order(column)
+        response = await query.range(start, start + PAGE_SIZE - 1).execute()
+        page = response.data or []
+        rows.extend(page)
+        if len(page) < PAGE_SIZE:
+            return rows
+        start += PAGE_SIZE
+
+
+async def fetch_rows_in(table: str, columns: str, column: str, values: Iterable,
+                  batch_size: int = BATCH_SIZE, refine: Optional[Callable] = None,
+                  order_by: Optional[Sequence[str]] = None) -> List[dict]:
+    """
+    Fetch all rows of `table` whose `column` is in `values`, `batch_size` values per query.
+    `refine(query)` can add further filters or ordering to every query. Pages
+    are ordered by `order_by`, the table's key from TABLE_KEYS by default.
+    """
+    order_by = order_by or TABLE_KEYS[table]
+    values = list(dict.fromkeys(v for v in values if v is not None))
+
+    def make_query(batch):
+        query = supabase.table(table).select(columns).in_(column, batch)
+        return refine(query) if refine else query
+
+    pages = await asyncio.gather(*(
+        fetch_paged(lambda batch=values[i:i + batch_size]: make_query(batch), order_by)
+        for i in range(0, len(values), batch_size)
+    ))
+    return [row for page in pages for row in page]
+
+
+async def load_taste_profiles(user_ids: Iterable[int], batch_size: int = BATCH_SIZE) -> Dict[int, TasteProfile]:
+    """
+    Load the artists, tracks and genres of many users at once.
+    Costs three paged queries per `batch_size` users, run concurrently; every
+    requested user gets a profile, empty if they have no rows.
+    """
+    grouped = {user_id: {field: set() for field in PROFILE_TABLES} for user_id in user_ids if user_id is not None}
+
+    results = await asyncio.gather(*(
+        fetch_rows_in(table, f"user_id, {column}", "user_id", grouped.keys(), batch_size)
+        for table, column in PROFILE_TABLES.values()
+    ))
+    for (field, (table, column)), rows in zip(PROFILE_TABLES.items(), results):
+        for row in rows:
+            user_sets = grouped.get(row.get("user_id"))
+            if user_sets is not None and row.get(column) is not None:
+                user_sets[field].add(row[column])
+
+    return {user_id: TasteProfile(user_id=user_id, **sets) for user_id, sets in grouped.items()}
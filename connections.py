@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+from fastapi import WebSocket
+
+from broker import broker as default_broker
+
+# Messages waiting for one socket before it counts as a slow consumer.
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "100"))
+# What to do with a slow consumer: "disconnect" closes the socket (the client
+# reconnects and reloads the chat), "drop" skips messages for it until its
+# queue has room again.
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "disconnect")
+# A single send taking longer than this closes the socket under either policy.
+WS_SEND_TIMEOUT_SECONDS = float(os.getenv("WS_SEND_TIMEOUT_SECONDS", "10"))
+
+# Close code for sockets dropped as slow consumers ("try again later").
+SLOW_CONSUMER_CLOSE_CODE = 1013
+# Close code for sockets whose send failed ("internal error"); the client reconnects.
+SEND_FAILED_CLOSE_CODE = 1011
+
+
+class Connection:
+    """One WebSocket with its own bounded outbound queue, drained by a writer task."""
+
+    def __init__(self, manager: "ConnectionManager", websocket: WebSocket, user_id: str):
+        self.manager = manager
+        self.websocket = websocket
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.writer: Optional[asyncio.Task] = None
+        self.closed = False
+
+    def start(self):
+        self.writer = asyncio.create_task(self._write_loop())
+
+    def enqueue(self, message: dict) -> bool:
+        """Queue `message` without waiting; False when the connection is (being) dropped."""
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait((time.monotonic(), message))
+            return True
+        except asyncio.QueueFull:
+            if WS_SLOW_CONSUMER_POLICY == "drop":
+                self.manager.messages_dropped += 1
+                return False
+            self.manager.slow_consumers_disconnected += 1
+            logging.warning(f"Disconnecting slow WebSocket consumer of user {self.user_id}")
+            self.close(SLOW_CONSUMER_CLOSE_CODE, "Slow consumer")
+            return False
+
+    async def _write_loop(self):
+        while True:
+            queued_at, message = await self.queue.get()
+            started = time.monotonic()
+            try:
+                await asyncio.wait_for(self.websocket.send_json(message), WS_SEND_TIMEOUT_SECONDS)
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                self.manager.slow_consumers_disconnected += 1
+                logging.warning(f"WebSocket send to user {self.user_id} timed out, disconnecting")
+                self.close(SLOW_CONSUMER_CLOSE_CODE, "Slow consumer")
+                return
+            except Exception as e:
+                logging.error(f"WebSocket send to user {self.user_id} failed: {e}")
+                self.close(SEND_FAILED_CLOSE_CODE, "Send failed")
+                return
+            self.manager.record_send(time.monotonic() - started, time.monotonic() - queued_at)
+
+    def close(self, code: Optional[int] = None, reason: str = ""):
+        """Stop the writer and unregister; also closes the socket in the background when `code` is given."""
+        if self.closed:
+            return
+        self.closed = True
+        self.manager.remove(self)
+        if self.writer and self.writer is not asyncio.current_task():
+            self.writer.cancel()
+        if code is not None:
+            asyncio.create_task(self._close_socket(code, reason))
+
+    async def _close_socket(self, code: int, reason: str):
+        try:
+            await asyncio.wait_for(self.websocket.close(code=code, reason=reason), WS_SEND_TIMEOUT_SECONDS)
+        except Exception:
+            pass
+
+
+class ConnectionManager:
+    """
+    Open WebSockets per user_id.
+
+    `send_message` goes through the broker, which hands the message to the
+    worker(s) holding the user's connections; there `deliver_local` only puts
+    it on each connection queue, so one slow socket never delays the others;
+    every connection's writer task sends independently. Full queues are
+    handled according to WS_SLOW_CONSUMER_POLICY.
+    """
+
+    def __init__(self, broker=default_broker):
+        self.broker = broker
+        self.active_connections: Dict[str, List[Connection]] = {}
+        self.messages_sent = 0
+        self.messages_dropped = 0
+        self.slow_consumers_disconnected = 0
+        self.send_seconds_total = 0.0
+        self.send_seconds_max = 0.0
+        self.delivery_seconds_total = 0.0
+        self.delivery_seconds_max = 0.0
+
+    async def connect(self, websocket: WebSocket, user_id: str):
+        await websocket.accept()
+        connection = Connection(self, websocket, user_id)
+        self.active_connections.setdefault(user_id, []).append(connection)
+        self.broker.register(user_id)
+        connection.start()
+
+    def remove(self, connection: Connection):
+        connections = self.active_connections.get(connection.user_id)
+        if connections and connection in connections:
+            connections.remove(connection)
+            if not connections:
+                del self.active_connections[connection.user_id]
+                self.broker.unregister(connection.user_id)
+
+    async def disconnect(self, websocket: WebSocket, user_id: str):
+        for connection in list(self.active_connections.get(user_id, [])):
+            if connection.websocket is websocket:
+                connection.close()
+
+    async def start(self):
+        await self.broker.start(self.deliver_local)
+
+    async def stop(self):
+        await self.broker.stop()
+
+    async def send_message(self, message: dict, user_id: str):
+        await self.broker.publish(user_id, message)
+
+    async def deliver_local(self, message: dict, user_id: str):
+        for connection in list(self.active_connections.get(user_id, [])):
+            connection.enqueue(message)
+
+    def record_send(self, send_seconds: float, delivery_seconds: float):
+        self.messages_sent += 1
+        self.send_seconds_total += send_seconds
+        self.send_seconds_max = max(self.send_seconds_max, send_seconds)
+        self.delivery_seconds_total += delivery_seconds
+        self.delivery_seconds_max = max(self.delivery_seconds_max, delivery_seconds)
+
+    def stats(self) -> dict:
+        depths = [
+            connection.queue.qsize()
+            for connections in self.active_connections.values()
+            for connection in connections
+        ]
+        sent = self.messages_sent
+        return {
+            "broker": self.broker.stats(),
+            "users": len(self.active_connections),
+            "connections": len(depths),
+            "queue_depth_total": sum(depths),
+            "queue_depth_max": max(depths, default=0),
+            "queue_size": WS_SEND_QUEUE_SIZE,
+            "slow_consumer_policy": WS_SLOW_CONSUMER_POLICY,
+            "messages_sent": sent,
+            "messages_dropped": self.messages_dropped,
+            "slow_consumers_disconnected": self.slow_consumers_disconnected,
+            "send_seconds_avg": self.send_seconds_total / sent if sent else None,
+            "send_seconds_max": self.send_seconds_max,
+            "delivery_seconds_avg": self.delivery_seconds_total / sent if sent else None,
+            "delivery_seconds_max": self.delivery_seconds_max
+        }
+
+
+manager = ConnectionManager()
@@ -0,0 +1,93 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from supabase import acreate_client, AsyncClient
+
+from supabase_client import get_supabase_client, SUPABASE_URL, SUPABASE_API_KEY
+
+# "threadpool": run the sync supabase-py client on a bounded thread pool.
+# "async": use supabase-py's AsyncClient (falls back to the thread pool until connected).
+DB_MODE = os.getenv("DB_MODE", "threadpool")
+DB_MAX_CONCURRENCY = int(os.getenv("DB_MAX_CONCURRENCY", "16"))
+
+
+class _Query:
+    """
+    Wraps a postgrest request builder so that `execute()` returns an awaitable
+    running through the database's concurrency limit, whatever the client.
+    """
+
+    def __init__(self, query, database: "Database"):
+        self._query = query
+        self._database = database
+
+    def __getattr__(self, name):
+        attr = getattr(self._query, name)
+        if not callable(attr):
+            return _Query(attr, self._database) if hasattr(attr, "execute") else attr
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            return _Query(result, self._database) if hasattr(result, "execute") else result
+
+        return call
+
+    async def execute(self):
+        return await self._database.run_query(self._query.execute)
+
+
+class Database:
+    """
+    Non-blocking access to Supabase for the async endpoints.
+
+    `table()` and `rpc()` mirror the supabase-py client, but `execute()` must
+    be awaited: `await db.table("users").select("*").execute()`. At most
+    `max_concurrency` queries run at once; independent ones can be awaited
+    together with `asyncio.gather`.
+    """
+
+    def __init__(self, mode: str = DB_MODE, max_concurrency: int = DB_MAX_CONCURRENCY):
+        self.mode = mode
+        self.max_concurrency = max_concurrency
+        self.sync_client = get_supabase_client()
+        self.async_client: Optional[AsyncClient] = None
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="db")
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def connect(self):
+        if self.mode == "async" and self.async_client is None:
+            self.async_client = await acreate_client(SUPABASE_URL, SUPABASE_API_KEY)
+
+    def _client(self):
+        return self.async_client if self.async_client is not None else self.sync_client
+
+    def table(self, name: str) -> _Query:
+        return _Query(self._client().table(name), self)
+
+    def rpc(self, name: str, params: Optional[dict] = None) -> _Query:
+        return _Query(self._client().rpc(name, params or {}), self)
+
+    @property
+    def storage(self):
+        """Sync storage client; call it through `run_sync`."""
+        return self.sync_client.storage
+
+    async def run_query(self, execute: Callable):
+        async with self._semaphore:
+            if asyncio.iscoroutinefunction(execute):
+                return await execute()
+            return await asyncio.get_running_loop().run_in_executor(self._executor, execute)
+
+    async def run_sync(self, func: Callable, *args):
+        """Run any other blocking call of the client on the database pool."""
+        async with self._semaphore:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+
+database = Database()
+
+
+def get_database() -> Database:
+    return database
@@ -0,0 +1,43 @@
+import os
+from typing import Optional
+
+from cache import TTLCache
+
+IDENTITY_CACHE_MAX_SIZE = int(os.getenv("IDENTITY_CACHE_MAX_SIZE", "10000"))
+IDENTITY_CACHE_TTL_SECONDS = float(os.getenv("IDENTITY_CACHE_TTL_SECONDS", "300"))
+
+
+class IdentityCache:
+    """Email <-> user_id mapping in both directions, bounded by size and age."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.by_email = TTLCache(max_size, ttl)
+        self.by_user_id = TTLCache(max_size, ttl)
+
+    def user_id_for(self, email: str) -> Optional[int]:
+        return self.by_email.get(email)
+
+    def email_for(self, user_id: int) -> Optional[str]:
+        return self.by_user_id.get(user_id)
+
+    def remember(self, email: str, user_id: int):
+        if email is None or user_id is None:
+            return
+        self.by_email.set(email, user_id)
+        self.by_user_id.set(user_id, email)
+
+    def invalidate(self, email: Optional[str] = None, user_id: Optional[int] = None):
+        if email is not None:
+            cached_id = self.by_email.pop(email)
+            if cached_id is not None:
+                self.by_user_id.pop(cached_id)
+        if user_id is not None:
+            cached_email = self.by_user_id.pop(user_id)
+            if cached_email is not None:
+                self.by_email.pop(cached_email)
+
+    def stats(self) -> dict:
+        return {"by_email": self.by_email.stats(), "by_user_id": self.by_user_id.stats()}
+
+
+identity_cache = IdentityCache(IDENTITY_CACHE_MAX_SIZE, IDENTITY_CACHE_TTL_SECONDS)
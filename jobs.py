@@ -0,0 +1,308 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, Optional
+
+from schemas import Job
+
+# "inprocess": the API process runs the workers. "external": the API only
+# enqueues and `python worker.py` runs the jobs (needs the sqlite backend).
+JOBS_MODE = os.getenv("JOBS_MODE", "inprocess")
+# "sqlite": jobs in JOB_DB_PATH, visible to every worker process of the host.
+# "memory": jobs only exist in one process; only for a single uvicorn worker,
+# since GET /jobs/{job_id} answers 404 on every other worker.
+JOB_BACKEND = os.getenv("JOB_BACKEND", "sqlite")
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", ".jobs.sqlite3")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "5"))
+# A running job whose worker stops reporting for this long is picked up again.
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "600"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "0.5"))
+# Finished jobs (and their results) are deleted this long after they finished.
+JOB_RESULT_TTL_SECONDS = float(os.getenv("JOB_RESULT_TTL_SECONDS", "86400"))
+
+ACTIVE_STATUSES = ("queued", "running")
+FINISHED_STATUSES = ("succeeded", "failed")
+
+
+def _expire_lease(job: Job, now: float) -> bool:
+    """
+    Fail a running job whose lease expired with no attempts left, e.g. because
+    it crashed its worker every time; True when it was failed.
+    """
+    if job.status != "running" or job.attempts < job.max_attempts:
+        return False
+    job.status = "failed"
+    job.error = job.error or f"Lease expired after {job.attempts} attempts"
+    job.run_after = now
+    job.updated_at = _now()
+    return True
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class MemoryJobBackend:
+    """Jobs in a dict; only workers of this process can see them."""
+
+    def __init__(self, result_ttl: float = JOB_RESULT_TTL_SECONDS):
+        self.result_ttl = result_ttl
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float):
+        for job_id in [
+            job_id for job_id, job in self._jobs.items()
+            if job.status in FINISHED_STATUSES and job.run_after < now - self.result_ttl
+        ]:
+            del self._jobs[job_id]
+
+    def enqueue(self, job: Job) -> Job:
+        with self._lock:
+            if job.dedupe_key:
+                for existing in self._jobs.values():
+                    if existing.dedupe_key == job.dedupe_key and existing.status in ACTIVE_STATUSES:
+                        return existing.model_copy()
+            self._jobs[job.job_id] = job.model_copy()
+            return job
+
+    def claim(self, lease_seconds: float) -> Optional[Job]:
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            ready = []
+            for job in self._jobs.values():
+                if job.status in ACTIVE_STATUSES and job.run_after <= now and not _expire_lease(job, now):
+                    ready.append(job)
+            if not ready:
+                return None
+            job = min(ready, key=lambda j: j.created_at)
+            job.status = "running"
+            job.attempts += 1
+            job.run_after = now + lease_seconds
+            job.updated_at = _now()
+            return job.model_copy()
+
+    def update(self, job: Job):
+        with self._lock:
+            self._jobs[job.job_id] = job.model_copy()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job.model_copy() if job else None
+
+
+class SQLiteJobBackend:
+    """
+    Jobs in a SQLite file, so every worker process on the same host can see
+    and run them. The file is opened on first use.
+    """
+
+    def __init__(self, path: str, result_ttl: float = JOB_RESULT_TTL_SECONDS):
+        self.path = path
+        self.result_ttl = result_ttl
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, dedupe_key TEXT, status TEXT NOT NULL, "
+                "run_after REAL NOT NULL, created_at TEXT NOT NULL, data TEXT NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, run_after)")
+            self._conn = db
+        return self._conn
+
+    def _write(self, job: Job):
+        self._db.execute(
+            "INSERT OR REPLACE INTO jobs (job_id, dedupe_key, status, run_after, created_at, data) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (job.job_id, job.dedupe_key, job.status, job.run_after, job.created_at.isoformat(),
+             job.model_dump_json())
+        )
+
+    def enqueue(self, job: Job) -> Job:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                if job.dedupe_key:
+                    row = self._db.execute(
+                        "SELECT data FROM jobs WHERE dedupe_key = ? AND status IN (?, ?)",
+                        (job.dedupe_key, *ACTIVE_STATUSES)
+                    ).fetchone()
+                    if row:
+                        self._db.execute("COMMIT")
+                        return Job.model_validate_json(row[0])
+                self._write(job)
+                self._db.execute("COMMIT")
+                return job
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def claim(self, lease_seconds: float) -> Optional[Job]:
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute(
+                    "DELETE FROM jobs WHERE status IN (?, ?) AND run_after < ?",
+                    (*FINISHED_STATUSES, now - self.result_ttl)
+                )
+                while True:
+                    row = self._db.execute(
+                        "SELECT data FROM jobs WHERE status IN (?, ?) AND run_after <= ? ORDER BY created_at LIMIT 1",
+                        (*ACTIVE_STATUSES, now)
+                    ).fetchone()
+                    if not row:
+                        self._db.execute("COMMIT")
+                        return None
+                    job = Job.model_validate_json(row[0])
+                    if not _expire_lease(job, now):
+                        break
+                    self._write(job)
+                job.status = "running"
+                job.attempts += 1
+                job.run_after = now + lease_seconds
+                job.updated_at = _now()
+                self._write(job)
+                self._db.execute("COMMIT")
+                return job
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def update(self, job: Job):
+        with self._lock:
+            self._write(job)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            row = self._db.execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return Job.model_validate_json(row[0]) if row else None
+
+
+JobHandler = Callable[[Job, Callable[[str], Awaitable[None]]], Awaitable[Optional[dict]]]
+
+
+class JobQueue:
+    """
+    Background jobs with retries, leases and per-key idempotency.
+
+    Handlers are registered by name with `@job_queue.handler(name)` and get
+    the job plus a `progress(text)` coroutine; what they return becomes the
+    job result. Failed attempts are retried with exponential backoff up to
+    the job's max_attempts; a job whose lease expires (its worker died) also
+    counts an attempt and is failed once none are left. Enqueuing with a
+    dedupe_key that already has a queued or running job returns that job
+    instead of a new one. Finished jobs are kept for JOB_RESULT_TTL_SECONDS.
+    """
+
+    def __init__(self, backend, lease_seconds: float = JOB_LEASE_SECONDS,
+                 retry_base_seconds: float = JOB_RETRY_BASE_SECONDS, poll_seconds: float = JOB_POLL_SECONDS):
+        self.backend = backend
+        self.lease_seconds = lease_seconds
+        self.retry_base_seconds = retry_base_seconds
+        self.poll_seconds = poll_seconds
+        self.handlers: Dict[str, JobHandler] = {}
+        self._workers = []
+
+    def handler(self, name: str):
+        def register(func: JobHandler) -> JobHandler:
+            self.handlers[name] = func
+            return func
+        return register
+
+    async def enqueue(self, name: str, payload: dict, dedupe_key: Optional[str] = None,
+                      max_attempts: int = JOB_MAX_ATTEMPTS) -> Job:
+        now = _now()
+        job = Job(
+            job_id=uuid.uuid4().hex,
+            name=name,
+            payload=payload,
+            dedupe_key=dedupe_key,
+            max_attempts=max_attempts,
+            created_at=now,
+            updated_at=now
+        )
+        return await asyncio.to_thread(self.backend.enqueue, job)
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        return await asyncio.to_thread(self.backend.get, job_id)
+
+    async def _save(self, job: Job):
+        job.updated_at = _now()
+        await asyncio.to_thread(self.backend.update, job)
+
+    async def run_one(self) -> bool:
+        """Claim and run one ready job; False when there was none."""
+        job = await asyncio.to_thread(self.backend.claim, self.lease_seconds)
+        if job is None:
+            return False
+
+        async def progress(text: str):
+            job.progress = text
+            job.run_after = time.time() + self.lease_seconds
+            await self._save(job)
+
+        try:
+            handler = self.handlers[job.name]
+            job.result = await handler(job, progress)
+            job.status = "succeeded"
+            job.error = None
+        except Exception as e:
+            logging.error(f"Job {job.job_id} ({job.name}) attempt {job.attempts} failed: {e}")
+            job.error = str(e)
+            if job.attempts < job.max_attempts and job.name in self.handlers:
+                job.status = "queued"
+                job.run_after = time.time() + self.retry_base_seconds * 2 ** (job.attempts - 1)
+            else:
+                job.status = "failed"
+        if job.status in FINISHED_STATUSES:
+            job.run_after = time.time()
+        await self._save(job)
+        return True
+
+    async def run_worker(self):
+        while True:
+            try:
+                ran = await self.run_one()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Job worker error: {e}")
+                ran = False
+            if not ran:
+                await asyncio.sleep(self.poll_seconds)
+
+    def start(self, workers: int = JOB_WORKERS):
+        for _ in range(workers):
+            self._workers.append(asyncio.create_task(self.run_worker()))
+
+    async def run_forever(self, workers: int = JOB_WORKERS):
+        self.start(workers)
+        await asyncio.gather(*self._workers)
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+if JOBS_MODE == "external" and JOB_BACKEND != "sqlite":
+    raise RuntimeError("JOBS_MODE=external needs JOB_BACKEND=sqlite so the worker process can see the jobs")
+
+job_queue = JobQueue(SQLiteJobBackend(JOB_DB_PATH) if JOB_BACKEND == "sqlite" else MemoryJobBackend())
@@ -0,0 +1,329 @@
+import os
+import threading
+import zlib
+from itertools import islice
+from typing import Dict, Iterable, List, Optional, Set
+
+import numpy as np
+
+from match_engine import KINDS, MATCH_WEIGHTS, overlap_score, match_engine
+from taste_index import taste_index
+
+# "exact": score everybody sharing an item (match_engine). "lsh": score only
+# the MinHash candidates below, trading some recall for speed on large user bases.
+MATCH_CANDIDATES = os.getenv("MATCH_CANDIDATES", "exact")
+# MinHash permutations per kind. The score is an overlap coefficient, i.e. how
+# much of the smaller set lies in the larger one, and a pair whose smaller set
+# is a share c inside the larger becomes a candidate with probability about
+# 1 - (1 - c) ** LSH_PERMUTATIONS. More permutations raise recall and cost.
+LSH_PERMUTATIONS = int(os.getenv("LSH_PERMUTATIONS", "32"))
+# Candidates that get an exact score, most hits first.
+LSH_MAX_CANDIDATES = int(os.getenv("LSH_MAX_CANDIDATES", "2000"))
+# Users read from one posting list; keeps items like "pop" from dominating a query.
+LSH_MAX_BUCKET_SIZE = int(os.getenv("LSH_MAX_BUCKET_SIZE", "5000"))
+# Share of LSH queries that are also scored exactly to track recall.
+LSH_RECALL_SAMPLE_RATE = float(os.getenv("LSH_RECALL_SAMPLE_RATE", "0.01"))
+# Recall is also reported for the best this many exact matches.
+LSH_RECALL_TOP_K = int(os.getenv("LSH_RECALL_TOP_K", "50"))
+LSH_REBUILD_AFTER = int(os.getenv("LSH_REBUILD_AFTER", "5000"))
+LSH_SEED = int(os.getenv("LSH_SEED", "1"))
+
+# (user, item) pairs hashed per numpy step while building.
+_BUILD_CHUNK = 100_000
+
+
+def _item_hashes(item_ids: Iterable) -> np.ndarray:
+    return np.fromiter((zlib.crc32(str(item_id).encode()) for item_id in item_ids), dtype=np.uint64)
+
+
+class _Sketches:
+    """
+    Sketch postings of one kind: item hash -> users whose MinHash sketch
+    holds the item, once per permutation it was the minimum of, as sorted arrays.
+    """
+
+    def __init__(self, user_ids: np.ndarray, item_hashes: np.ndarray):
+        order = np.argsort(item_hashes, kind="stable")
+        # crc32 values: half the memory of the uint64 they are computed in.
+        self.sorted_hashes = item_hashes[order].astype(np.uint32)
+        self.sorted_users = user_ids[order]
+        self.users = len(np.unique(user_ids))
+
+    def lookup(self, item_hashes: np.ndarray) -> List[np.ndarray]:
+        starts = np.searchsorted(self.sorted_hashes, item_hashes, side="left")
+        ends = np.searchsorted(self.sorted_hashes, item_hashes, side="right")
+        return [self.sorted_users[start:min(end, start + LSH_MAX_BUCKET_SIZE)] for start, end in zip(starts, ends)]
+
+
+class LSHIndex:
+    """
+    Containment MinHash over every user's artist, track and genre sets.
+
+    Per kind and permutation the item with the smallest hash of a set is its
+    sketch item; the sketch of a set is a uniform sample of it, so with `c`
+    the share of a set S inside a set L, a sketch item of S lies in L with
+    probability `c`. `candidates` uses that in both directions, which is what
+    the overlap coefficient needs: users whose sketch holds one of the
+    current user's items (their set lies in the current one), and users
+    holding one of the current user's sketch items (the current set lies in
+    theirs), read from the taste index's posting lists. The share of
+    permutations that hit estimates that containment, so candidates are
+    ranked by the MATCH_WEIGHTS-weighted sum over kinds of the larger of the
+    two, an estimate of the score; `score_all` gives them the exact overlap
+    score. Like the match engine the sketch postings are built from the taste
+    index and users changed afterwards are kept in a small overlay until the
+    next rebuild. Once in use, the postings of a reloaded index are built in
+    the loading thread and taken over by the next query.
+    """
+
+    def __init__(self, index, permutations: int = LSH_PERMUTATIONS, seed: int = LSH_SEED):
+        self.index = index
+        self.permutations = permutations
+        rng = np.random.default_rng(seed)
+        # Multiply-shift hashing: h(x) = (a * x + b) mod 2**64 >> 32, a odd.
+        self._a = rng.integers(0, 2 ** 63, permutations, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self._b = rng.integers(0, 2 ** 63, permutations, dtype=np.uint64)
+        self._lock = threading.Lock()
+        self._base: Dict[str, _Sketches] = {}
+        # kind -> user_id -> sketch item hashes (None: no items) for users changed since the build
+        self._overlay: Dict[str, Dict[int, Optional[List[int]]]] = {kind: {} for kind in KINDS}
+        # kind -> item hash -> {user_id: permutations} of the overlay users
+        self._overlay_postings: Dict[str, Dict[int, Dict[int, int]]] = {kind: {} for kind in KINDS}
+        self._dirty: Set[int] = set()
+        self._built = False
+        self._generation = None
+        # (sketch postings, generation, users changed during that load) built off the query path
+        self._pending: Optional[tuple] = None
+        self.queries = 0
+        self.recall_samples = 0
+        self.recall_sum = 0.0
+        self.recall_top_k_sum = 0.0
+        self.last_recall: Optional[float] = None
+        index.subscribe(self._on_change)
+        index.on_load(self._prepare)
+
+    def _on_change(self, kind: str, user_id: int):
+        self._dirty.add(user_id)
+
+    def _prepare(self, user_items: Dict[str, Dict[int, Set]]):
+        """Build the sketch postings of a freshly loaded index, unless LSH is not in use."""
+        if not self._built and MATCH_CANDIDATES != "lsh":
+            return None
+        base = {kind: self._build_kind(user_items[kind]) for kind in KINDS}
+
+        def install(generation: int, changed: Set[int]):
+            self._pending = (base, generation, changed)
+        return install
+
+    def _minhashes(self, hashes: np.ndarray) -> np.ndarray:
+        """(permutations, len(hashes)) multiply-shift hashes."""
+        return (self._a[:, None] * hashes[None, :] + self._b[:, None]) >> np.uint64(32)
+
+    def _sketch_positions(self, hashes: np.ndarray, starts: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+        """
+        Positions in `hashes` of the sketch items of the sets given by the
+        `starts`/`sizes` runs, one per permutation (and set).
+        """
+        minhashes = self._minhashes(hashes)
+        minimums = np.minimum.reduceat(minhashes, starts, axis=1)
+        _, positions = np.nonzero(minhashes == np.repeat(minimums, sizes, axis=1))
+        return positions
+
+    def sketch(self, item_ids: Iterable) -> List:
+        """The sketch items of one set, one per permutation."""
+        item_ids = list(item_ids)
+        if not item_ids:
+            return []
+        positions = np.argmin(self._minhashes(_item_hashes(item_ids)), axis=1)
+        return [item_ids[position] for position in positions]
+
+    def _build_kind(self, user_items: Dict[int, Set]) -> _Sketches:
+        user_ids, sizes, items = [], [], []
+        for user_id, item_ids in user_items.items():
+            if item_ids:
+                user_ids.append(user_id)
+                sizes.append(len(item_ids))
+                items.extend(item_ids)
+        hashes = _item_hashes(items)
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        sizes = np.asarray(sizes, dtype=np.int64)
+        starts = np.cumsum(sizes) - sizes
+        positions = []
+
+        first = 0
+        while first < len(user_ids):
+            last = int(np.searchsorted(starts, starts[first] + _BUILD_CHUNK, side="right"))
+            last = max(last, first + 1)
+            begin = starts[first]
+            end = starts[last - 1] + sizes[last - 1]
+            positions.append(begin + self._sketch_positions(
+                hashes[begin:end], starts[first:last] - begin, sizes[first:last]
+            ))
+            first = last
+
+        positions = np.concatenate(positions) if positions else np.empty(0, dtype=np.int64)
+        return _Sketches(np.repeat(user_ids, sizes)[positions], hashes[positions])
+
+    def _build(self):
+        with self.index.lock:
+            self._dirty = set()
+            self._generation = self.index.generation
+            snapshot = {kind: dict(self.index.user_items[kind]) for kind in KINDS}
+        self._base = {kind: self._build_kind(snapshot[kind]) for kind in KINDS}
+        self._overlay = {kind: {} for kind in KINDS}
+        self._overlay_postings = {kind: {} for kind in KINDS}
+        self._built = True
+
+    def _refresh_dirty(self):
+        dirty, self._dirty = self._dirty, set()
+        for kind in KINDS:
+            overlay = self._overlay[kind]
+            postings = self._overlay_postings[kind]
+            for user_id in dirty:
+                old_hashes = overlay.get(user_id)
+                for item_hash in set(old_hashes or ()):
+                    members = postings.get(item_hash)
+                    if members is not None:
+                        members.pop(user_id, None)
+                        if not members:
+                            del postings[item_hash]
+                sketch = self.sketch(self.index.items_of(kind, user_id))
+                hashes = [int(item_hash) for item_hash in _item_hashes(sketch)] if sketch else None
+                overlay[user_id] = hashes
+                for item_hash in hashes or ():
+                    members = postings.setdefault(item_hash, {})
+                    members[user_id] = members.get(user_id, 0) + 1
+
+    def _take_pending(self):
+        with self.index.lock:
+            pending, self._pending = self._pending, None
+        if pending is None or pending[1] != self.index.generation:
+            return
+        base, generation, changed = pending
+        self._base = base
+        self._overlay = {kind: {} for kind in KINDS}
+        self._overlay_postings = {kind: {} for kind in KINDS}
+        # Users moved to the old overlay meanwhile are no longer in `_dirty`.
+        self._dirty |= changed
+        self._generation = generation
+        self._built = True
+
+    def ensure_built(self):
+        with self._lock:
+            self._take_pending()
+            if not self._built or self._generation != self.index.generation \
+                    or len(self._dirty) + len(self._overlay[KINDS[0]]) > LSH_REBUILD_AFTER:
+                self._build()
+            elif self._dirty:
+                self._refresh_dirty()
+
+    def candidates(self, user_id: int, limit: int = LSH_MAX_CANDIDATES) -> List[int]:
+        """Up to `limit` users found through the sketches of either side, highest estimated score first."""
+        self.ensure_built()
+        # (kind, direction) -> (users, permutations hit), one entry per posting read
+        found: Dict[tuple, list] = {}
+
+        def add(kind: str, direction: int, members: np.ndarray, hits):
+            found.setdefault((kind, direction), []).append((members, np.broadcast_to(np.float64(hits), members.shape)))
+
+        with self._lock:
+            for kind in KINDS:
+                item_ids = list(self.index.items_of(kind, user_id))
+                if not item_ids:
+                    continue
+                # Users whose sketch holds one of our items: their set lies (mostly) in ours.
+                hashes = np.unique(_item_hashes(item_ids))
+                overlay = self._overlay[kind]
+                extra = self._overlay_postings[kind]
+                for item_hash, members in zip(hashes, self._base[kind].lookup(hashes)):
+                    if overlay:
+                        # Overlay users are answered from their new sketch below.
+                        members = members[[int(other_id) not in overlay for other_id in members]]
+                    add(kind, 0, members, 1)
+                    overlay_members = extra.get(int(item_hash))
+                    if overlay_members:
+                        add(kind, 0, np.fromiter(overlay_members.keys(), dtype=np.int64),
+                            np.fromiter(overlay_members.values(), dtype=np.float64))
+
+                # Users holding one of our sketch items: our set lies (mostly) in theirs.
+                sketch = self.sketch(item_ids)
+                with self.index.lock:
+                    postings = self.index.postings[kind]
+                    for item_id in set(sketch):
+                        posting = postings.get(item_id, ())
+                        add(kind, 1, np.fromiter(islice(posting, LSH_MAX_BUCKET_SIZE), dtype=np.int64),
+                            sketch.count(item_id))
+
+        if not found:
+            return []
+        user_ids = np.unique(np.concatenate([members for entries in found.values() for members, _ in entries]))
+        containment = {}
+        for key, entries in found.items():
+            rows = np.searchsorted(user_ids, np.concatenate([members for members, _ in entries]))
+            hits = np.concatenate([weights for _, weights in entries])
+            containment[key] = np.bincount(rows, weights=hits, minlength=len(user_ids)) / self.permutations
+
+        estimate = np.zeros(len(user_ids), dtype=np.float64)
+        zeros = np.zeros(len(user_ids), dtype=np.float64)
+        for kind in KINDS:
+            larger = np.maximum(containment.get((kind, 0), zeros), containment.get((kind, 1), zeros))
+            estimate = estimate + np.minimum(larger, 1.0) * MATCH_WEIGHTS[kind]
+        estimate[user_ids == user_id] = -1
+        best = np.argsort(-estimate, kind="stable")[:limit]
+        return [int(other_id) for other_id in user_ids[best[estimate[best] > 0]]]
+
+    def score_all(self, user_id: int, limit: int = LSH_MAX_CANDIDATES) -> Dict[int, float]:
+        """Exact scores of the LSH candidates of `user_id`, same shape as match_engine.score_all."""
+        self.queries += 1
+        current = {kind: set(self.index.items_of(kind, user_id)) for kind in KINDS}
+        results = {}
+        for other_id in self.candidates(user_id, limit):
+            other = {kind: self.index.items_of(kind, other_id) for kind in KINDS}
+            score = overlap_score(current, other)
+            if score:
+                results[other_id] = score
+        return results
+
+    def record_recall(self, approximate: Dict[int, float], exact: Dict[int, float]) -> float:
+        """
+        Share of the exact matches (user_id -> score) the LSH path found too;
+        the recall of the best LSH_RECALL_TOP_K exact matches is kept alongside.
+        """
+        found = set(approximate)
+        top = sorted(exact, key=exact.get, reverse=True)[:LSH_RECALL_TOP_K]
+        recall = len(found & set(exact)) / len(exact) if exact else 1.0
+        self.recall_samples += 1
+        self.recall_sum += recall
+        self.recall_top_k_sum += len(found & set(top)) / len(top) if top else 1.0
+        self.last_recall = recall
+        return recall
+
+    def stats(self) -> dict:
+        return {
+            "mode": MATCH_CANDIDATES,
+            "permutations": self.permutations,
+            "users": {kind: self._base[kind].users if kind in self._base else 0 for kind in KINDS},
+            "overlay_users": len(self._overlay[KINDS[0]]),
+            "queries": self.queries,
+            "recall_samples": self.recall_samples,
+            "mean_recall": self.recall_sum / self.recall_samples if self.recall_samples else None,
+            "mean_recall_top_k": self.recall_top_k_sum / self.recall_samples if self.recall_samples else None,
+            "last_recall": self.last_recall
+        }
+
+
+lsh_index = LSHIndex(taste_index)
+
+
+def measure_recall(user_ids: Iterable[int], min_score: float = 10) -> Optional[float]:
+    """
+    Mean recall of the LSH path against the exact engine over `user_ids`,
+    counting only matches above `min_score`. CPU-bound; the taste index must
+    be loaded.
+    """
+    recalls = []
+    for user_id in user_ids:
+        exact = {other_id: score for other_id, score in match_engine.score_all(user_id).items() if score > min_score}
+        approximate = {other_id: score for other_id, score in lsh_index.score_all(user_id).items() if score > min_score}
+        recalls.append(lsh_index.record_recall(approximate, exact))
+    return sum(recalls) / len(recalls) if recalls else None
@@ -0,0 +1,34 @@
+import os
+from typing import Iterable, Optional
+
+from cache import TTLCache
+
+MATCH_CACHE_MAX_SIZE = int(os.getenv("MATCH_CACHE_MAX_SIZE", "50000"))
+# Bounds how long another worker's deletes can go unnoticed here.
+MATCH_CACHE_TTL_SECONDS = float(os.getenv("MATCH_CACHE_TTL_SECONDS", "600"))
+
+
+class MatchCache:
+    """match_id -> {"user1_id", "user2_id"} for chat authorization and routing."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.participants = TTLCache(max_size, ttl)
+
+    def get(self, match_id: int) -> Optional[dict]:
+        return self.participants.get(match_id)
+
+    def remember(self, rows: Iterable[dict]):
+        """Store rows of the matches table (need match_id, user1_id and user2_id)."""
+        for row in rows:
+            if row.get("match_id") is not None:
+                self.participants.set(row["match_id"], {"user1_id": row["user1_id"], "user2_id": row["user2_id"]})
+
+    def invalidate(self, match_ids: Iterable[int]):
+        for match_id in match_ids:
+            self.participants.pop(match_id)
+
+    def stats(self) -> dict:
+        return self.participants.stats()
+
+
+match_cache = MatchCache(MATCH_CACHE_MAX_SIZE, MATCH_CACHE_TTL_SECONDS)
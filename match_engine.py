@@ -0,0 +1,316 @@
+import heapq
+import os
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from scipy import sparse
+
+from taste_index import taste_index
+
+# Order matters: scores are summed in this order, as the API always has.
+MATCH_WEIGHTS = {
+    "artist": 0.35,
+    "track": 0.25,
+    "genre": 0.40
+}
+KINDS = list(MATCH_WEIGHTS)
+
+# Users changed since the last build are scored in Python; past this many the
+# matrices are rebuilt instead.
+REBUILD_AFTER = int(os.getenv("MATCH_ENGINE_REBUILD_AFTER", "500"))
+
+
+def overlap_score(current: Dict[str, Set], other: Dict[str, Set]) -> float:
+    """Weighted overlap coefficient of two taste profiles, rounded like the API returns it."""
+    match_score = 0.0
+    for kind in KINDS:
+        shared = len(current[kind] & other[kind])
+        kind_match = shared / max(1, min(len(current[kind]), len(other[kind])))
+        match_score = match_score + kind_match * MATCH_WEIGHTS[kind]
+
+    return round(match_score * 100, 2)
+
+
+def taste_delta(old: Dict[str, Set], new: Dict[str, Set]) -> Dict[str, tuple]:
+    """kind -> (added items, removed items) between two taste profiles."""
+    return {kind: (new[kind] - old[kind], old[kind] - new[kind]) for kind in KINDS}
+
+
+def affected_users(index, user_id: int, old: Dict[str, Set], new: Dict[str, Set]) -> Set[int]:
+    """
+    Users whose score with `user_id` can differ between the `old` and `new` profiles.
+
+    Per kind a pair's score only depends on the shared count and on
+    min(len(A), len(B)). The shared count changes only with users holding an
+    added or removed item; the minimum changes only with overlapping users
+    whose own set is larger than the smaller of the two sizes of A.
+    """
+    result = set()
+    delta = taste_delta(old, new)
+    with index.lock:
+        for kind in KINDS:
+            postings = index.postings[kind]
+            added, removed = delta[kind]
+            for item_id in added | removed:
+                result.update(postings.get(item_id, ()))
+
+            if len(old[kind]) != len(new[kind]):
+                smaller = min(len(old[kind]), len(new[kind]))
+                user_items = index.user_items[kind]
+                for item_id in old[kind] | new[kind]:
+                    for other_id in postings.get(item_id, ()):
+                        if len(user_items.get(other_id, ())) > smaller:
+                            result.add(other_id)
+
+    result.discard(user_id)
+    return result
+
+
+class _Matrices:
+    """One build of the engine: the stacked user x item matrix and its row and column maps."""
+
+    def __init__(self, user_items: Dict[str, Dict[int, Set]], generation: int):
+        user_ids = sorted(set().union(*(user_items[kind].keys() for kind in KINDS)))
+        row_of = {user_id: row for row, user_id in enumerate(user_ids)}
+
+        rows, cols = [], []
+        col_of = {kind: {} for kind in KINDS}
+        sizes = np.zeros((len(user_ids), len(KINDS)), dtype=np.float64)
+        offset = 0
+        for k, kind in enumerate(KINDS):
+            kind_cols = col_of[kind]
+            for user_id, items in user_items[kind].items():
+                row = row_of[user_id]
+                sizes[row, k] = len(items)
+                for item_id in items:
+                    col = kind_cols.get(item_id)
+                    if col is None:
+                        col = kind_cols[item_id] = offset + len(kind_cols)
+                    rows.append(row)
+                    cols.append(col)
+            offset += len(kind_cols)
+
+        self.matrix = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float64), (rows, cols)),
+            shape=(len(user_ids), offset)
+        )
+        self.sizes = sizes
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.row_of = row_of
+        self.col_of = col_of
+        self.n_cols = offset
+        self.generation = generation
+
+
+class MatchEngine:
+    """
+    One-vs-all scorer over sparse binary user x item matrices.
+
+    Artists, tracks and genres are stacked side by side in a single CSR
+    matrix, so the shared counts of every user with the current one come out
+    of one sparse product with a (n_items x 3) indicator of the current user's
+    items. The matrices are built from the taste index, which must be loaded
+    first; users that change afterwards are scored from the index sets until
+    the next rebuild. When the index is (re)loaded the new matrices are built
+    in the loading thread and swapped in together with the new index, so
+    queries never wait for a full build after a reload.
+    Scoring is CPU-bound, so async callers should run it in a thread.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        # Serializes builds; scoring reads `_matrices` and `_dirty` under the index lock.
+        self._lock = threading.Lock()
+        self._matrices: Optional[_Matrices] = None
+        self._dirty: Set[int] = set()
+        self.topk_queries = 0
+        self.topk_scored = 0
+        self.topk_candidates = 0
+        self.builds = 0
+        self.background_builds = 0
+        index.subscribe(self._on_change)
+        index.on_load(self._prepare)
+
+    def _on_change(self, kind: str, user_id: int):
+        self._dirty.add(user_id)
+
+    def _prepare(self, user_items: Dict[str, Dict[int, Set]]):
+        """Build the matrices of a freshly loaded index, off the query path."""
+        matrices = _Matrices(user_items, generation=None)
+
+        def install(generation: int, changed: Set[int]):
+            # Runs under the index lock as the new index goes live; `changed`
+            # are the users written while it was loading.
+            matrices.generation = generation
+            self._matrices = matrices
+            self._dirty = set(changed)
+            self.background_builds += 1
+        return install
+
+    def _build(self):
+        with self.index.lock:
+            self._matrices = _Matrices(self.index.user_items, self.index.generation)
+            self._dirty = set()
+        self.builds += 1
+
+    def ensure_built(self):
+        with self._lock:
+            matrices = self._matrices
+            if matrices is None or matrices.generation != self.index.generation or len(self._dirty) > REBUILD_AFTER:
+                self._build()
+
+    def _current_sets(self, user_id: int) -> Dict[str, Set]:
+        return {kind: set(self.index.items_of(kind, user_id)) for kind in KINDS}
+
+    def score_all(self, user_id: int) -> Dict[int, float]:
+        """Scores of every other user sharing at least one item with `user_id`."""
+        self.ensure_built()
+        with self.index.lock:
+            current = self._current_sets(user_id)
+            matrices, dirty = self._matrices, set(self._dirty)
+
+        results = {}
+        if matrices.n_cols and len(matrices.user_ids):
+            indicator = np.zeros((matrices.n_cols, len(KINDS)), dtype=np.float64)
+            for k, kind in enumerate(KINDS):
+                kind_cols = matrices.col_of[kind]
+                cols = [kind_cols[item_id] for item_id in current[kind] if item_id in kind_cols]
+                indicator[cols, k] = 1.0
+
+            shared = np.asarray(matrices.matrix @ indicator)
+            current_sizes = np.array([len(current[kind]) for kind in KINDS], dtype=np.float64)
+            denominators = np.maximum(1.0, np.minimum(current_sizes, matrices.sizes))
+            kind_match = shared / denominators
+
+            raw = np.zeros(len(matrices.user_ids), dtype=np.float64)
+            for k, kind in enumerate(KINDS):
+                raw = raw + kind_match[:, k] * MATCH_WEIGHTS[kind]
+
+            for row in np.flatnonzero(raw):
+                other_id = int(matrices.user_ids[row])
+                if other_id != user_id and other_id not in dirty:
+                    # Python's round() keeps the results identical to overlap_score.
+                    results[other_id] = round(float(raw[row]) * 100, 2)
+
+        for other_id in dirty:
+            if other_id == user_id:
+                continue
+            score = overlap_score(current, self._current_sets(other_id))
+            if score:
+                results[other_id] = score
+            else:
+                results.pop(other_id, None)
+
+        return results
+
+    def top_k(self, user_id: int, k: int, min_score: float = 10) -> List[Tuple[int, float]]:
+        """
+        The `k` best (user_id, score) pairs above `min_score`, best first and
+        ties by user_id, equal to the head of the sorted score_all result.
+
+        Artist and track overlaps come from their (small) posting lists and
+        are exact; the genre part is at most MATCH_WEIGHTS["genre"]. Candidates
+        are visited by that upper bound and scoring stops as soon as no
+        remaining bound can beat the k-th score found so far. Users sharing
+        only genres can score at most the genre weight and are only counted
+        when that can still make the list.
+        """
+        self.topk_queries += 1
+        current = self._current_sets(user_id)
+        sizes = {kind: len(current[kind]) for kind in KINDS}
+        genre_bound = MATCH_WEIGHTS["genre"] * 100
+
+        partial = {}
+        with self.index.lock:
+            for kind in ("artist", "track"):
+                shared = {}
+                postings = self.index.postings[kind]
+                for item_id in current[kind]:
+                    for other_id in postings.get(item_id, ()):
+                        shared[other_id] = shared.get(other_id, 0) + 1
+                user_items = self.index.user_items[kind]
+                for other_id, count in shared.items():
+                    denominator = max(1, min(sizes[kind], len(user_items.get(other_id, ()))))
+                    partial[other_id] = partial.get(other_id, 0.0) + count / denominator * MATCH_WEIGHTS[kind]
+        partial.pop(user_id, None)
+
+        # Min-heap of (score, -user_id): heap[0] is the entry the next better one replaces.
+        heap = []
+
+        def threshold() -> float:
+            return heap[0][0] if len(heap) >= k else min_score
+
+        def offer(other_id: int, bound: float) -> bool:
+            """Score `other_id` if its bound can still make the list; False once nothing can."""
+            # Rounding to 2 decimals can lift a score by up to 0.005 over its raw bound.
+            if bound + 0.005 < threshold():
+                return False
+            self.topk_scored += 1
+            # Same summation order as overlap_score, so the rounded scores are identical.
+            shared_genres = len(current["genre"] & user_genres.get(other_id, set()))
+            genre_match = shared_genres / max(1, min(sizes["genre"], len(user_genres.get(other_id, ()))))
+            score = round((partial[other_id] + genre_match * MATCH_WEIGHTS["genre"]) * 100, 2)
+            entry = (score, -other_id)
+            if score > min_score:
+                if len(heap) < k:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+            return True
+
+        user_genres = self.index.user_items["genre"]
+        if k > 0:
+            bounds = {
+                other_id: score * 100 + (genre_bound if sizes["genre"] and user_genres.get(other_id) else 0.0)
+                for other_id, score in partial.items()
+            }
+            for other_id in sorted(bounds, key=bounds.get, reverse=True):
+                if not offer(other_id, bounds[other_id]):
+                    break
+
+            if sizes["genre"] and genre_bound + 0.005 >= threshold() and genre_bound + 0.005 > min_score:
+                # No artist or track overlap, so the genre count gives the exact score.
+                shared = {}
+                with self.index.lock:
+                    postings = self.index.postings["genre"]
+                    for item_id in current["genre"]:
+                        for other_id in postings.get(item_id, ()):
+                            if other_id not in partial:
+                                shared[other_id] = shared.get(other_id, 0) + 1
+                    genre_scores = {
+                        other_id: round(
+                            count / max(1, min(sizes["genre"], len(user_genres.get(other_id, ()))))
+                            * MATCH_WEIGHTS["genre"] * 100, 2
+                        )
+                        for other_id, count in shared.items()
+                        if other_id != user_id
+                    }
+                self.topk_candidates += len(genre_scores)
+                self.topk_scored += len(genre_scores)
+                for other_id in sorted(genre_scores, key=lambda other_id: (-genre_scores[other_id], other_id)):
+                    entry = (genre_scores[other_id], -other_id)
+                    if entry[0] <= min_score or (len(heap) >= k and entry <= heap[0]):
+                        break
+                    if len(heap) < k:
+                        heapq.heappush(heap, entry)
+                    else:
+                        heapq.heapreplace(heap, entry)
+
+        self.topk_candidates += len(partial)
+        return [(-negative_id, score) for score, negative_id in sorted(heap, reverse=True)]
+
+    def stats(self) -> dict:
+        matrices = self._matrices
+        return {
+            "users": len(matrices.user_ids) if matrices else 0,
+            "dirty_users": len(self._dirty),
+            "builds": self.builds,
+            "background_builds": self.background_builds,
+            "top_k_queries": self.topk_queries,
+            "top_k_scored": self.topk_scored,
+            "top_k_candidates": self.topk_candidates
+        }
+
+
+match_engine = MatchEngine(taste_index)
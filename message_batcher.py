@@ -0,0 +1,117 @@
+import asyncio
+import os
+import time
+from typing import List, Optional, Set, Tuple
+
+from db import get_database
+
+# Off by default: every message is its own insert, as before.
+MESSAGE_BATCHING = os.getenv("MESSAGE_BATCHING", "0") == "1"
+# A batch is written as soon as it holds this many messages...
+MESSAGE_BATCH_FLUSH_SIZE = int(os.getenv("MESSAGE_BATCH_FLUSH_SIZE", "50"))
+# ...or this long after its first message arrived.
+MESSAGE_BATCH_FLUSH_INTERVAL_MS = float(os.getenv("MESSAGE_BATCH_FLUSH_INTERVAL_MS", "5"))
+
+database = get_database()
+
+
+class MessageBatcher:
+    """
+    Group commit for the messages table.
+
+    `insert(row)` waits until the row was written as part of one bulk insert
+    with the other rows that arrived within the flush interval and returns
+    the stored row, message_id included. Batches are written one at a time
+    in arrival order, so message_ids keep the order messages were sent in.
+    `stop()` writes what is still waiting and waits for running writes.
+    """
+
+    def __init__(self, table: str, flush_size: int, flush_interval: float):
+        self.table = table
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._pending: List[Tuple[dict, asyncio.Future, float]] = []
+        self._timer: Optional[asyncio.Task] = None
+        self._flushes: Set[asyncio.Task] = set()
+        self._write_lock = asyncio.Lock()
+        self.batches = 0
+        self.rows = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    async def insert(self, row: dict) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((row, future, time.monotonic()))
+        if len(self._pending) >= self.flush_size:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = self._track(asyncio.create_task(self._flush_later()))
+        return await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._timer = None
+        await self._flush(self._take())
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._track(asyncio.create_task(self._flush(self._take())))
+
+    def _track(self, task: asyncio.Task) -> asyncio.Task:
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+        return task
+
+    async def stop(self):
+        # A task like any other batch, so it queues for the write lock behind
+        # the batches taken before it.
+        if self._pending:
+            self._start_flush()
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    def _take(self) -> list:
+        batch, self._pending = self._pending, []
+        return batch
+
+    async def _flush(self, batch: list):
+        if not batch:
+            return
+        async with self._write_lock:
+            try:
+                response = await database.table(self.table).insert([row for row, _, _ in batch]).execute()
+                stored = response.data or []
+                if len(stored) != len(batch):
+                    raise Exception(f"Bulk insert returned {len(stored)} of {len(batch)} rows")
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+
+        now = time.monotonic()
+        self.batches += 1
+        self.rows += len(batch)
+        # Rows come back in the order they were sent.
+        for (_, future, queued_at), stored_row in zip(batch, stored):
+            wait = now - queued_at
+            self.wait_seconds_total += wait
+            self.wait_seconds_max = max(self.wait_seconds_max, wait)
+            if not future.done():
+                future.set_result(stored_row)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": MESSAGE_BATCHING,
+            "flush_size": self.flush_size,
+            "flush_interval_ms": self.flush_interval * 1000,
+            "batches": self.batches,
+            "rows": self.rows,
+            "rows_per_batch": self.rows / self.batches if self.batches else None,
+            "wait_seconds_avg": self.wait_seconds_total / self.rows if self.rows else None,
+            "wait_seconds_max": self.wait_seconds_max
+        }
+
+
+message_batcher = MessageBatcher("messages", MESSAGE_BATCH_FLUSH_SIZE, MESSAGE_BATCH_FLUSH_INTERVAL_MS / 1000)
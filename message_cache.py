@@ -0,0 +1,124 @@
+import os
+from collections import deque
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional
+
+from cache import TTLCache
+from schemas import Message
+
+# Newest messages kept per conversation; larger first pages go to the database.
+MESSAGE_CACHE_SIZE = int(os.getenv("MESSAGE_CACHE_SIZE", "50"))
+MESSAGE_CACHE_MAX_CONVERSATIONS = int(os.getenv("MESSAGE_CACHE_MAX_CONVERSATIONS", "5000"))
+# Other workers invalidate conversations they write to through the broker;
+# this bounds how stale a conversation gets when such an event is lost.
+MESSAGE_CACHE_TTL_SECONDS = float(os.getenv("MESSAGE_CACHE_TTL_SECONDS", "60"))
+
+
+class _Conversation:
+    def __init__(self, messages: Iterable[Message], complete: bool, size: int):
+        # Oldest first; appending past `size` drops the oldest.
+        self.messages = deque(messages, maxlen=size)
+        # True when the database held no older messages than these.
+        self.complete = complete
+
+
+class MessageCache:
+    """
+    Ring buffer of the newest messages per match, for the first page of a chat.
+
+    Conversations are loaded on the first page-1 request and evicted whole,
+    least recently used first. New messages and read receipts of this worker
+    are written through, those of other workers `invalidate` the conversation;
+    a load that raced with either is not kept.
+    """
+
+    def __init__(self, size: int, max_conversations: int, ttl: float):
+        self.size = size
+        self.conversations = TTLCache(max_conversations, ttl)
+        # match_id -> sequence number of its latest write, to detect loads
+        # that raced with a write. Matches not in it are at `_floor`, so
+        # pruning it only ever moves versions forward.
+        self._versions: Dict[int, int] = {}
+        self._sequence = 0
+        self._floor = 0
+        self.page_hits = 0
+        self.page_misses = 0
+        self.invalidations = 0
+
+    def version(self, match_id: int) -> int:
+        return self._versions.get(match_id, self._floor)
+
+    def _bump(self, match_id: int):
+        self._sequence += 1
+        if len(self._versions) >= 4 * self.conversations.max_size:
+            self._versions.clear()
+            self._floor = self._sequence
+        self._versions[match_id] = self._sequence
+
+    def first_page(self, match_id: int, page_size: int) -> Optional[List[Message]]:
+        """The newest `page_size` messages, newest first, or None when they are not all cached."""
+        conversation = self.conversations.get(match_id)
+        if conversation is None or (page_size > len(conversation.messages) and not conversation.complete):
+            self.page_misses += 1
+            return None
+        self.page_hits += 1
+        messages = list(conversation.messages)
+        messages.reverse()
+        return messages[:page_size]
+
+    def load(self, match_id: int, newest_first: List[Message], version: int):
+        """Store what a `size`-message first-page query returned, unless a write happened meanwhile."""
+        if self.version(match_id) != version:
+            return
+        self.conversations.set(match_id, _Conversation(
+            reversed(newest_first[:self.size]), complete=len(newest_first) < self.size, size=self.size
+        ))
+
+    def invalidate(self, match_id: int):
+        """Drop the conversation, e.g. after another worker wrote to it."""
+        self._bump(match_id)
+        self.invalidations += 1
+        self.conversations.pop(match_id)
+
+    def append(self, message: Message):
+        self._bump(message.match_id)
+        conversation = self.conversations.get(message.match_id)
+        if conversation is None:
+            return
+        messages = conversation.messages
+        if any(cached.message_id == message.message_id for cached in messages):
+            return
+        if len(messages) == messages.maxlen:
+            # The oldest message drops out of the buffer but not out of the database.
+            conversation.complete = False
+        if not messages or (message.sent_at, message.message_id) > (messages[-1].sent_at, messages[-1].message_id):
+            messages.append(message)
+        else:
+            ordered = sorted([*messages, message], key=lambda m: (m.sent_at, m.message_id))
+            messages.clear()
+            messages.extend(ordered)
+
+    def mark_read(self, match_id: int, reader_id: int, read_at: datetime):
+        """Same change as the read-receipt update: unread messages of the other user sent up to `read_at`."""
+        self._bump(match_id)
+        conversation = self.conversations.get(match_id)
+        if conversation is None:
+            return
+        for index, cached in enumerate(conversation.messages):
+            sent_at = cached.sent_at if cached.sent_at.tzinfo else cached.sent_at.replace(tzinfo=timezone.utc)
+            if cached.sender_id != reader_id and cached.read_at is None and sent_at <= read_at:
+                conversation.messages[index] = cached.model_copy(update={"read_at": read_at})
+
+    def stats(self) -> dict:
+        lookups = self.page_hits + self.page_misses
+        return {
+            "conversations": self.conversations.stats(),
+            "size": self.size,
+            "page_hits": self.page_hits,
+            "page_misses": self.page_misses,
+            "invalidations": self.invalidations,
+            "page_hit_rate": round(self.page_hits / lookups, 4) if lookups else None
+        }
+
+
+message_cache = MessageCache(MESSAGE_CACHE_SIZE, MESSAGE_CACHE_MAX_CONVERSATIONS, MESSAGE_CACHE_TTL_SECONDS)
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+# At most one read-receipt write per (reader, match) per interval; events in
+# between only move the watermark that the next write uses.
+READ_RECEIPT_INTERVAL_SECONDS = float(os.getenv("READ_RECEIPT_INTERVAL_SECONDS", "1"))
+# A failed write is retried at the next interval, at most this many times in a row.
+READ_RECEIPT_MAX_RETRIES = int(os.getenv("READ_RECEIPT_MAX_RETRIES", "5"))
+
+FlushCallback = Callable[[int, int, int, datetime], Awaitable[Optional[int]]]
+
+
+class _Pending:
+    def __init__(self, other_user_id: int):
+        self.other_user_id = other_user_id
+        self.watermark: Optional[datetime] = None
+        self.task: Optional[asyncio.Task] = None
+        self.failures = 0
+
+
+class ReadReceiptCoalescer:
+    """
+    Debounces read receipts per (reader, match).
+
+    The first receipt of a reader for a match is written right away; receipts
+    arriving during the following `interval` only move the watermark (the
+    time of the latest receipt), which is written once when the interval
+    ends. Flushing runs the `on_flush` callbacks in registration order with
+    (match_id, reader_id, other_user_id, watermark), e.g. the database update
+    and the notification of the other user. A flush that raises keeps its
+    watermark pending, so it is retried when the next interval ends, up to
+    `max_retries` times in a row.
+    """
+
+    def __init__(self, interval: float = READ_RECEIPT_INTERVAL_SECONDS, max_retries: int = READ_RECEIPT_MAX_RETRIES):
+        self.interval = interval
+        self.max_retries = max_retries
+        self._callbacks: List[FlushCallback] = []
+        self._pending: Dict[Tuple[int, int], _Pending] = {}
+        self.received = 0
+        self.flushed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def on_flush(self, callback: FlushCallback) -> FlushCallback:
+        self._callbacks.append(callback)
+        return callback
+
+    async def _flush(self, match_id: int, reader_id: int, pending: _Pending, watermark: datetime) -> Optional[int]:
+        result = None
+        for callback in self._callbacks:
+            value = await callback(match_id, reader_id, pending.other_user_id, watermark)
+            if result is None:
+                result = value
+        self.flushed += 1
+        pending.failures = 0
+        return result
+
+    def _flush_failed(self, match_id: int, reader_id: int, pending: _Pending, watermark: datetime, error: Exception):
+        self.failed += 1
+        pending.failures += 1
+        if pending.failures > self.max_retries:
+            self.dropped += 1
+            pending.failures = 0
+            logging.error(f"Read receipt of user {reader_id} for match {match_id} failed, giving up: {error}")
+            return
+        logging.error(f"Read receipt of user {reader_id} for match {match_id} failed, retrying: {error}")
+        if pending.watermark is None:
+            # A newer receipt already covers this one.
+            pending.watermark = watermark
+
+    async def mark_read(self, match_id: int, reader_id: int, other_user_id: int) -> dict:
+        """Record that `reader_id` has read the match up to now."""
+        self.received += 1
+        key = (reader_id, match_id)
+        now = datetime.now(timezone.utc)
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending.watermark = now
+            return {"status": "success", "coalesced": True}
+
+        pending = self._pending[key] = _Pending(other_user_id)
+        try:
+            updated_count = await self._flush(match_id, reader_id, pending, now)
+        except Exception as e:
+            self._flush_failed(match_id, reader_id, pending, now, e)
+            return {"status": "success", "retrying": True}
+        finally:
+            pending.task = asyncio.create_task(self._trailing_flush(key, pending))
+        return {"status": "success", "updated_count": updated_count}
+
+    async def _trailing_flush(self, key: Tuple[int, int], pending: _Pending):
+        reader_id, match_id = key
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                watermark, pending.watermark = pending.watermark, None
+                if watermark is None:
+                    return
+                try:
+                    await self._flush(match_id, reader_id, pending, watermark)
+                except Exception as e:
+                    self._flush_failed(match_id, reader_id, pending, watermark, e)
+        finally:
+            if self._pending.get(key) is pending:
+                del self._pending[key]
+
+    async def stop(self):
+        """Write the receipts still waiting for their interval to end."""
+        pending_items = list(self._pending.items())
+        for _, pending in pending_items:
+            if pending.task:
+                pending.task.cancel()
+        for (reader_id, match_id), pending in pending_items:
+            if pending.watermark is not None:
+                try:
+                    await self._flush(match_id, reader_id, pending, pending.watermark)
+                except Exception as e:
+                    self.failed += 1
+                    self.dropped += 1
+                    logging.error(f"Read receipt of user {reader_id} for match {match_id} failed: {e}")
+        self._pending.clear()
+
+    def stats(self) -> dict:
+        return {
+            "interval_seconds": self.interval,
+            "received": self.received,
+            "flushed": self.flushed,
+            "coalesced": self.received - self.flushed - self.dropped,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "pending": len(self._pending)
+        }
+
+
+read_receipts = ReadReceiptCoalescer()
@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 from datetime import date, datetime
-from typing import Optional, List
+from typing import Optional, List, Set, Dict
 
 class UserCreate(BaseModel):
     email: str
@@ -55,6 +55,35 @@ class TrackBasicInfo(BaseModel):
 class GenreList(BaseModel):
     genres: List[str]
 
+class TasteProfile(BaseModel):
+    user_id: int
+    artist_ids: Set[str] = set()
+    track_ids: Set[str] = set()
+    genre_ids: Set[int] = set()
+
+    def as_sets(self) -> Dict[str, set]:
+        return {"artist": self.artist_ids, "track": self.track_ids, "genre": self.genre_ids}
+
+class SpotifySnapshot(BaseModel):
+    saved_tracks: dict = {}
+    top_tracks: dict = {}
+    top_artists: dict = {}
+
+class Job(BaseModel):
+    job_id: str
+    name: str
+    payload: dict = {}
+    dedupe_key: Optional[str] = None
+    status: str = "queued"  # queued, running, succeeded, failed
+    attempts: int = 0
+    max_attempts: int = 3
+    progress: Optional[str] = None
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    run_after: float = 0.0  # next attempt, lease expiry while running, finish time once done
+    created_at: datetime
+    updated_at: datetime
+
 class MessageBase(BaseModel):
     match_id: int
     message_text: str
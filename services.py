@@ -1,13 +1,31 @@
-from supabase_client import get_supabase_client
+from db import get_database
 from schemas import *
 from auth import *
+from taste_index import taste_index, TASTE_TABLES
+from match_engine import match_engine, overlap_score, affected_users
+from lsh import lsh_index, MATCH_CANDIDATES, LSH_RECALL_SAMPLE_RATE
+from bulk_loader import load_taste_profiles, fetch_rows_in, fetch_paged, TABLE_KEYS
+from identity_cache import identity_cache
+from match_cache import match_cache
+from message_batcher import message_batcher, MESSAGE_BATCHING
+from message_cache import message_cache, MESSAGE_CACHE_SIZE
+from unread_counters import unread_counters
+from read_receipts import read_receipts
+from broker import broker
+from spotify_executor import spotify_call
+from artist_genre_cache import artist_genre_cache
 from datetime import timezone, datetime
+import asyncio
+import base64
+import logging
+import random
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 SUPABASE_STORAGE_URL = os.getenv("SUPABASE_STORAGE_URL")
-supabase = get_supabase_client()
+supabase = get_database()
+logger = logging.getLogger(__name__)
 
 async def register_user(user: UserCreate):
     if not await unique_email(user.email):
@@ -24,11 +42,12 @@ async def register_user(user: UserCreate):
     }
 
     response = (
-        supabase.table("users")
+        await supabase.table("users")
         .insert(request_body)
         .execute()
     )
 
+    identity_cache.invalidate(email=user.email)
 
     access_token = create_access_token(data={"sub": user.email}, expires_delta=30)
     return {"access_token": access_token, "token_type": "bearer"}
@@ -36,7 +55,7 @@ async def register_user(user: UserCreate):
 
 async def login_user(user: LoginUser):
     response = (
-        supabase.table("users")
+        await supabase.table("users")
         .select("*")
         .eq("email", user.email)
         .execute()
@@ -51,7 +70,7 @@ async def login_user(user: LoginUser):
 
 async def unique_email(email: str) -> bool:
     response = (
-        supabase.table("users")
+        await supabase.table("users")
         .select("*")
         .eq("email", email)
         .execute()
@@ -62,7 +81,7 @@ async def unique_email(email: str) -> bool:
 
 async def current_user_data(email: str) -> dict:
     user_response = (
-        supabase.table("users")
+        await supabase.table("users")
         .select("user_id", "first_name", "last_name", "birth_date", "gender", "bio", "location", "profile_picture_url")
         .eq("email", email)
         .maybe_single()
@@ -74,9 +93,10 @@ async def current_user_data(email: str) -> dict:
 
     user_data = user_response.data
     user_id = user_data.get("user_id")
+    identity_cache.remember(email, user_id)
 
     genre_response = (
-        supabase.table("user_genres")
+        await supabase.table("user_genres")
         .select("genres(name)")
         .eq("user_id", user_id)
         .execute()
@@ -109,12 +129,14 @@ async def current_user_data_update(first_name, last_name, birth_date, gender,
         request_body = {k: v for k, v in request_body.items() if v is not None}
 
         response = (
-            supabase.table("users")
+            await supabase.table("users")
             .update(request_body)
             .eq("email", current_user_email)
             .execute()
         )
 
+        identity_cache.invalidate(email=current_user_email)
+
         if not response.data:
             raise HTTPException(status_code=400, detail="User update failed")
 
@@ -129,7 +151,7 @@ async def upload_image(file, current_user_email):
 
         file_content = await file.read()
 
-        upload_response = supabase.storage.from_("SpotyDate").upload(file_name, file_content)
+        upload_response = await supabase.run_sync(supabase.storage.from_("SpotyDate").upload, file_name, file_content)
 
         return SUPABASE_STORAGE_URL + upload_response.full_path
     except Exception as e:
@@ -137,8 +159,7 @@ async def upload_image(file, current_user_email):
 
 
 async def tracks_upload(input_tracks, current_user_email):
-    user_response = supabase.table("users").select("user_id").eq("email", current_user_email).maybe_single().execute()
-    user_id = user_response.data.get("user_id")
+    user_id = await get_user_id_from_email(current_user_email)
 
     tracks_to_insert = []
     valid_track_ids = set()
@@ -149,7 +170,7 @@ async def tracks_upload(input_tracks, current_user_email):
             tracks_to_insert.append({"track_id": track_id, "name": track_name})
             valid_track_ids.add(track_id)
 
-    response_tracks = supabase.table("tracks").upsert(
+    response_tracks = await supabase.table("tracks").upsert(
         tracks_to_insert,
         ignore_duplicates=True,
         on_conflict='track_id'
@@ -159,16 +180,17 @@ async def tracks_upload(input_tracks, current_user_email):
     for track_id in valid_track_ids:
         user_tracks_to_insert.append({"user_id": user_id, "track_id": track_id})
 
-    response_user_tracks = supabase.table("user_tracks").upsert(
+    response_user_tracks = await supabase.table("user_tracks").upsert(
         user_tracks_to_insert,
         ignore_duplicates=True,
     ).execute()
 
+    taste_index.add_items("track", user_id, valid_track_ids)
+
 
 
 async def artists_upload(input_artists, current_user_email):
-    user_response = supabase.table("users").select("user_id").eq("email", current_user_email).maybe_single().execute()
-    user_id = user_response.data.get("user_id")
+    user_id = await get_user_id_from_email(current_user_email)
 
     artists_to_insert = []
     valid_artist_ids = set()
@@ -179,7 +201,7 @@ async def artists_upload(input_artists, current_user_email):
             artists_to_insert.append({"artist_id": artist_id, "name": artist_name})
             valid_artist_ids.add(artist_id)
 
-    response_artists = supabase.table("artists").upsert(
+    response_artists = await supabase.table("artists").upsert(
         artists_to_insert,
         ignore_duplicates=True,
         on_conflict='artist_id'
@@ -190,27 +212,28 @@ async def artists_upload(input_artists, current_user_email):
     for artist_id in valid_artist_ids:
         user_artists_to_insert.append({"user_id": user_id, "artist_id": artist_id})
 
-    response_user_artists = supabase.table("user_artists").upsert(
+    response_user_artists = await supabase.table("user_artists").upsert(
         user_artists_to_insert,
         ignore_duplicates=True,
     ).execute()
 
+    taste_index.add_items("artist", user_id, valid_artist_ids)
+
 
 async def genres_upload(input_genres: List[str], current_user_email: str):
-    user_response = supabase.table("users").select("user_id").eq("email", current_user_email).maybe_single().execute()
-    user_id = user_response.data.get("user_id")
+    user_id = await get_user_id_from_email(current_user_email)
 
     genres_to_upsert = [{"name": genre} for genre in input_genres if genre]
 
     if genres_to_upsert:
-        supabase.table("genres").upsert(
+        await supabase.table("genres").upsert(
             genres_to_upsert,
             on_conflict='name'
         ).execute()
 
     genre_name_to_id_map = {}
     if input_genres:
-        response_fetch_genres = supabase.table("genres").select("genre_id", "name").in_("name", input_genres).execute()
+        response_fetch_genres = await supabase.table("genres").select("genre_id", "name").in_("name", input_genres).execute()
         genre_name_to_id_map = {genre["name"]: genre["genre_id"] for genre in response_fetch_genres.data}
 
     user_genres_to_insert = []
@@ -220,16 +243,33 @@ async def genres_upload(input_genres: List[str], current_user_email: str):
             user_genres_to_insert.append({"user_id": user_id, "genre_id": genre_id})
 
     if user_genres_to_insert:
-        supabase.table("user_genres").upsert(
+        await supabase.table("user_genres").upsert(
             user_genres_to_insert,
         ).execute()
 
+        taste_index.add_items("genre", user_id, [row["genre_id"] for row in user_genres_to_insert])
 
-async def fetch_and_process_top_artists(spotify, current_user_email):
-    top_artists_data = spotify.current_user_top_artists(
-        limit=50,
-        time_range='medium_term'
-    )
+
+SNAPSHOT_PARTS = ("saved_tracks", "top_tracks", "top_artists")
+
+
+async def fetch_spotify_snapshot(spotify, parts=SNAPSHOT_PARTS, top_limit: int = 50,
+                                 time_range: str = "medium_term") -> SpotifySnapshot:
+    """
+    Fetch the user's saved tracks, top tracks and top artists once per sync;
+    every ingestion stage reads from the returned snapshot.
+    """
+    calls = {
+        "saved_tracks": lambda: spotify_call(spotify.current_user_saved_tracks, limit=top_limit),
+        "top_tracks": lambda: spotify_call(spotify.current_user_top_tracks, limit=top_limit, time_range=time_range),
+        "top_artists": lambda: spotify_call(spotify.current_user_top_artists, limit=top_limit, time_range=time_range),
+    }
+    results = await asyncio.gather(*(calls[part]() for part in parts))
+    return SpotifySnapshot(**{part: data or {} for part, data in zip(parts, results)})
+
+
+async def process_top_artists(snapshot: SpotifySnapshot, current_user_email):
+    top_artists_data = snapshot.top_artists
     parsed_artists = []
     if top_artists_data and 'items' in top_artists_data:
         for artist_item in top_artists_data['items']:
@@ -241,11 +281,8 @@ async def fetch_and_process_top_artists(spotify, current_user_email):
     await artists_upload(parsed_artists, current_user_email)
 
 
-async def fetch_and_process_top_tracks(spotify, current_user_email):
-    top_tracks_data = spotify.current_user_top_tracks(
-        limit=50,
-        time_range='medium_term'
-    )
+async def process_top_tracks(snapshot: SpotifySnapshot, current_user_email):
+    top_tracks_data = snapshot.top_tracks
 
     parsed_tracks = []
     if top_tracks_data and 'items' in top_tracks_data:
@@ -258,14 +295,11 @@ async def fetch_and_process_top_tracks(spotify, current_user_email):
     await tracks_upload(parsed_tracks, current_user_email)
 
 
-async def fetch_and_process_genres(spotify, current_user_email):
+async def process_genres(spotify, snapshot: SpotifySnapshot, current_user_email):
     all_genres = set()
     all_artist_ids = set()
-    top_limit = 50
-    time_range = "medium_term"
-
 
-    saved_tracks_data = spotify.current_user_saved_tracks(limit=top_limit)
+    saved_tracks_data = snapshot.saved_tracks
     if saved_tracks_data and 'items' in saved_tracks_data:
         for item in saved_tracks_data.get('items', []):
             track = item.get('track')
@@ -274,8 +308,7 @@ async def fetch_and_process_genres(spotify, current_user_email):
                     if artist and artist.get('id'):
                         all_artist_ids.add(artist['id'])
 
-
-    top_tracks_data = spotify.current_user_top_tracks(limit=top_limit, time_range=time_range)
+    top_tracks_data = snapshot.top_tracks
     if top_tracks_data and 'items' in top_tracks_data:
         for track in top_tracks_data.get('items', []):
             if track and track.get('artists'):
@@ -283,7 +316,7 @@ async def fetch_and_process_genres(spotify, current_user_email):
                     if artist and artist.get('id'):
                         all_artist_ids.add(artist['id'])
 
-    top_artists_data = spotify.current_user_top_artists(limit=top_limit, time_range=time_range)
+    top_artists_data = snapshot.top_artists
     if top_artists_data and 'items' in top_artists_data:
         for artist in top_artists_data.get('items', []):
             if artist:
@@ -294,16 +327,13 @@ async def fetch_and_process_genres(spotify, current_user_email):
                 if artist_genres:
                     all_genres.update(artist_genres)
 
+    if top_artists_data and 'items' in top_artists_data:
+        await artist_genre_cache.remember(top_artists_data['items'])
+
     if all_artist_ids:
-        artist_ids_list = list(all_artist_ids)
-        batch_size = 50
-        for i in range(0, len(artist_ids_list), batch_size):
-            batch_ids = artist_ids_list[i:i + batch_size]
-            artists_details = spotify.artists(batch_ids)
-            if artists_details and artists_details.get('artists'):
-                for artist in artists_details['artists']:
-                    if artist and artist.get('genres'):
-                        all_genres.update(artist['genres'])
+        genres_by_artist = await artist_genre_cache.get_genres(spotify, all_artist_ids)
+        for artist_genres in genres_by_artist.values():
+            all_genres.update(artist_genres)
 
     sorted_genres = sorted(list(all_genres))
     await genres_upload(sorted_genres, current_user_email)
@@ -311,43 +341,47 @@ async def fetch_and_process_genres(spotify, current_user_email):
     return sorted_genres
 
 
-async def find_matches(current_user_email: str):
-    user_response = supabase.table("users").select("user_id").eq("email", current_user_email).maybe_single().execute()
-    if not user_response.data:
-        raise HTTPException(status_code=404, detail="User not found")
+async def sync_spotify_library(spotify, current_user_email):
+    """Take one snapshot of the user's library and run every ingestion stage on it."""
+    snapshot = await fetch_spotify_snapshot(spotify)
+    await asyncio.gather(
+        process_top_artists(snapshot, current_user_email),
+        process_top_tracks(snapshot, current_user_email),
+        process_genres(spotify, snapshot, current_user_email)
+    )
+    return snapshot
 
-    current_user_id = user_response.data.get("user_id")
 
-    current_user_artists = supabase.table("user_artists").select("artist_id").eq("user_id", current_user_id).execute()
-    current_user_tracks = supabase.table("user_tracks").select("track_id").eq("user_id", current_user_id).execute()
-    current_user_genres = supabase.table("user_genres").select("genre_id").eq("user_id", current_user_id).execute()
+async def find_matches(current_user_email: str):
+    current_user_id = await get_user_id_from_email(current_user_email)
 
-    current_artist_ids = [item.get("artist_id") for item in current_user_artists.data]
-    current_track_ids = [item.get("track_id") for item in current_user_tracks.data]
-    current_genre_ids = [item.get("genre_id") for item in current_user_genres.data]
+    await taste_index.ensure_loaded()
+    if MATCH_CANDIDATES == "lsh":
+        scores = await asyncio.to_thread(lsh_index.score_all, current_user_id)
+        if random.random() < LSH_RECALL_SAMPLE_RATE:
+            exact_scores = await asyncio.to_thread(match_engine.score_all, current_user_id)
+            lsh_index.record_recall(
+                {user_id: score for user_id, score in scores.items() if score > 10},
+                {user_id: score for user_id, score in exact_scores.items() if score > 10}
+            )
+    else:
+        scores = await asyncio.to_thread(match_engine.score_all, current_user_id)
+    matched_scores = {user_id: score for user_id, score in scores.items() if score > 10}
+
+    users_info = await fetch_rows_in(
+        "users", "user_id, first_name, last_name, profile_picture_url", "user_id", sorted(matched_scores)
+    )
 
-    all_users = supabase.table("users").select("user_id").neq("user_id", current_user_id).execute()
     potential_matches = []
-
-    for other_user in all_users.data:
-        other_user_id = other_user.get("user_id")
-        match_score = await calculate_match_score(
-            current_user_id, other_user_id,
-            current_artist_ids, current_track_ids, current_genre_ids
-        )
-
-        if match_score > 10:
-            other_user_info = supabase.table("users").select(
-                "user_id", "first_name", "last_name", "profile_picture_url"
-            ).eq("user_id", other_user_id).maybe_single().execute()
-
-            potential_matches.append({
-                "user_id": other_user_id,
-                "first_name": other_user_info.data.get("first_name"),
-                "last_name": other_user_info.data.get("last_name"),
-                "profile_picture_url": other_user_info.data.get("profile_picture_url"),
-                "match_score": match_score
-            })
+    for other_user_info in users_info:
+        other_user_id = other_user_info.get("user_id")
+        potential_matches.append({
+            "user_id": other_user_id,
+            "first_name": other_user_info.get("first_name"),
+            "last_name": other_user_info.get("last_name"),
+            "profile_picture_url": other_user_info.get("profile_picture_url"),
+            "match_score": matched_scores[other_user_id]
+        })
 
     potential_matches.sort(key=lambda x: x["match_score"], reverse=True)
 
@@ -356,59 +390,127 @@ async def find_matches(current_user_email: str):
     return potential_matches
 
 
-async def calculate_match_score(current_user_id: int, other_user_id: int,
-                                current_artist_ids: list, current_track_ids: list, current_genre_ids: list) -> float:
-    other_user_artists = supabase.table("user_artists").select("artist_id").eq("user_id", other_user_id).execute()
-    other_user_tracks = supabase.table("user_tracks").select("track_id").eq("user_id", other_user_id).execute()
-    other_user_genres = supabase.table("user_genres").select("genre_id").eq("user_id", other_user_id).execute()
+async def find_top_matches(current_user_email: str, k: int = 5, min_score: float = 10):
+    """
+    The `k` best matches above `min_score`, same as the head of find_matches
+    but without scoring every candidate or storing the results.
+    """
+    current_user_id = await get_user_id_from_email(current_user_email)
+
+    await taste_index.ensure_loaded()
+    top = await asyncio.to_thread(match_engine.top_k, current_user_id, k, min_score)
 
-    other_artist_ids = [item.get("artist_id") for item in other_user_artists.data]
-    other_track_ids = [item.get("track_id") for item in other_user_tracks.data]
-    other_genre_ids = [item.get("genre_id") for item in other_user_genres.data]
+    users_info = await fetch_rows_in(
+        "users", "user_id, first_name, last_name, profile_picture_url", "user_id", [user_id for user_id, _ in top]
+    )
+    info_by_id = {info.get("user_id"): info for info in users_info}
+
+    top_matches = []
+    for other_user_id, score in top:
+        other_user_info = info_by_id.get(other_user_id)
+        if other_user_info is None:
+            continue
+        top_matches.append({
+            "user_id": other_user_id,
+            "first_name": other_user_info.get("first_name"),
+            "last_name": other_user_info.get("last_name"),
+            "profile_picture_url": other_user_info.get("profile_picture_url"),
+            "match_score": score
+        })
 
-    shared_artists = set(current_artist_ids).intersection(set(other_artist_ids))
-    shared_tracks = set(current_track_ids).intersection(set(other_track_ids))
-    shared_genres = set(current_genre_ids).intersection(set(other_genre_ids))
+    return top_matches
 
-    artist_match = len(shared_artists) / max(1, min(len(current_artist_ids), len(other_artist_ids)))
-    track_match = len(shared_tracks) / max(1, min(len(current_track_ids), len(other_track_ids)))
-    genre_match = len(shared_genres) / max(1, min(len(current_genre_ids), len(other_genre_ids)))
 
-    weights = {
-        "artist": 0.35,
-        "track": 0.25,
-        "genre": 0.40
+async def _existing_match_rows(user_id: int) -> dict:
+    rows = await fetch_paged(
+        lambda: supabase.table("matches")
+        .select("match_id, user1_id, user2_id, match_score")
+        .or_(f"user1_id.eq.{user_id},user2_id.eq.{user_id}"),
+        TABLE_KEYS["matches"]
+    )
+    match_cache.remember(rows)
+    return {
+        row["user2_id"] if row["user1_id"] == user_id else row["user1_id"]: row
+        for row in rows
     }
 
-    match_score = (
-                          artist_match * weights["artist"] +
-                          track_match * weights["track"] +
-                          genre_match * weights["genre"]
-                  ) * 100
 
-    return round(match_score, 2)
+async def has_stored_matches(user_id: int) -> bool:
+    response = await supabase.table("matches") \
+        .select("match_id") \
+        .or_(f"user1_id.eq.{user_id},user2_id.eq.{user_id}") \
+        .limit(1) \
+        .execute()
+    return bool(response.data)
+
+
+async def _write_match_changes(user_id: int, scores: dict, scope=None) -> dict:
+    """
+    Bring the user's rows in `matches` in line with `scores` (other user_id -> score).
+
+    Only pairs with users in `scope` are looked at (all of the user's rows and
+    scores when None). Rows keep their match_id; only new pairs are inserted,
+    only changed scores are upserted and pairs that dropped to 10 or below are
+    deleted.
+    """
+    existing = await _existing_match_rows(user_id)
+    others = scope if scope is not None else set(existing) | set(scores)
+
+    to_insert, to_upsert, to_delete = [], [], []
+    for other_id in others:
+        score = scores.get(other_id)
+        row = existing.get(other_id)
+        if score is not None and score > 10:
+            user1, user2 = sorted([user_id, other_id])
+            if row is None:
+                to_insert.append({"user1_id": user1, "user2_id": user2, "match_score": score})
+            elif float(row["match_score"]) != score:
+                to_upsert.append({"match_id": row["match_id"], "user1_id": user1, "user2_id": user2, "match_score": score})
+        elif row is not None:
+            to_delete.append(row["match_id"])
+
+    match_cache.invalidate(to_delete)
+    writes = []
+    if to_insert:
+        writes.append(supabase.table("matches").insert(to_insert).execute())
+    if to_upsert:
+        writes.append(supabase.table("matches").upsert(to_upsert, on_conflict="match_id").execute())
+    if to_delete:
+        writes.append(supabase.table("matches").delete().in_("match_id", to_delete).execute())
+    results = await asyncio.gather(*writes)
+    if to_insert:
+        # The new rows come back with their match_id, ready for the chat.
+        match_cache.remember(results[0].data or [])
+
+    return {"inserted": len(to_insert), "updated": len(to_upsert), "deleted": len(to_delete)}
 
 
 async def store_match_results(user_id: int, matches: list):
-    supabase.table("matches").delete().eq("user1_id", user_id).execute()
-    supabase.table("matches").delete().eq("user2_id", user_id).execute()
+    await _write_match_changes(user_id, {match["user_id"]: match["match_score"] for match in matches})
+    return True
 
-    match_records = []
-    timestamp = datetime.now(timezone.utc)
 
-    for match in matches:
-        user1, user2 = sorted([user_id, match["user_id"]])
+def current_taste_sets(user_id: int) -> dict:
+    """Copy of the user's artist, track and genre sets from the taste index (must be loaded)."""
+    return {kind: set(taste_index.items_of(kind, user_id)) for kind in TASTE_TABLES}
 
-        match_records.append({
-            "user1_id": user1,
-            "user2_id": user2,
-            "match_score": match["match_score"]
-        })
 
-    if match_records:
-        supabase.table("matches").insert(match_records).execute()
+async def update_matches_incremental(user_id: int, old_sets: dict) -> dict:
+    """
+    Re-score only the pairs a taste change can affect, after the index has
+    been updated with the user's new rows; `old_sets` are the user's sets from
+    before the change (see current_taste_sets).
+    """
+    await taste_index.ensure_loaded()
+    new_sets = current_taste_sets(user_id)
+    affected = affected_users(taste_index, user_id, old_sets, new_sets)
 
-    return True
+    scores = {
+        other_id: overlap_score(new_sets, current_taste_sets(other_id))
+        for other_id in affected
+    }
+    changes = await _write_match_changes(user_id, scores, scope=affected)
+    return {"rescored": len(affected), **changes}
 
 
 async def process_spotify_connection(spotify, current_user_email: str):
@@ -421,101 +523,87 @@ async def process_spotify_connection(spotify, current_user_email: str):
     }
 
 
-async def get_match_details(current_user_id: int, match_user_id: int, match_score: float, match_id: int):
-    try:
-        match_user = supabase.table("users") \
-            .select("user_id, first_name, last_name, profile_picture_url, birth_date, gender, bio, location") \
-            .eq("user_id", match_user_id) \
-            .maybe_single() \
-            .execute()
-
-        if not match_user.data:
-            return None
-
-        user_data = match_user.data
-
-        current_user_genres = supabase.table("user_genres") \
-            .select("genre_id") \
-            .eq("user_id", current_user_id) \
-            .execute()
-
-        match_user_genres = supabase.table("user_genres") \
-            .select("genre_id") \
-            .eq("user_id", match_user_id) \
-            .execute()
-
-        current_user_artists = supabase.table("user_artists") \
-            .select("artist_id") \
-            .eq("user_id", current_user_id) \
-            .execute()
-
-        match_user_artists = supabase.table("user_artists") \
-            .select("artist_id") \
-            .eq("user_id", match_user_id) \
-            .execute()
-
-        current_user_tracks = supabase.table("user_tracks") \
-            .select("track_id") \
-            .eq("user_id", current_user_id) \
-            .execute()
+def _calculate_age(birth_date_value):
+    if not birth_date_value:
+        return None
+    birth_date = datetime.strptime(birth_date_value, "%Y-%m-%d").date()
+    today = datetime.now().date()
+    return today.year - birth_date.year - ((today.month, today.day) < (birth_date.month, birth_date.day))
+
+
+async def _fetch_names(table: str, id_column: str, ids: set) -> dict:
+    if not ids:
+        return {}
+    rows = await fetch_rows_in(table, f"{id_column}, name", id_column, ids)
+    return {item.get(id_column): item.get("name") for item in rows}
+
+
+async def get_matches_details(current_user_id: int, matches: list) -> list:
+    """
+    Build the detailed view of many matches at once.
+
+    `matches` holds dicts with "match_id", "user_id" (the other user) and
+    "match_score". Users, taste profiles and the names of all shared genres,
+    artists and tracks are fetched in bulk, so the number of queries depends
+    on the batch size and not on the number of matches. Matches whose user no
+    longer exists are left out.
+    """
+    if not matches:
+        return []
+
+    match_user_ids = [match["user_id"] for match in matches]
+
+    users_rows, profiles = await asyncio.gather(
+        fetch_rows_in(
+            "users",
+            "user_id, first_name, last_name, profile_picture_url, birth_date, gender, bio, location",
+            "user_id",
+            match_user_ids
+        ),
+        load_taste_profiles([current_user_id] + match_user_ids)
+    )
+    users_by_id = {row.get("user_id"): row for row in users_rows}
+    current_profile = profiles[current_user_id]
 
-        match_user_tracks = supabase.table("user_tracks") \
-            .select("track_id") \
-            .eq("user_id", match_user_id) \
-            .execute()
+    shared_by_match = []
+    all_genre_ids, all_artist_ids, all_track_ids = set(), set(), set()
+    for match in matches:
+        match_profile = profiles[match["user_id"]]
+        shared = (
+            list(current_profile.genre_ids & match_profile.genre_ids),
+            list(current_profile.artist_ids & match_profile.artist_ids),
+            list(current_profile.track_ids & match_profile.track_ids)
+        )
+        all_genre_ids.update(shared[0])
+        all_artist_ids.update(shared[1])
+        all_track_ids.update(shared[2])
+        shared_by_match.append(shared)
+
+    genre_map, artist_map, track_map = await asyncio.gather(
+        _fetch_names("genres", "genre_id", all_genre_ids),
+        _fetch_names("artists", "artist_id", all_artist_ids),
+        _fetch_names("tracks", "track_id", all_track_ids)
+    )
 
-        current_genre_ids = [item.get("genre_id") for item in current_user_genres.data]
-        match_genre_ids = [item.get("genre_id") for item in match_user_genres.data]
-        shared_genre_ids = list(set(current_genre_ids).intersection(set(match_genre_ids)))
-
-        current_artist_ids = [item.get("artist_id") for item in current_user_artists.data]
-        match_artist_ids = [item.get("artist_id") for item in match_user_artists.data]
-        shared_artist_ids = list(set(current_artist_ids).intersection(set(match_artist_ids)))
-
-        current_track_ids = [item.get("track_id") for item in current_user_tracks.data]
-        match_track_ids = [item.get("track_id") for item in match_user_tracks.data]
-        shared_track_ids = list(set(current_track_ids).intersection(set(match_track_ids)))
-
-        shared_genres = []
-        if shared_genre_ids:
-            genres_data = supabase.table("genres") \
-                .select("genre_id, name") \
-                .in_("genre_id", shared_genre_ids) \
-                .execute()
-
-            genre_map = {item.get("genre_id"): item.get("name") for item in genres_data.data}
-            shared_genres = [genre_map.get(genre_id) for genre_id in shared_genre_ids if genre_id in genre_map]
-
-        shared_artists = []
-        if shared_artist_ids:
-            artists_data = supabase.table("artists") \
-                .select("artist_id, name") \
-                .in_("artist_id", shared_artist_ids) \
-                .execute()
-
-            artist_map = {item.get("artist_id"): item.get("name") for item in artists_data.data}
-            shared_artists = [artist_map.get(artist_id) for artist_id in shared_artist_ids if artist_id in artist_map]
-
-        shared_tracks = []
-        if shared_track_ids:
-            tracks_data = supabase.table("tracks") \
-                .select("track_id, name") \
-                .in_("track_id", shared_track_ids) \
-                .execute()
-
-            track_map = {item.get("track_id"): item.get("name") for item in tracks_data.data}
-            shared_tracks = [track_map.get(track_id) for track_id in shared_track_ids if track_id in track_map]
-
-        age = None
-        if user_data.get("birth_date"):
-            from datetime import datetime
-            birth_date = datetime.strptime(user_data.get("birth_date"), "%Y-%m-%d").date()
-            today = datetime.now().date()
-            age = today.year - birth_date.year - ((today.month, today.day) < (birth_date.month, birth_date.day))
-
-        return {
-            "match_id": match_id,
-            "user_id": match_user_id,
+    detailed_matches = []
+    for match, (shared_genre_ids, shared_artist_ids, shared_track_ids) in zip(matches, shared_by_match):
+        user_data = users_by_id.get(match["user_id"])
+        if not user_data:
+            continue
+
+        shared_genres = [genre_map.get(genre_id) for genre_id in shared_genre_ids if genre_id in genre_map]
+        shared_artists = [artist_map.get(artist_id) for artist_id in shared_artist_ids if artist_id in artist_map]
+        shared_tracks = [track_map.get(track_id) for track_id in shared_track_ids if track_id in track_map]
+
+        try:
+            age = _calculate_age(user_data.get("birth_date"))
+        except ValueError as e:
+            logger.warning(f"Error parsing birth date of user {match['user_id']}: {str(e)}")
+            age = None
+
+        detailed_matches.append({
+            "match_id": match["match_id"],
+            "user_id": match["user_id"],
             "first_name": user_data.get("first_name"),
             "last_name": user_data.get("last_name"),
             "profile_picture_url": user_data.get("profile_picture_url"),
@@ -524,7 +612,7 @@ async def get_match_details(current_user_id: int, match_user_id: int, match_scor
             "gender": user_data.get("gender"),
             "bio": user_data.get("bio"),
             "location": user_data.get("location"),
-            "match_score": match_score,
+            "match_score": match["match_score"],
             "shared_music": {
                 "genres": shared_genres,
                 "artists": shared_artists,
@@ -533,34 +621,76 @@ async def get_match_details(current_user_id: int, match_user_id: int, match_scor
                 "artist_count": len(shared_artists),
                 "track_count": len(shared_tracks)
             }
-        }
+        })
+
+    return detailed_matches
+
+
+async def get_match_details(current_user_id: int, match_user_id: int, match_score: float, match_id: int):
+    try:
+        details = await get_matches_details(current_user_id, [{
+            "match_id": match_id,
+            "user_id": match_user_id,
+            "match_score": match_score
+        }])
+        return details[0] if details else None
 
     except Exception as e:
-        print(f"Error getting match details: {str(e)}")
+        logger.error(f"Error getting match details: {str(e)}")
         return None
 
 async def get_user_id_from_email(email: str) -> int:
-    user_response =  supabase.table("users").select("user_id").eq("email", email).maybe_single().execute()
-    if not user_response.data:
+    user_id = identity_cache.user_id_for(email)
+    if user_id is not None:
+        return user_id
+
+    user_response =  await supabase.table("users").select("user_id").eq("email", email).maybe_single().execute()
+    if not user_response or not user_response.data:
         raise HTTPException(status_code=404, detail="User not found")
-    return user_response.data["user_id"]
+
+    user_id = user_response.data["user_id"]
+    identity_cache.remember(email, user_id)
+    return user_id
 
 
 async def get_user_email_from_id(user_id: int) -> str:
-    user_response = supabase.table("users").select("email").eq("user_id", user_id).maybe_single().execute()
-    if not user_response.data:
+    email = identity_cache.email_for(user_id)
+    if email is not None:
+        return email
+
+    user_response = await supabase.table("users").select("email").eq("user_id", user_id).maybe_single().execute()
+    if not user_response or not user_response.data:
         raise ValueError("User not found")
-    return user_response.data["email"]
+
+    email = user_response.data["email"]
+    identity_cache.remember(email, user_id)
+    return email
+
+
+# Event telling the other workers to drop a conversation from their message cache.
+MESSAGE_CACHE_INVALIDATE = "message_cache.invalidate"
+broker.subscribe(MESSAGE_CACHE_INVALIDATE, lambda data: message_cache.invalidate(data["match_id"]))
 
 
 async def get_match_by_id(match_id: int):
-    match_response =  supabase.table("matches").select("user1_id, user2_id").eq("match_id",
+    cached = match_cache.get(match_id)
+    if cached is not None:
+        return cached
+
+    match_response =  await supabase.table("matches").select("match_id, user1_id, user2_id").eq("match_id",
                                                                                      match_id).maybe_single().execute()
-    if not match_response.data:
+    # maybe_single() gives no response at all when the match does not exist.
+    if not match_response or not match_response.data:
         return None
+    match_cache.remember([match_response.data])
     return match_response.data
 
 
+async def preload_user_matches(user_id: int):
+    """Fill the match cache with all of the user's matches, e.g. when their chat socket connects."""
+    await _existing_match_rows(user_id)
+
+
 async def create_chat_message_service(message: MessageCreate, sender_email: str) -> Message:
     sender_id = await get_user_id_from_email(sender_email)
 
@@ -579,12 +709,15 @@ async def create_chat_message_service(message: MessageCreate, sender_email: str)
     }
 
     try:
-        response =  supabase.table("messages").insert(new_message_data).execute()
-        if not response.data:
-            raise HTTPException(status_code=500, detail="Could not send message")
-
-        created_message = response.data[0]
-        return Message(
+        if MESSAGE_BATCHING:
+            created_message = await message_batcher.insert(new_message_data)
+        else:
+            response =  await supabase.table("messages").insert(new_message_data).execute()
+            if not response.data:
+                raise HTTPException(status_code=500, detail="Could not send message")
+            created_message = response.data[0]
+
+        new_message = Message(
             message_id=created_message['message_id'],
             match_id=created_message['match_id'],
             sender_id=created_message['sender_id'],
@@ -593,12 +726,41 @@ async def create_chat_message_service(message: MessageCreate, sender_email: str)
             read_at=datetime.fromisoformat(created_message['read_at'].replace('Z', '+00:00')) if created_message.get(
                 'read_at') else None
         )
+        message_cache.append(new_message)
+        broker.broadcast(MESSAGE_CACHE_INVALIDATE, {"match_id": message.match_id})
+        recipient_id = match_data['user2_id'] if match_data['user1_id'] == sender_id else match_data['user1_id']
+        unread_counters.increment(recipient_id, message.match_id)
+        return new_message
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
 
-async def get_chat_messages_service(match_id: int, current_user_email: str, page: int = 1, page_size: int = 20) -> List[
-    Message]:
+def message_cursor(message: Message) -> str:
+    """Opaque keyset cursor for a message: its (sent_at, message_id)."""
+    raw = f"{message.sent_at.isoformat()}|{message.message_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _parse_message_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        sent_at, message_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(sent_at).isoformat(), int(message_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def get_chat_messages_service(match_id: int, current_user_email: str, page: int = 1, page_size: int = 20,
+                                    before: Optional[str] = None, after: Optional[str] = None) -> List[Message]:
+    """
+    One page of a conversation, newest message first.
+
+    With `before` (or `after`) the page holds the messages right before
+    (after) that cursor in (sent_at, message_id) order, which costs the same
+    however far back the page is and does not shift when new messages arrive.
+    Without a cursor `page` selects an offset page as before; page 1 is
+    served from the message cache when it holds the conversation.
+    """
     current_user_id = await get_user_id_from_email(current_user_email)
 
     match_data = await get_match_by_id(match_id)
@@ -608,21 +770,52 @@ async def get_chat_messages_service(match_id: int, current_user_email: str, page
     if current_user_id not in [match_data['user1_id'], match_data['user2_id']]:
         raise HTTPException(status_code=403, detail="User is not part of this match")
 
-    offset = (page - 1) * page_size
-    try:
-        response =  supabase.table("messages") \
-            .select("*") \
-            .eq("match_id", match_id) \
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+
+    query = supabase.table("messages").select("*").eq("match_id", match_id)
+    if before:
+        sent_at, message_id = _parse_message_cursor(before)
+        query = query \
+            .or_(f'sent_at.lt."{sent_at}",and(sent_at.eq."{sent_at}",message_id.lt.{message_id})') \
+            .order("sent_at", desc=True) \
+            .order("message_id", desc=True) \
+            .limit(page_size)
+    elif after:
+        sent_at, message_id = _parse_message_cursor(after)
+        query = query \
+            .or_(f'sent_at.gt."{sent_at}",and(sent_at.eq."{sent_at}",message_id.gt.{message_id})') \
+            .order("sent_at") \
+            .order("message_id") \
+            .limit(page_size)
+    elif page == 1:
+        cached = message_cache.first_page(match_id, page_size)
+        if cached is not None:
+            return cached
+        query = query \
             .order("sent_at", desc=True) \
+            .order("message_id", desc=True) \
+            .limit(max(page_size, MESSAGE_CACHE_SIZE))
+    else:
+        query = query \
+            .order("sent_at", desc=True) \
+            .order("message_id", desc=True) \
             .limit(page_size) \
-            .offset(offset) \
-            .execute()
+            .offset((page - 1) * page_size)
+    cache_version = message_cache.version(match_id)
+
+    try:
+        response = await query.execute()
+        first_page = not before and not after and page == 1
 
         if not response.data:
+            if first_page:
+                message_cache.load(match_id, [], cache_version)
             return []
 
+        rows = reversed(response.data) if after else response.data
         messages = []
-        for msg_data in response.data:
+        for msg_data in rows:
             messages.append(Message(
                 message_id=msg_data['message_id'],
                 match_id=msg_data['match_id'],
@@ -632,6 +825,9 @@ async def get_chat_messages_service(match_id: int, current_user_email: str, page
                 read_at=datetime.fromisoformat(msg_data['read_at'].replace('Z', '+00:00')) if msg_data.get(
                     'read_at') else None
             ))
+        if first_page:
+            message_cache.load(match_id, messages, cache_version)
+            messages = messages[:page_size]
         return messages
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
@@ -647,76 +843,161 @@ async def mark_messages_as_read_service(match_id: int, reader_email: str):
     if reader_id not in [match_data['user1_id'], match_data['user2_id']]:
         raise HTTPException(status_code=403, detail="User is not part of this match")
 
-    try:
-        response =  supabase.table("messages") \
-            .update({"read_at": datetime.utcnow().isoformat()}) \
-            .eq("match_id", match_id) \
-            .neq("sender_id", reader_id) \
-            .is_("read_at", None) \
-            .execute()
+    other_user_id = match_data['user2_id'] if match_data['user1_id'] == reader_id else match_data['user1_id']
+    return await read_receipts.mark_read(match_id, reader_id, other_user_id)
+
+
+@read_receipts.on_flush
+async def _write_read_receipt(match_id: int, reader_id: int, other_user_id: int, read_at: datetime) -> int:
+    """
+    Mark the other user's messages sent up to `read_at` as read. Errors go to
+    the read-receipt coalescer, which retries the receipt later.
+    """
+    response =  await supabase.table("messages") \
+        .update({"read_at": read_at.isoformat()}) \
+        .eq("match_id", match_id) \
+        .neq("sender_id", reader_id) \
+        .is_("read_at", None) \
+        .lte("sent_at", read_at.isoformat()) \
+        .execute()
+    updated_count = len(response.data) if response.data else 0
+    message_cache.mark_read(match_id, reader_id, read_at)
+    broker.broadcast(MESSAGE_CACHE_INVALIDATE, {"match_id": match_id})
+    # Messages sent after `read_at` stay unread.
+    unread_counters.decrement(reader_id, match_id, updated_count)
+    return updated_count
 
-        return {"status": "success", "updated_count": len(
-            response.data) if response.data else "unknown (check Supabase logs for actual count)"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
+def _parse_timestamp(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
 
-async def get_user_conversations_service(current_user_email: str):
-    current_user_id = await get_user_id_from_email(current_user_email)
 
-    query1 = supabase.table("matches").select("match_id, user1_id, user2_id").eq("user1_id", current_user_id)
-    query2 = supabase.table("matches").select("match_id, user1_id, user2_id").eq("user2_id", current_user_id)
+# Set to False once PostgREST reports the function as missing, i.e. when
+# sql/get_conversation_summaries.sql has not been applied to the database.
+conversations_rpc_available = True
+# PostgREST's error code for a function that is not in its schema cache.
+MISSING_FUNCTION_CODE = "PGRST202"
+
 
-    response1 = query1.execute()
-    response2 = query2.execute()
+async def _conversation_rows_from_rpc(current_user_id: int):
+    global conversations_rpc_available
+    if not conversations_rpc_available:
+        return None
+    try:
+        response = await supabase.rpc("get_conversation_summaries", {"p_user_id": current_user_id}).execute()
+        return response.data or []
+    except Exception as e:
+        if getattr(e, "code", None) == MISSING_FUNCTION_CODE:
+            logger.warning(f"get_conversation_summaries RPC missing, using bulk queries: {e}")
+            conversations_rpc_available = False
+        else:
+            # Transient errors only skip the RPC for this request.
+            logger.warning(f"get_conversation_summaries RPC failed, using bulk queries: {e}")
+        return None
 
-    all_matches_data = []
-    if response1.data:
-        all_matches_data.extend(response1.data)
-    if response2.data:
-        all_matches_data.extend(response2.data)
 
-    unique_matches = {m['match_id']: m for m in all_matches_data}.values()
+async def _conversation_rows_from_bulk(current_user_id: int):
+    matches = await fetch_paged(
+        lambda: supabase.table("matches")
+        .select("match_id, user1_id, user2_id")
+        .or_(f"user1_id.eq.{current_user_id},user2_id.eq.{current_user_id}"),
+        TABLE_KEYS["matches"]
+    )
 
-    conversations_summary = []
-    for match_info in unique_matches:
-        other_user_id = match_info['user2_id'] if match_info['user1_id'] == current_user_id else match_info['user1_id']
+    unique_matches = {m['match_id']: m for m in matches}
+    other_user_ids = {
+        match_id: m['user2_id'] if m['user1_id'] == current_user_id else m['user1_id']
+        for match_id, m in unique_matches.items()
+    }
+    # The latest_messages view (sql/latest_messages.sql) holds one row per match.
+    users_rows, last_messages = await asyncio.gather(
+        fetch_rows_in("users", "user_id, first_name, last_name, profile_picture_url",
+                      "user_id", other_user_ids.values()),
+        fetch_rows_in("latest_messages", "match_id, message_text, sent_at, sender_id",
+                      "match_id", unique_matches)
+    )
+    users = {row['user_id']: row for row in users_rows}
+    last_by_match = {row['match_id']: row for row in last_messages}
+
+    rows = []
+    for match_id, other_user_id in other_user_ids.items():
+        user = users.get(other_user_id)
+        last_message = last_by_match.get(match_id)
+        rows.append({
+            "match_id": match_id,
+            "other_user_id": user['user_id'] if user else None,
+            "first_name": user.get('first_name') if user else None,
+            "last_name": user.get('last_name') if user else None,
+            "profile_picture_url": user.get('profile_picture_url') if user else None,
+            "last_message_text": last_message['message_text'] if last_message else None,
+            "last_message_sent_at": last_message['sent_at'] if last_message else None,
+            "last_message_sender_id": last_message['sender_id'] if last_message else None
+        })
+    return rows
 
-        other_user_response = supabase.table("users").select(
-            "user_id, first_name, last_name, profile_picture_url"
-        ).eq("user_id", other_user_id).maybe_single().execute()
 
+async def get_user_conversations_service(current_user_email: str):
+    """
+    List the user's conversations with the other user, the last message and
+    the unread count, most recently active first. Unread counts come from
+    the in-memory unread counters.
+
+    Uses the get_conversation_summaries RPC when it exists and falls back to
+    bulk queries otherwise: the matches, users and last messages (from the
+    latest_messages view) in batches, so the number of queries does not grow
+    with the number of conversations nor the cost with the length of the
+    chat histories.
+    """
+    current_user_id = await get_user_id_from_email(current_user_email)
+
+    rows, unread_counts = await asyncio.gather(
+        _conversation_rows_from_rpc(current_user_id),
+        unread_counters.counts_for(current_user_id)
+    )
+    if rows is None:
+        rows = await _conversation_rows_from_bulk(current_user_id)
+
+    conversations_summary = []
+    for row in rows:
         other_user_details = {}
-        if other_user_response and other_user_response.data:
+        if row.get('other_user_id') is not None:
             other_user_details = {
-                "user_id": other_user_response.data['user_id'],
-                "name": f"{other_user_response.data.get('first_name', '')} {other_user_response.data.get('last_name', '')}".strip(),
-                "profile_picture_url": other_user_response.data.get('profile_picture_url')
+                "user_id": row['other_user_id'],
+                "name": f"{row.get('first_name') or ''} {row.get('last_name') or ''}".strip(),
+                "profile_picture_url": row.get('profile_picture_url')
             }
 
         last_message_summary = None
-        last_message_response = supabase.table("messages") \
-            .select("message_text, sent_at, sender_id") \
-            .eq("match_id", match_info['match_id']) \
-            .order("sent_at", desc=True) \
-            .limit(1) \
-            .maybe_single() \
-            .execute()
-
-        if last_message_response and last_message_response.data:
+        if row.get('last_message_sent_at'):
             try:
                 last_message_summary = {
-                    "text": last_message_response.data['message_text'],
-                    "sent_at": datetime.fromisoformat(last_message_response.data['sent_at'].replace('Z', '+00:00')),
-                    "is_sender_current_user": last_message_response.data['sender_id'] == current_user_id
+                    "text": row['last_message_text'],
+                    "sent_at": _parse_timestamp(row['last_message_sent_at']),
+                    "is_sender_current_user": row['last_message_sender_id'] == current_user_id
                 }
             except Exception as e:
-                print(f"Error parsing last message: {e}")
+                logger.warning(f"Error parsing last message: {e}")
 
         conversations_summary.append({
-            "match_id": match_info['match_id'],
+            "match_id": row['match_id'],
             "other_user": other_user_details,
-            "last_message": last_message_summary
+            "last_message": last_message_summary,
+            "unread_count": unread_counts.get(row['match_id'], 0)
         })
 
+    conversations_summary.sort(
+        key=lambda c: c["last_message"]["sent_at"] if c["last_message"] else datetime.min.replace(tzinfo=timezone.utc),
+        reverse=True
+    )
     return conversations_summary
+
+
+async def get_unread_counts_service(current_user_email: str):
+    """Unread messages of the user in total and per match, for app badges."""
+    current_user_id = await get_user_id_from_email(current_user_email)
+    counts = await unread_counters.counts_for(current_user_id)
+    return {
+        "total": sum(counts.values()),
+        "matches": counts
+    }
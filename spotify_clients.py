@@ -0,0 +1,70 @@
+import os
+from typing import Callable
+
+import requests
+import spotipy
+from requests.adapters import HTTPAdapter
+from spotipy.oauth2 import SpotifyOAuth
+
+from cache import TTLCache
+from spotify_executor import SPOTIFY_MAX_WORKERS
+
+SPOTIFY_CLIENT_POOL_SIZE = int(os.getenv("SPOTIFY_CLIENT_POOL_SIZE", "1000"))
+SPOTIFY_CLIENT_IDLE_SECONDS = float(os.getenv("SPOTIFY_CLIENT_IDLE_SECONDS", "900"))
+
+
+def _build_http_session() -> requests.Session:
+    """One keep-alive connection pool to Spotify, shared by every client."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(SPOTIFY_MAX_WORKERS, 10))
+    session.mount("https://", adapter)
+    return session
+
+
+http_session = _build_http_session()
+
+
+class SharedSessionSpotify(spotipy.Spotify):
+    """spotipy.Spotify that leaves its requests session open when collected."""
+
+    def __del__(self):
+        # spotipy closes the session here, which would tear down the
+        # connection pool of every other client sharing `http_session`.
+        pass
+
+
+class SharedSessionSpotifyOAuth(SpotifyOAuth):
+    """SpotifyOAuth that leaves its requests session open when collected."""
+
+    def __del__(self):
+        pass
+
+
+class SpotifyClientPool:
+    """
+    Per-user spotipy clients, reused across requests.
+
+    Clients are evicted least recently used first and after being idle for
+    `idle_seconds`. They hold no token themselves (that lives in the token
+    store), so dropping one is always safe.
+    """
+
+    def __init__(self, max_size: int, idle_seconds: float):
+        self.clients = TTLCache(max_size, idle_seconds)
+
+    def get(self, user_id: int, factory: Callable[[], spotipy.Spotify]) -> spotipy.Spotify:
+        client = self.clients.get(user_id)
+        if client is None:
+            client = factory()
+        # Setting again restarts the idle timer.
+        self.clients.set(user_id, client)
+        return client
+
+    def discard(self, user_id: int):
+        self.clients.pop(user_id)
+
+    def stats(self) -> dict:
+        return self.clients.stats()
+
+
+spotify_client_pool = SpotifyClientPool(SPOTIFY_CLIENT_POOL_SIZE, SPOTIFY_CLIENT_IDLE_SECONDS)
@@ -0,0 +1,17 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+# spotipy is synchronous; its calls run on this pool so they neither block
+# the event loop nor open an unbounded number of requests to Spotify.
+SPOTIFY_MAX_WORKERS = int(os.getenv("SPOTIFY_MAX_WORKERS", "8"))
+
+_executor = ThreadPoolExecutor(max_workers=SPOTIFY_MAX_WORKERS, thread_name_prefix="spotify")
+
+
+async def spotify_call(func: Callable, *args, **kwargs):
+    """Await a blocking spotipy call, e.g. `await spotify_call(spotify.artists, ids)`."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
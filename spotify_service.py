@@ -4,7 +4,14 @@ from datetime import datetime, timezone
 import os
 from dotenv import load_dotenv
 from fastapi import HTTPException
-from supabase_client import get_supabase_client
+from db import get_database
+from services import get_user_id_from_email, sync_spotify_library, find_matches, \
+    current_taste_sets, update_matches_incremental, has_stored_matches
+from taste_index import taste_index
+from jobs import job_queue
+from spotify_executor import spotify_call
+from token_store import token_store, TokenStoreCacheHandler
+from spotify_clients import spotify_client_pool, http_session, SharedSessionSpotify, SharedSessionSpotifyOAuth
 import json
 
 load_dotenv()
@@ -18,32 +25,29 @@ spotify_connections = {}
 
 load_dotenv()
 SUPABASE_STORAGE_URL = os.getenv("SUPABASE_STORAGE_URL")
-supabase = get_supabase_client()
+supabase = get_database()
 
 
-async def get_spotify_client(email: str) -> spotipy.Spotify:
-    try:
-        cache_path = f".cache-{email}"
+def create_auth_manager(user_id: int) -> SpotifyOAuth:
+    return SharedSessionSpotifyOAuth(
+        client_id=SPOTIFY_CLIENT_ID,
+        client_secret=SPOTIFY_CLIENT_SECRET,
+        redirect_uri=SPOTIFY_REDIRECT_URI,
+        scope="user-library-read user-read-recently-played user-top-read user-read-currently-playing",
+        cache_handler=TokenStoreCacheHandler(token_store, user_id),
+        requests_session=http_session
+    )
 
-        auth_manager = SpotifyOAuth(
-            client_id=SPOTIFY_CLIENT_ID,
-            client_secret=SPOTIFY_CLIENT_SECRET,
-            redirect_uri=SPOTIFY_REDIRECT_URI,
-            scope="user-library-read user-read-recently-played user-top-read user-read-currently-playing",
-            cache_path=cache_path
-        )
 
-        user_response = supabase.table("users").select("user_id").eq("email",
-                                                                     email).maybe_single().execute()
-        user_id = user_response.data.get("user_id")
-
-        response = supabase.table("spotify_accounts").select("token_info").eq("user_id", user_id).execute()
+async def get_spotify_client(email: str) -> spotipy.Spotify:
+    try:
+        user_id = await get_user_id_from_email(email)
+        await token_store.preload(user_id)
 
-        if response.data and len(response.data) > 0 and response.data[0]["token_info"]:
-            token_info = json.loads(response.data[0]["token_info"])
-            auth_manager.cache_handler.save_token_to_cache(token_info)
+        def create_client():
+            return SharedSessionSpotify(auth_manager=create_auth_manager(user_id), requests_session=http_session)
 
-        return spotipy.Spotify(auth_manager=auth_manager)
+        return spotify_client_pool.get(user_id, create_client)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -57,14 +61,13 @@ async def save_spotify_connection(email: str, spotify_client: spotipy.Spotify):
             raise Exception("No token information available")
 
         # Get the user information
-        spotify_user = spotify_client.me()
+        spotify_user = await spotify_call(spotify_client.me)
 
         token_info_json = json.dumps(token_info)
 
         print(token_info_json)
 
-        user_response = supabase.table("users").select("user_id").eq("email", email).maybe_single().execute()
-        user_id = user_response.data.get("user_id")
+        user_id = await get_user_id_from_email(email)
 
         connection_data = {
             "user_id": user_id,
@@ -75,11 +78,14 @@ async def save_spotify_connection(email: str, spotify_client: spotipy.Spotify):
             "connected_at": datetime.now(timezone.utc).isoformat()
         }
 
-        response = supabase.table("spotify_accounts").upsert(connection_data).execute()
+        response = await supabase.table("spotify_accounts").upsert(connection_data).execute()
 
         if hasattr(response, 'error') and response.error:
             raise Exception(f"Supabase error: {response.error.message}")
 
+        # The row now holds this token, no need to write it again.
+        token_store.save(user_id, token_info, persist=False)
+
         return connection_data
 
     except Exception as e:
@@ -91,10 +97,9 @@ async def save_spotify_connection(email: str, spotify_client: spotipy.Spotify):
 
 async def get_user_spotify_data(email: str) -> dict:
     try:
-        user_response = supabase.table("users").select("user_id").eq("email", email).maybe_single().execute()
-        user_id = user_response.data.get("user_id")
+        user_id = await get_user_id_from_email(email)
 
-        response = supabase.table("spotify_accounts").select("*").eq("user_id", user_id).execute()
+        response = await supabase.table("spotify_accounts").select("*").eq("user_id", user_id).execute()
 
         if response.data and len(response.data) > 0:
             # Parse the stored token info JSON
@@ -109,20 +114,40 @@ async def get_user_spotify_data(email: str) -> dict:
 
 
 async def refresh_spotify_token(email: str):
+    """
+    Spotify client for the user. Expired tokens are refreshed by spotipy on
+    the next API call and written back through the token store only then.
+    """
     try:
-        user_response = supabase.table("users").select("user_id").eq("email", email).maybe_single().execute()
-        user_id = user_response.data.get("user_id")
+        return await get_spotify_client(email)
 
-        spotify_client = await get_spotify_client(email)
-        token_info = spotify_client.auth_manager.cache_handler.get_cached_token()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to refresh Spotify token: {str(e)}")
 
-        if token_info:
-            supabase.table("spotify_accounts").update({
-                "token_info": json.dumps(token_info),
-                "expires_at": datetime.fromtimestamp(token_info["expires_at"], tz=timezone.utc).isoformat()
-            }).eq("user_id", user_id).execute()
 
-        return spotify_client
+@job_queue.handler("ingest_and_match")
+async def ingest_and_match_job(job, progress):
+    """Sync the user's Spotify library and bring their matches up to date, after /callback."""
+    email = job.payload["email"]
+    spotify = await refresh_spotify_token(email)
+    user_id = await get_user_id_from_email(email)
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to refresh Spotify token: {str(e)}")
+    await taste_index.ensure_loaded()
+    old_sets = current_taste_sets(user_id)
+
+    await progress("syncing spotify library")
+    await sync_spotify_library(spotify, email)
+
+    # Without stored matches (a first sync, even if the /spotify endpoints already
+    # uploaded part of the library) every pair is scored; otherwise only what changed
+    if await has_stored_matches(user_id):
+        await progress("updating matches")
+        return await update_matches_incremental(user_id, old_sets)
+
+    await progress("finding matches")
+    matches_result = await find_matches(email)
+
+    return {
+        "matches_found": len(matches_result),
+        "top_matches": matches_result[:5]
+    }
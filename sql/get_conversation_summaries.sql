@@ -0,0 +1,44 @@
+-- Conversation list for one user: the other participant and the last message
+-- per match, in a single round trip. Unread counts come from the service's
+-- in-memory counters.
+-- Used by services.get_user_conversations_service; falls back to bulk queries
+-- when this function is missing.
+-- The return type changed (unread_count was dropped), which create or replace
+-- cannot do.
+drop function if exists get_conversation_summaries(bigint);
+
+create function get_conversation_summaries(p_user_id bigint)
+returns table (
+    match_id bigint,
+    other_user_id bigint,
+    first_name text,
+    last_name text,
+    profile_picture_url text,
+    last_message_text text,
+    last_message_sent_at timestamptz,
+    last_message_sender_id bigint
+)
+language sql
+stable
+as $$
+    select
+        m.match_id,
+        u.user_id,
+        u.first_name,
+        u.last_name,
+        u.profile_picture_url,
+        lm.message_text,
+        lm.sent_at,
+        lm.sender_id
+    from matches m
+    left join users u
+        on u.user_id = case when m.user1_id = p_user_id then m.user2_id else m.user1_id end
+    left join lateral (
+        select message_text, sent_at, sender_id
+        from messages
+        where messages.match_id = m.match_id
+        order by sent_at desc, message_id desc
+        limit 1
+    ) lm on true
+    where m.user1_id = p_user_id or m.user2_id = p_user_id;
+$$;
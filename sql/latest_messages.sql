@@ -0,0 +1,9 @@
+-- The newest message of every match, for the bulk fallback of
+-- services.get_user_conversations_service, which reads it with
+-- match_id=in.(...) in batches. The filter on the distinct on column is
+-- pushed into the view, so every match costs one probe of
+-- messages_match_sent_at_message_id_idx (sql/messages_keyset_index.sql).
+create or replace view latest_messages as
+    select distinct on (match_id) match_id, message_id, message_text, sent_at, sender_id
+    from messages
+    order by match_id, sent_at desc, message_id desc;
@@ -0,0 +1,4 @@
+-- Index behind the keyset pagination of services.get_chat_messages_service:
+-- every page is a range scan from the cursor, however old it is.
+create index if not exists messages_match_sent_at_message_id_idx
+    on messages (match_id, sent_at desc, message_id desc);
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterable, Optional, Set
+
+from db import get_database
+from bulk_loader import fetch_paged, TABLE_KEYS
+
+supabase = get_database()
+
+# kind -> (link table, item column)
+TASTE_TABLES = {
+    "artist": ("user_artists", "artist_id"),
+    "track": ("user_tracks", "track_id"),
+    "genre": ("user_genres", "genre_id"),
+}
+
+# Opt-in: re-read the link tables this often, in the background, to see rows
+# written by other workers and by worker.py. Every reload reads all three
+# tables and rebuilds the match engine, so keep it long on large databases;
+# 0 (the default) loads the index once.
+TASTE_INDEX_RELOAD_SECONDS = float(os.getenv("TASTE_INDEX_RELOAD_SECONDS", "0"))
+
+
+def _add_to(postings: Dict[str, Dict], user_items: Dict[str, Dict], kind: str, user_id: int, item_id):
+    if user_id is None or item_id is None:
+        return
+    postings[kind].setdefault(item_id, set()).add(user_id)
+    user_items[kind].setdefault(user_id, set()).add(item_id)
+
+
+class TasteIndex:
+    """
+    Process-wide inverted index of everybody's music taste.
+
+    For every kind ("artist", "track", "genre") it keeps posting lists
+    item_id -> {user_id, ...} plus the forward sets user_id -> {item_id, ...},
+    so matching only has to look at users sharing at least one item.
+    The index is built from the link tables by awaiting `ensure_loaded()`
+    before first use and kept up to date by the upload functions through
+    `add_items`. With `reload_seconds` set, `ensure_loaded()` also starts a
+    reload in the background once the index is older than that; the old data
+    is served until the new one replaces it, and `generation` counts these
+    full loads. Structures derived from the index (see `on_load`) are built
+    from a new load before it goes live and replace the old ones with it.
+    """
+
+    def __init__(self, reload_seconds: float = TASTE_INDEX_RELOAD_SECONDS):
+        self.reload_seconds = reload_seconds
+        self.lock = threading.RLock()
+        self._load_lock = asyncio.Lock()
+        self._loaded = False
+        self._next_reload = 0.0
+        self._reload_task: Optional[asyncio.Task] = None
+        # add_items calls seen while a load is running, replayed onto its result
+        self._journal: Optional[list] = None
+        self.postings: Dict[str, Dict[object, Set[int]]] = {kind: {} for kind in TASTE_TABLES}
+        self.user_items: Dict[str, Dict[int, Set[object]]] = {kind: {} for kind in TASTE_TABLES}
+        self.version = 0
+        self.generation = 0
+        self.reloads = 0
+        self._listeners = []
+        self._preparers = []
+
+    def subscribe(self, listener):
+        """Call `listener(kind, user_id)` whenever a user's items change."""
+        self._listeners.append(listener)
+
+    def on_load(self, prepare):
+        """
+        Call `prepare(user_items)` in a worker thread with every new load
+        before it goes live. It returns None or `install(generation, changed)`,
+        which is called under the index lock as the load replaces the old
+        data; `changed` are the users whose items changed during the load.
+        """
+        self._preparers.append(prepare)
+
+    def _start_journal(self):
+        with self.lock:
+            if self._journal is None:
+                self._journal = []
+
+    async def ensure_loaded(self):
+        if self._loaded:
+            if self.reload_seconds and self._reload_task is None and time.monotonic() >= self._next_reload:
+                self._start_journal()
+                self._reload_task = asyncio.create_task(self._reload())
+            return
+        self._start_journal()
+        async with self._load_lock:
+            if self._loaded:
+                return
+            await self._load()
+
+    async def _reload(self):
+        try:
+            async with self._load_lock:
+                await self._load()
+            self.reloads += 1
+        except Exception as e:
+            logging.error(f"Reloading the taste index failed, keeping the old one: {e}")
+        finally:
+            self._reload_task = None
+
+    async def _load(self):
+        self._next_reload = time.monotonic() + self.reload_seconds
+        self._start_journal()
+        try:
+            results = await asyncio.gather(*(
+                fetch_paged(
+                    lambda table=table, column=column: supabase.table(table).select(f"user_id, {column}"),
+                    TABLE_KEYS[table]
+                )
+                for table, column in TASTE_TABLES.values()
+            ))
+        except Exception:
+            with self.lock:
+                self._journal = None
+            raise
+
+        def build():
+            postings = {kind: {} for kind in TASTE_TABLES}
+            user_items = {kind: {} for kind in TASTE_TABLES}
+            for (kind, (table, column)), rows in zip(TASTE_TABLES.items(), results):
+                for row in rows:
+                    _add_to(postings, user_items, kind, row.get("user_id"), row.get(column))
+            return postings, user_items, [prepare(user_items) for prepare in self._preparers]
+
+        try:
+            postings, user_items, installs = await asyncio.to_thread(build)
+        except Exception:
+            with self.lock:
+                self._journal = None
+            raise
+
+        with self.lock:
+            changed = set()
+            for kind, user_id, item_ids in self._journal:
+                changed.add(user_id)
+                for item_id in item_ids:
+                    _add_to(postings, user_items, kind, user_id, item_id)
+            self._journal = None
+            self.postings, self.user_items = postings, user_items
+            self._loaded = True
+            self.generation += 1
+            self.version += 1
+            for install in installs:
+                if install is not None:
+                    install(self.generation, changed)
+
+    def add_items(self, kind: str, user_id: int, item_ids: Iterable):
+        """Record rows just written to the link table of `kind`."""
+        item_ids = list(item_ids)
+        with self.lock:
+            for item_id in item_ids:
+                _add_to(self.postings, self.user_items, kind, user_id, item_id)
+            if self._journal is not None:
+                self._journal.append((kind, user_id, item_ids))
+            self.version += 1
+            for listener in self._listeners:
+                listener(kind, user_id)
+
+    def items_of(self, kind: str, user_id: int) -> Set:
+        return self.user_items[kind].get(user_id, set())
+
+    def candidates(self, user_id: int) -> Set[int]:
+        """Users sharing at least one artist, track or genre with `user_id`."""
+        result = set()
+        with self.lock:
+            for kind in TASTE_TABLES:
+                postings = self.postings[kind]
+                for item_id in self.user_items[kind].get(user_id, ()):
+                    result.update(postings.get(item_id, ()))
+        result.discard(user_id)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "loaded": self._loaded,
+            "generation": self.generation,
+            "reloads": self.reloads,
+            "users": len(set().union(*(self.user_items[kind].keys() for kind in TASTE_TABLES))),
+            "reload_seconds": self.reload_seconds
+        }
+
+
+taste_index = TasteIndex()
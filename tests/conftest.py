@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Modules create their Supabase client at import; nothing here talks to it.
+os.environ.setdefault("SUPABASE_URL", "http://localhost:54321")
+os.environ.setdefault("SUPABASE_API_KEY", "test.test.test")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
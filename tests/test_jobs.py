@@ -0,0 +1,126 @@
+import asyncio
+import time
+
+import pytest
+
+from jobs import JobQueue, MemoryJobBackend, SQLiteJobBackend
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return MemoryJobBackend(result_ttl=60)
+    return SQLiteJobBackend(str(tmp_path / "jobs.sqlite3"), result_ttl=60)
+
+
+def make_queue(backend) -> JobQueue:
+    return JobQueue(backend, lease_seconds=60, retry_base_seconds=0, poll_seconds=0)
+
+
+def test_failed_attempts_are_retried_until_max_attempts(backend):
+    queue = make_queue(backend)
+    calls = []
+
+    @queue.handler("flaky")
+    async def flaky(job, progress):
+        calls.append(job.attempts)
+        raise RuntimeError("boom")
+
+    async def run():
+        job = await queue.enqueue("flaky", {}, max_attempts=3)
+        while await queue.run_one():
+            pass
+        return await queue.get(job.job_id)
+
+    job = asyncio.run(run())
+    assert calls == [1, 2, 3]
+    assert job.status == "failed"
+    assert job.error == "boom"
+
+
+def test_retry_succeeds_and_keeps_the_result(backend):
+    queue = make_queue(backend)
+
+    @queue.handler("second_time_lucky")
+    async def second_time_lucky(job, progress):
+        if job.attempts == 1:
+            raise RuntimeError("transient")
+        await progress("done")
+        return {"attempt": job.attempts}
+
+    async def run():
+        job = await queue.enqueue("second_time_lucky", {})
+        while await queue.run_one():
+            pass
+        return await queue.get(job.job_id)
+
+    job = asyncio.run(run())
+    assert job.status == "succeeded"
+    assert job.result == {"attempt": 2}
+    assert job.progress == "done"
+    assert job.error is None
+
+
+def test_expired_lease_is_claimed_again_but_not_past_max_attempts(backend):
+    queue = make_queue(backend)
+
+    async def run():
+        job = await queue.enqueue("crashes_worker", {}, max_attempts=2)
+        # Workers that die right after claiming: the lease simply runs out.
+        claims = [backend.claim(lease_seconds=0) for _ in range(3)]
+        return job, claims, await queue.get(job.job_id)
+
+    job, claims, stored = asyncio.run(run())
+    assert [claim.attempts if claim else None for claim in claims] == [1, 2, None]
+    assert stored.status == "failed"
+    assert "Lease expired" in stored.error
+
+
+def test_running_job_is_not_claimed_while_its_lease_holds(backend):
+    queue = make_queue(backend)
+
+    async def run():
+        await queue.enqueue("slow", {})
+        return backend.claim(lease_seconds=60), backend.claim(lease_seconds=60)
+
+    first, second = asyncio.run(run())
+    assert first is not None and first.status == "running"
+    assert second is None
+
+
+def test_dedupe_key_returns_the_active_job(backend):
+    queue = make_queue(backend)
+
+    @queue.handler("sync")
+    async def sync(job, progress):
+        return {}
+
+    async def run():
+        first = await queue.enqueue("sync", {}, dedupe_key="sync:1")
+        again = await queue.enqueue("sync", {}, dedupe_key="sync:1")
+        await queue.run_one()
+        after = await queue.enqueue("sync", {}, dedupe_key="sync:1")
+        return first, again, after
+
+    first, again, after = asyncio.run(run())
+    assert again.job_id == first.job_id
+    assert after.job_id != first.job_id
+
+
+def test_finished_jobs_expire(backend):
+    queue = make_queue(backend)
+
+    @queue.handler("quick")
+    async def quick(job, progress):
+        return {}
+
+    async def run():
+        job = await queue.enqueue("quick", {})
+        await queue.run_one()
+        finished = await queue.get(job.job_id)
+        finished.run_after = time.time() - 120
+        backend.update(finished)
+        await queue.run_one()
+        return await queue.get(job.job_id)
+
+    assert asyncio.run(run()) is None
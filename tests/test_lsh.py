@@ -0,0 +1,63 @@
+import random
+
+from lsh import LSHIndex, LSH_RECALL_TOP_K
+from match_engine import MatchEngine
+from taste_index import TasteIndex
+
+
+def build_index(users: int, seed: int) -> TasteIndex:
+    rng = random.Random(seed)
+    index = TasteIndex(reload_seconds=0)
+    for user_id in range(1, users + 1):
+        index.add_items("artist", user_id, rng.sample(range(1000), rng.randint(0, 30)))
+        index.add_items("track", user_id, [f"t{i}" for i in rng.sample(range(5000), rng.randint(0, 50))])
+        index.add_items("genre", user_id, rng.sample(range(120), rng.randint(1, 12)))
+    return index
+
+
+def above(scores: dict, min_score: float = 10) -> dict:
+    return {user_id: score for user_id, score in scores.items() if score > min_score}
+
+
+def test_small_sets_inside_larger_ones_are_candidates():
+    index = TasteIndex(reload_seconds=0)
+    index.add_items("genre", 1, [1, 2])
+    for user_id in range(2, 21):
+        index.add_items("genre", user_id, range(1, 13))
+    engine = MatchEngine(index)
+    lsh = LSHIndex(index)
+
+    assert lsh.score_all(1) == engine.score_all(1)
+    assert len(lsh.score_all(1)) == 19
+    # And the other way round: user 1's set lies in every other user's.
+    assert lsh.score_all(2)[1] == engine.score_all(2)[1] == 40.0
+
+
+def test_recall_against_the_exact_engine():
+    index = build_index(1000, seed=5)
+    engine = MatchEngine(index)
+    lsh = LSHIndex(index, seed=1)
+
+    for user_id in range(1, 1001, 10):
+        lsh.record_recall(above(lsh.score_all(user_id)), above(engine.score_all(user_id)))
+
+    stats = lsh.stats()
+    assert stats["mean_recall"] >= 0.98
+    assert stats["mean_recall_top_k"] >= 0.99
+
+
+def test_users_changed_after_the_build_are_candidates():
+    index = build_index(300, seed=5)
+    engine = MatchEngine(index)
+    lsh = LSHIndex(index, seed=1)
+    lsh.ensure_built()
+
+    index.add_items("genre", 301, [1, 2])
+    index.add_items("artist", 301, [7])
+    index.add_items("genre", 5, [1, 2])
+
+    exact = above(engine.score_all(301))
+    top = sorted(exact, key=lambda user_id: (-exact[user_id], user_id))[:LSH_RECALL_TOP_K]
+    found = lsh.score_all(301)
+    assert set(top) <= set(found)
+    assert 301 in lsh.score_all(5)
@@ -0,0 +1,123 @@
+import asyncio
+import random
+from types import SimpleNamespace
+
+import taste_index as taste_index_module
+from match_engine import MatchEngine
+from taste_index import TasteIndex
+
+
+def legacy_match_score(current: dict, other: dict) -> float:
+    """The per-pair scorer find_matches used before the match engine."""
+    shared_artists = current["artist"] & other["artist"]
+    shared_tracks = current["track"] & other["track"]
+    shared_genres = current["genre"] & other["genre"]
+
+    artist_match = len(shared_artists) / max(1, min(len(current["artist"]), len(other["artist"])))
+    track_match = len(shared_tracks) / max(1, min(len(current["track"]), len(other["track"])))
+    genre_match = len(shared_genres) / max(1, min(len(current["genre"]), len(other["genre"])))
+
+    match_score = (artist_match * 0.35 + track_match * 0.25 + genre_match * 0.40) * 100
+    return round(match_score, 2)
+
+
+def build_index(users: int = 300, seed: int = 7) -> TasteIndex:
+    rng = random.Random(seed)
+    index = TasteIndex(reload_seconds=0)
+    for user_id in range(1, users + 1):
+        index.add_items("artist", user_id, rng.sample(range(200), rng.randint(0, 30)))
+        index.add_items("track", user_id, [f"t{i}" for i in rng.sample(range(1000), rng.randint(0, 50))])
+        index.add_items("genre", user_id, rng.sample(range(40), rng.randint(0, 12)))
+    return index
+
+
+def profile(index: TasteIndex, user_id: int) -> dict:
+    return {kind: set(index.items_of(kind, user_id)) for kind in ("artist", "track", "genre")}
+
+
+def expected_scores(index: TasteIndex, user_id: int, users: int) -> dict:
+    current = profile(index, user_id)
+    scores = {}
+    for other_id in range(1, users + 1):
+        if other_id != user_id:
+            score = legacy_match_score(current, profile(index, other_id))
+            if score:
+                scores[other_id] = score
+    return scores
+
+
+def test_score_all_matches_legacy_scorer():
+    index = build_index()
+    engine = MatchEngine(index)
+    for user_id in range(1, 301, 7):
+        assert engine.score_all(user_id) == expected_scores(index, user_id, 300)
+
+
+def test_score_all_sees_users_changed_after_the_build():
+    index = build_index()
+    engine = MatchEngine(index)
+    engine.ensure_built()
+    index.add_items("artist", 5, range(200, 210))
+    index.add_items("artist", 301, range(200, 205))
+    index.add_items("genre", 301, [1, 2, 3])
+
+    for user_id in (5, 301, 12):
+        assert engine.score_all(user_id) == expected_scores(index, user_id, 301)
+
+
+def expected_top_k(scores: dict, k: int, min_score: float) -> list:
+    ranked = sorted(((user_id, score) for user_id, score in scores.items() if score > min_score),
+                    key=lambda pair: (-pair[1], pair[0]))
+    return ranked[:k]
+
+
+def test_top_k_equals_head_of_full_ranking():
+    index = build_index()
+    engine = MatchEngine(index)
+    for user_id in range(1, 301, 3):
+        scores = engine.score_all(user_id)
+        for k, min_score in ((1, 10), (5, 10), (20, 0), (50, 30)):
+            assert engine.top_k(user_id, k, min_score) == expected_top_k(scores, k, min_score)
+
+
+def test_top_k_with_genre_only_overlaps_and_ties():
+    index = TasteIndex(reload_seconds=0)
+    index.add_items("genre", 1, [1, 2])
+    for user_id in range(2, 8):
+        index.add_items("genre", user_id, [1, 2])
+    index.add_items("artist", 1, ["a"])
+    index.add_items("artist", 9, ["a"])
+    engine = MatchEngine(index)
+
+    top = engine.top_k(1, 4, 10)
+    assert top == expected_top_k(engine.score_all(1), 4, 10)
+    assert [user_id for user_id, _ in top] == [2, 3, 4, 5]
+
+
+def test_reload_swaps_in_matrices_built_while_loading(monkeypatch):
+    source = build_index()
+    rows = {
+        table: [{"user_id": user_id, column: item_id}
+                for user_id, items in source.user_items[kind].items() for item_id in items]
+        for kind, (table, column) in taste_index_module.TASTE_TABLES.items()
+    }
+    index = TasteIndex(reload_seconds=0)
+    engine = MatchEngine(index)
+
+    async def fetch_paged(make_query, order_by):
+        # Written while the load runs, so it must survive the swap.
+        index.add_items("artist", 301, range(5))
+        return rows[make_query()]
+
+    monkeypatch.setattr(taste_index_module, "supabase",
+                        SimpleNamespace(table=lambda table: SimpleNamespace(select=lambda columns: table)))
+    monkeypatch.setattr(taste_index_module, "fetch_paged", fetch_paged)
+
+    # The first load and a reload.
+    for _ in range(2):
+        asyncio.run(index._load())
+        for user_id in (1, 50, 301):
+            assert engine.score_all(user_id) == expected_scores(index, user_id, 301)
+
+    assert engine.builds == 0
+    assert engine.background_builds == 2
@@ -0,0 +1,102 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import message_batcher
+from message_batcher import MessageBatcher
+
+
+class FakeTable:
+    def __init__(self, database):
+        self.database = database
+        self.rows = None
+
+    def insert(self, rows):
+        self.rows = rows
+        return self
+
+    async def execute(self):
+        await asyncio.sleep(self.database.delay)
+        if self.database.fail:
+            raise RuntimeError("insert failed")
+        self.database.batches.append(self.rows)
+        stored = []
+        for row in self.rows:
+            self.database.next_id += 1
+            stored.append({**row, "message_id": self.database.next_id})
+        return SimpleNamespace(data=stored)
+
+
+class FakeDatabase:
+    def __init__(self, delay=0.0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.batches = []
+        self.next_id = 0
+
+    def table(self, name):
+        return FakeTable(self)
+
+
+@pytest.fixture
+def database(monkeypatch):
+    fake = FakeDatabase()
+    monkeypatch.setattr(message_batcher, "database", fake)
+    return fake
+
+
+def test_batches_keep_arrival_order_and_return_each_callers_row(database):
+    # Slow writes make later batches queue up behind earlier ones.
+    database.delay = 0.01
+    batcher = MessageBatcher("messages", flush_size=3, flush_interval=0.005)
+
+    async def run():
+        return await asyncio.gather(*(batcher.insert({"content": str(i)}) for i in range(8)))
+
+    stored = asyncio.run(run())
+    assert [row["content"] for row in stored] == [str(i) for i in range(8)]
+    assert [row["message_id"] for row in stored] == list(range(1, 9))
+    assert [len(batch) for batch in database.batches] == [3, 3, 2]
+
+
+def test_insert_failure_reaches_every_caller_of_the_batch(database):
+    database.fail = True
+    batcher = MessageBatcher("messages", flush_size=2, flush_interval=60)
+
+    async def run():
+        return await asyncio.gather(*(batcher.insert({"content": str(i)}) for i in range(2)),
+                                    return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_stop_writes_rows_still_waiting_for_the_interval(database):
+    batcher = MessageBatcher("messages", flush_size=50, flush_interval=60)
+
+    async def run():
+        inserts = [asyncio.create_task(batcher.insert({"content": str(i)})) for i in range(3)]
+        await asyncio.sleep(0)
+        await batcher.stop()
+        assert all(task.done() for task in inserts)
+        return [task.result() for task in inserts]
+
+    stored = asyncio.run(run())
+    assert [row["message_id"] for row in stored] == [1, 2, 3]
+    assert database.batches == [[{"content": "0"}, {"content": "1"}, {"content": "2"}]]
+
+
+def test_stop_waits_for_running_writes(database):
+    database.delay = 0.02
+    batcher = MessageBatcher("messages", flush_size=2, flush_interval=60)
+
+    async def run():
+        inserts = [asyncio.create_task(batcher.insert({"content": str(i)})) for i in range(3)]
+        await asyncio.sleep(0)
+        await batcher.stop()
+        assert all(task.done() for task in inserts)
+        return [task.result()["content"] for task in inserts]
+
+    assert asyncio.run(run()) == ["0", "1", "2"]
+    assert [len(batch) for batch in database.batches] == [2, 1]
@@ -0,0 +1,42 @@
+from datetime import datetime, timezone
+
+from message_cache import MessageCache
+from schemas import Message
+
+
+def make_message(message_id: int, match_id: int) -> Message:
+    return Message(message_id=message_id, match_id=match_id, sender_id=1, message_text="hi",
+                   sent_at=datetime(2024, 5, 1, 12, message_id, tzinfo=timezone.utc))
+
+
+def test_versions_never_go_back_when_pruned():
+    cache = MessageCache(size=10, max_conversations=1, ttl=60)
+    cache._bump(1)
+    seen = cache.version(1)
+
+    # Enough writes to other matches to prune the version table.
+    for match_id in range(2, 10):
+        cache._bump(match_id)
+
+    assert cache.version(1) >= seen
+    assert cache.version(99) >= seen
+
+
+def test_load_that_raced_with_an_invalidation_is_not_kept():
+    cache = MessageCache(size=10, max_conversations=10, ttl=60)
+    version = cache.version(1)
+
+    cache.invalidate(1)
+    cache.load(1, [make_message(1, 1)], version)
+
+    assert cache.first_page(1, 1) is None
+
+
+def test_invalidate_drops_the_conversation():
+    cache = MessageCache(size=10, max_conversations=10, ttl=60)
+    cache.load(1, [make_message(1, 1)], cache.version(1))
+    assert cache.first_page(1, 1) is not None
+
+    cache.invalidate(1)
+
+    assert cache.first_page(1, 1) is None
@@ -0,0 +1,106 @@
+import asyncio
+import base64
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+import services
+from schemas import Message
+from services import _parse_message_cursor, get_chat_messages_service, message_cursor
+
+
+def make_message(message_id: int, sent_at: datetime) -> Message:
+    return Message(message_id=message_id, match_id=1, sender_id=10, message_text="hi", sent_at=sent_at)
+
+
+class RecordingQuery:
+    """Records the calls of a messages query and returns `rows`."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.calls = []
+
+    def __getattr__(self, name):
+        def record(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+        return record
+
+    async def execute(self):
+        return SimpleNamespace(data=self.rows)
+
+
+@pytest.fixture
+def messages_query(monkeypatch):
+    query = RecordingQuery([])
+
+    async def user_id(email):
+        return 10
+
+    async def match(match_id):
+        return {"user1_id": 10, "user2_id": 20}
+
+    monkeypatch.setattr(services, "get_user_id_from_email", user_id)
+    monkeypatch.setattr(services, "get_match_by_id", match)
+    monkeypatch.setattr(services, "supabase", SimpleNamespace(table=lambda name: query))
+    return query
+
+
+def test_cursor_round_trips_sent_at_and_message_id():
+    sent_at = datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)
+    cursor = message_cursor(make_message(42, sent_at))
+
+    assert "=" not in cursor
+    assert _parse_message_cursor(cursor) == (sent_at.isoformat(), 42)
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64 at all!",
+    base64.urlsafe_b64encode(b"2024-05-01T12:30:15+00:00").decode(),
+    base64.urlsafe_b64encode(b"2024-05-01T12:30:15+00:00|abc").decode(),
+    base64.urlsafe_b64encode(b"yesterday|42").decode(),
+])
+def test_invalid_cursor_is_a_400(cursor):
+    with pytest.raises(HTTPException) as error:
+        _parse_message_cursor(cursor)
+    assert error.value.status_code == 400
+
+
+def test_before_selects_older_messages_newest_first(messages_query):
+    sent_at = datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc)
+    cursor = message_cursor(make_message(42, sent_at))
+
+    asyncio.run(get_chat_messages_service(1, "a@example.com", page_size=10, before=cursor))
+
+    assert ("or_", (f'sent_at.lt."{sent_at.isoformat()}",'
+                    f'and(sent_at.eq."{sent_at.isoformat()}",message_id.lt.42)',), {}) in messages_query.calls
+    orders = [call for call in messages_query.calls if call[0] == "order"]
+    assert orders == [("order", ("sent_at",), {"desc": True}), ("order", ("message_id",), {"desc": True})]
+    assert ("limit", (10,), {}) in messages_query.calls
+
+
+def test_after_selects_newer_messages_and_returns_them_newest_first(messages_query):
+    sent_at = datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc)
+    messages_query.rows = [
+        {"message_id": 43, "match_id": 1, "sender_id": 20, "message_text": "a", "sent_at": "2024-05-01T12:00:00+00:00"},
+        {"message_id": 44, "match_id": 1, "sender_id": 20, "message_text": "b", "sent_at": "2024-05-01T12:01:00+00:00"},
+    ]
+
+    messages = asyncio.run(get_chat_messages_service(
+        1, "a@example.com", page_size=10, after=message_cursor(make_message(42, sent_at))
+    ))
+
+    assert ("or_", (f'sent_at.gt."{sent_at.isoformat()}",'
+                    f'and(sent_at.eq."{sent_at.isoformat()}",message_id.gt.42)',), {}) in messages_query.calls
+    orders = [call for call in messages_query.calls if call[0] == "order"]
+    assert orders == [("order", ("sent_at",), {}), ("order", ("message_id",), {})]
+    assert [message.message_id for message in messages] == [44, 43]
+
+
+def test_before_and_after_together_is_a_400(messages_query):
+    cursor = message_cursor(make_message(42, datetime(2024, 5, 1, tzinfo=timezone.utc)))
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(get_chat_messages_service(1, "a@example.com", before=cursor, after=cursor))
+    assert error.value.status_code == 400
@@ -0,0 +1,86 @@
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import services
+from read_receipts import ReadReceiptCoalescer
+from unread_counters import UnreadCounters
+
+
+class UpdateQuery:
+    """Stands in for the read-receipt update; returns `updated` rows."""
+
+    def __init__(self, updated):
+        self.updated = updated
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    async def execute(self):
+        return SimpleNamespace(data=[{"message_id": i} for i in range(self.updated)])
+
+
+def test_read_receipt_takes_the_updated_messages_off_the_counter(monkeypatch):
+    counters = UnreadCounters()
+    # Three unread, but one of them arrived after the receipt's watermark.
+    counters._counts[10] = {1: 3}
+    monkeypatch.setattr(services, "unread_counters", counters)
+    monkeypatch.setattr(services, "supabase", SimpleNamespace(table=lambda name: UpdateQuery(2)))
+
+    updated = asyncio.run(services._write_read_receipt(1, 10, 20, datetime.now(timezone.utc)))
+
+    assert updated == 2
+    assert counters._counts[10] == {1: 1}
+
+
+def test_decrement_drops_counters_that_reach_zero():
+    counters = UnreadCounters()
+    counters._counts[10] = {1: 2, 2: 5}
+
+    counters.decrement(10, 1, 3)
+    counters.decrement(10, 3, 1)
+    counters.decrement(99, 1, 1)
+
+    assert counters._counts == {10: {2: 5}}
+
+
+def test_failed_receipt_is_retried_with_its_watermark():
+    coalescer = ReadReceiptCoalescer(interval=0.01, max_retries=3)
+    calls = []
+
+    @coalescer.on_flush
+    async def write(match_id, reader_id, other_user_id, read_at):
+        calls.append(read_at)
+        if len(calls) == 1:
+            raise RuntimeError("database down")
+        return 1
+
+    async def run():
+        result = await coalescer.mark_read(1, 10, 20)
+        await asyncio.sleep(0.05)
+        return result
+
+    result = asyncio.run(run())
+    assert result["retrying"] is True
+    assert len(calls) == 2 and calls[0] == calls[1]
+    assert coalescer.stats()["failed"] == 1
+    assert coalescer.stats()["pending"] == 0
+
+
+def test_receipt_is_dropped_after_max_retries():
+    coalescer = ReadReceiptCoalescer(interval=0.005, max_retries=2)
+    calls = []
+
+    @coalescer.on_flush
+    async def write(match_id, reader_id, other_user_id, read_at):
+        calls.append(read_at)
+        raise RuntimeError("database down")
+
+    async def run():
+        await coalescer.mark_read(1, 10, 20)
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+    assert len(calls) == 3
+    assert coalescer.stats()["dropped"] == 1
+    assert coalescer.stats()["pending"] == 0
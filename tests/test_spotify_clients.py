@@ -0,0 +1,27 @@
+import gc
+
+import spotify_service
+from spotify_clients import http_session, SharedSessionSpotify, SpotifyClientPool
+from spotify_service import create_auth_manager
+
+
+def test_evicted_clients_leave_the_shared_connection_pool_open(monkeypatch):
+    monkeypatch.setattr(spotify_service, "SPOTIFY_CLIENT_ID", "client")
+    monkeypatch.setattr(spotify_service, "SPOTIFY_CLIENT_SECRET", "secret")
+    monkeypatch.setattr(spotify_service, "SPOTIFY_REDIRECT_URI", "http://localhost/callback")
+    pool_manager = http_session.get_adapter("https://api.spotify.com").poolmanager
+    pool_manager.connection_from_url("https://api.spotify.com")
+    pools = len(pool_manager.pools)
+    clients = SpotifyClientPool(max_size=1, idle_seconds=60)
+
+    def factory():
+        return SharedSessionSpotify(auth_manager=create_auth_manager(1), requests_session=http_session)
+
+    clients.get(1, factory)
+    # Evicts and collects the first client and its auth manager.
+    clients.get(2, factory)
+    clients.discard(2)
+    gc.collect()
+
+    assert len(clients.clients) == 0
+    assert len(pool_manager.pools) == pools > 0
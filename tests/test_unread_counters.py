@@ -0,0 +1,57 @@
+import asyncio
+from types import SimpleNamespace
+
+import bulk_loader
+import unread_counters
+from unread_counters import UnreadCounters
+
+
+def test_concurrent_first_reads_share_one_load(monkeypatch):
+    counters = UnreadCounters()
+    loads = []
+
+    async def count(user_id):
+        loads.append(user_id)
+        await asyncio.sleep(0.01)
+        return {1: 2}
+
+    monkeypatch.setattr(counters, "_count_from_database", count)
+
+    async def run():
+        return await asyncio.gather(counters.counts_for(10), counters.counts_for(10))
+
+    assert asyncio.run(run()) == [{1: 2}, {1: 2}]
+    assert loads == [10]
+    assert counters._loads == {}
+
+
+class MatchesQuery:
+    """The matches of one user, served in `range` pages."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.start = self.end = None
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    def range(self, start, end):
+        self.start, self.end = start, end
+        return self
+
+    async def execute(self):
+        return SimpleNamespace(data=self.rows[self.start:self.end + 1])
+
+
+def test_count_pages_through_all_matches(monkeypatch):
+    rows = [{"match_id": match_id, "user1_id": 10, "user2_id": 100 + match_id} for match_id in range(5)]
+    monkeypatch.setattr(bulk_loader, "PAGE_SIZE", 2)
+    monkeypatch.setattr(unread_counters, "database", SimpleNamespace(table=lambda name: MatchesQuery(rows)))
+
+    async def unread(table, columns, column, values, refine=None):
+        return [{"match_id": match_id} for match_id in values]
+
+    monkeypatch.setattr(unread_counters, "fetch_rows_in", unread)
+
+    counts = asyncio.run(UnreadCounters()._count_from_database(10))
+    assert counts == {match_id: 1 for match_id in range(5)}
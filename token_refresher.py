@@ -0,0 +1,175 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from spotipy.oauth2 import SpotifyOauthError
+
+from bulk_loader import fetch_rows_in
+from db import get_database
+from spotify_executor import spotify_call
+from spotify_service import create_auth_manager
+from spotify_clients import spotify_client_pool
+from token_store import token_store
+
+# Refresh this long before a token expires; spotipy itself only refreshes
+# within 60 seconds of expiry, so user requests never get to do it.
+TOKEN_REFRESH_LEAD_SECONDS = float(os.getenv("TOKEN_REFRESH_LEAD_SECONDS", "300"))
+# Random extra advance so tokens that expire together do not refresh together.
+TOKEN_REFRESH_JITTER_SECONDS = float(os.getenv("TOKEN_REFRESH_JITTER_SECONDS", "120"))
+TOKEN_REFRESH_SCAN_SECONDS = float(os.getenv("TOKEN_REFRESH_SCAN_SECONDS", "60"))
+TOKEN_REFRESH_CONCURRENCY = int(os.getenv("TOKEN_REFRESH_CONCURRENCY", "4"))
+# After a failed refresh the user is retried after base * 2**(failures - 1), at most max seconds.
+TOKEN_REFRESH_BACKOFF_BASE_SECONDS = float(os.getenv("TOKEN_REFRESH_BACKOFF_BASE_SECONDS", "60"))
+TOKEN_REFRESH_BACKOFF_MAX_SECONDS = float(os.getenv("TOKEN_REFRESH_BACKOFF_MAX_SECONDS", "21600"))
+
+database = get_database()
+
+
+def _expires_at(row: dict) -> Optional[float]:
+    if row.get("token_info"):
+        token_info = json.loads(row["token_info"])
+        if token_info.get("expires_at"):
+            return float(token_info["expires_at"])
+    if row.get("expires_at"):
+        return datetime.fromisoformat(row["expires_at"].replace("Z", "+00:00")).timestamp()
+    return None
+
+
+class TokenRefreshScheduler:
+    """
+    Refreshes Spotify tokens shortly before they expire, in the background.
+
+    Every `scan_seconds` it reads the spotify_accounts rows expiring soon of
+    the users active on this worker (see TokenStore.active_users; others are
+    refreshed by spotipy when they come back) and schedules one refresh per
+    user at expires_at - lead - random jitter. At most `concurrency`
+    refreshes run at once. Failed refreshes are retried with exponential
+    backoff; tokens Spotify rejects as invalid_grant are dropped.
+    """
+
+    def __init__(self, lead: float = TOKEN_REFRESH_LEAD_SECONDS, jitter: float = TOKEN_REFRESH_JITTER_SECONDS,
+                 scan_seconds: float = TOKEN_REFRESH_SCAN_SECONDS, concurrency: int = TOKEN_REFRESH_CONCURRENCY):
+        self.lead = lead
+        self.jitter = jitter
+        self.scan_seconds = scan_seconds
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._scheduled: Dict[int, asyncio.Task] = {}
+        # user_id -> (failed refreshes in a row, time.time() before which it is not retried)
+        self._failures: Dict[int, tuple] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.refreshed = 0
+        self.skipped = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        tasks = list(self._scheduled.values())
+        if self._task:
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        self._scheduled.clear()
+
+    async def _run(self):
+        while True:
+            try:
+                await self.scan()
+            except Exception as e:
+                logging.error(f"Token refresh scan failed: {e}")
+            await asyncio.sleep(self.scan_seconds)
+
+    async def scan(self):
+        now = time.time()
+        horizon = now + self.lead + self.jitter + self.scan_seconds
+        # Users not retried for long (e.g. no longer active) do not keep their failure count forever.
+        for user_id in [user_id for user_id, (_, retry_at) in self._failures.items()
+                        if retry_at + TOKEN_REFRESH_BACKOFF_MAX_SECONDS < now and user_id not in self._scheduled]:
+            del self._failures[user_id]
+
+        rows = await fetch_rows_in(
+            "spotify_accounts", "user_id, token_info, expires_at", "user_id", token_store.active_users(),
+            refine=lambda query: query
+            .lte("expires_at", datetime.fromtimestamp(horizon, tz=timezone.utc).isoformat())
+            .not_.is_("token_info", "null")
+        )
+
+        for row in rows:
+            user_id = row.get("user_id")
+            expires_at = _expires_at(row)
+            if user_id is None or expires_at is None or user_id in self._scheduled:
+                continue
+            _, retry_at = self._failures.get(user_id, (0, 0.0))
+            refresh_at = max(expires_at - self.lead - random.uniform(0, self.jitter), retry_at)
+            self._scheduled[user_id] = asyncio.create_task(self._refresh_later(user_id, max(0.0, refresh_at - now)))
+
+    async def _refresh_later(self, user_id: int, delay: float):
+        try:
+            await asyncio.sleep(delay)
+            async with self._semaphore:
+                await self.refresh(user_id)
+            self._failures.pop(user_id, None)
+        except asyncio.CancelledError:
+            raise
+        except SpotifyOauthError as e:
+            if e.error == "invalid_grant":
+                # Revoked or otherwise dead refresh token: retrying can never succeed.
+                self.dropped += 1
+                self._failures.pop(user_id, None)
+                logging.warning(f"Spotify rejected the refresh token of user {user_id}, dropping it: {e}")
+                await asyncio.to_thread(token_store.drop, user_id)
+            else:
+                self._record_failure(user_id, e)
+        except Exception as e:
+            self._record_failure(user_id, e)
+        finally:
+            self._scheduled.pop(user_id, None)
+
+    def _record_failure(self, user_id: int, error: Exception):
+        self.failed += 1
+        failures = self._failures.get(user_id, (0, 0.0))[0] + 1
+        backoff = min(TOKEN_REFRESH_BACKOFF_BASE_SECONDS * 2 ** (failures - 1), TOKEN_REFRESH_BACKOFF_MAX_SECONDS)
+        self._failures[user_id] = (failures, time.time() + backoff)
+        logging.error(f"Refreshing Spotify token of user {user_id} failed ({failures} in a row, "
+                      f"retrying in {backoff:.0f}s): {error}")
+
+    async def refresh(self, user_id: int):
+        # Another worker may have refreshed it already; the stored row wins then.
+        token_info = await token_store.backend.load_async(user_id) or token_store.get(user_id)
+        if not token_info or not token_info.get("refresh_token"):
+            self.skipped += 1
+            return
+        if token_info.get("expires_at", 0) - time.time() > self.lead + self.jitter:
+            token_store.save(user_id, token_info, persist=False)
+            self.skipped += 1
+            return
+
+        # Reuse the pooled client's auth manager; both save through the token store.
+        client = spotify_client_pool.clients.get(user_id)
+        auth_manager = client.auth_manager if client is not None else create_auth_manager(user_id)
+        # Saves the new token through the token store, which writes it back to spotify_accounts.
+        await spotify_call(auth_manager.refresh_access_token, token_info["refresh_token"])
+        self.refreshed += 1
+
+    def stats(self) -> dict:
+        return {
+            "scheduled": len(self._scheduled),
+            "refreshed": self.refreshed,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "backing_off": len(self._failures)
+        }
+
+
+token_refresher = TokenRefreshScheduler()
@@ -0,0 +1,177 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from spotipy.cache_handler import CacheHandler
+
+from cache import TTLCache
+from db import get_database
+
+# "db": tokens live in spotify_accounts.token_info, memory is a read-through layer.
+# "memory": tokens only live in this process (single worker, local development).
+TOKEN_STORE_BACKEND = os.getenv("TOKEN_STORE_BACKEND", "db")
+TOKEN_STORE_CACHE_SIZE = int(os.getenv("TOKEN_STORE_CACHE_SIZE", "10000"))
+# Cached tokens are read again after this long, so tokens stored or refreshed
+# by other workers are picked up.
+TOKEN_STORE_CACHE_TTL_SECONDS = float(os.getenv("TOKEN_STORE_CACHE_TTL_SECONDS", "300"))
+# Users whose token was requested this recently count as active, e.g. for
+# the background refresher.
+TOKEN_STORE_ACTIVE_SECONDS = float(os.getenv("TOKEN_STORE_ACTIVE_SECONDS", "3600"))
+# A cached token this close to expiry is read again before spotipy refreshes
+# it, in case another worker already did.
+TOKEN_STORE_REVALIDATE_SECONDS = 60
+
+database = get_database()
+
+
+class MemoryTokenBackend:
+    reads_spotify_accounts = False
+
+    def __init__(self):
+        self._tokens: Dict[int, dict] = {}
+
+    def load(self, user_id: int) -> Optional[dict]:
+        return self._tokens.get(user_id)
+
+    async def load_async(self, user_id: int) -> Optional[dict]:
+        return self.load(user_id)
+
+    def save(self, user_id: int, token_info: dict):
+        self._tokens[user_id] = token_info
+
+    def drop(self, user_id: int):
+        self._tokens.pop(user_id, None)
+
+
+class SupabaseTokenBackend:
+    """Reads and writes spotify_accounts.token_info with the sync client (spotipy calls us from worker threads)."""
+
+    reads_spotify_accounts = True
+
+    @staticmethod
+    def _parse(data) -> Optional[dict]:
+        if data and data[0].get("token_info"):
+            return json.loads(data[0]["token_info"])
+        return None
+
+    def load(self, user_id: int) -> Optional[dict]:
+        response = database.sync_client.table("spotify_accounts") \
+            .select("token_info") \
+            .eq("user_id", user_id) \
+            .execute()
+        return self._parse(response.data)
+
+    async def load_async(self, user_id: int) -> Optional[dict]:
+        response = await database.table("spotify_accounts") \
+            .select("token_info") \
+            .eq("user_id", user_id) \
+            .execute()
+        return self._parse(response.data)
+
+    def save(self, user_id: int, token_info: dict):
+        database.sync_client.table("spotify_accounts").update({
+            "token_info": json.dumps(token_info),
+            "expires_at": datetime.fromtimestamp(token_info["expires_at"], tz=timezone.utc).isoformat()
+        }).eq("user_id", user_id).execute()
+
+    def drop(self, user_id: int):
+        database.sync_client.table("spotify_accounts").update({"token_info": None}).eq("user_id", user_id).execute()
+
+
+class TokenStore:
+    """
+    Spotify token_info per user_id, kept in memory in front of a backend.
+
+    Tokens are cached for `ttl` seconds, least recently used first out when
+    `max_size` is reached; users without a token are not cached, so a token
+    stored by another worker is found on the next read. A cached token about
+    to expire is read again from the backend. The backend is written only
+    when a token really changes, i.e. after the code exchange or a refresh.
+    """
+
+    def __init__(self, backend, max_size: int = TOKEN_STORE_CACHE_SIZE, ttl: float = TOKEN_STORE_CACHE_TTL_SECONDS,
+                 active_seconds: float = TOKEN_STORE_ACTIVE_SECONDS):
+        self.backend = backend
+        self._tokens = TTLCache(max_size, ttl)
+        # user_id -> True for users whose client was requested within `active_seconds`
+        self._active = TTLCache(max_size, active_seconds)
+        self._lock = threading.Lock()
+        self.backend_reads = 0
+        self.backend_writes = 0
+
+    @staticmethod
+    def _fresh(token_info: dict) -> bool:
+        return token_info.get("expires_at", 0) - time.time() > TOKEN_STORE_REVALIDATE_SECONDS
+
+    def _remember(self, user_id: int, token_info: Optional[dict]) -> Optional[dict]:
+        if token_info is None:
+            self._tokens.pop(user_id)
+        else:
+            self._tokens.set(user_id, token_info)
+        return token_info
+
+    def get(self, user_id: int) -> Optional[dict]:
+        token_info = self._tokens.get(user_id)
+        if token_info is not None and self._fresh(token_info):
+            return token_info
+        self.backend_reads += 1
+        return self._remember(user_id, self.backend.load(user_id))
+
+    async def preload(self, user_id: int) -> Optional[dict]:
+        """Async variant of `get` for the request path; also marks the user as active."""
+        self._active.set(user_id, True)
+        token_info = self._tokens.get(user_id)
+        if token_info is not None and self._fresh(token_info):
+            return token_info
+        self.backend_reads += 1
+        return self._remember(user_id, await self.backend.load_async(user_id))
+
+    def save(self, user_id: int, token_info: dict, persist: bool = True):
+        """`persist=False` when the spotify_accounts row already holds `token_info`."""
+        with self._lock:
+            if self._tokens.get(user_id) == token_info:
+                return
+            self._tokens.set(user_id, token_info)
+        if persist or not self.backend.reads_spotify_accounts:
+            self.backend_writes += 1
+            self.backend.save(user_id, token_info)
+
+    def forget(self, user_id: int):
+        self._tokens.pop(user_id)
+
+    def drop(self, user_id: int):
+        """Delete a token Spotify no longer accepts; the user has to connect again."""
+        self.forget(user_id)
+        self.backend_writes += 1
+        self.backend.drop(user_id)
+
+    def active_users(self) -> list:
+        return self._active.keys()
+
+    def stats(self) -> dict:
+        return {
+            "cache": self._tokens.stats(),
+            "active_users": len(self.active_users()),
+            "backend_reads": self.backend_reads,
+            "backend_writes": self.backend_writes
+        }
+
+
+class TokenStoreCacheHandler(CacheHandler):
+    """spotipy cache handler bound to one user of a TokenStore, replacing the .cache-{email} files."""
+
+    def __init__(self, store: TokenStore, user_id: int):
+        self.store = store
+        self.user_id = user_id
+
+    def get_cached_token(self):
+        return self.store.get(self.user_id)
+
+    def save_token_to_cache(self, token_info):
+        self.store.save(self.user_id, token_info)
+
+
+token_store = TokenStore(MemoryTokenBackend() if TOKEN_STORE_BACKEND == "memory" else SupabaseTokenBackend())
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+from bulk_loader import fetch_paged, fetch_rows_in, TABLE_KEYS
+from db import get_database
+from match_cache import match_cache
+
+# Loaded users are re-counted from the database this often, which also
+# picks up messages and reads handled by other workers.
+UNREAD_RECONCILE_SECONDS = float(os.getenv("UNREAD_RECONCILE_SECONDS", "300"))
+# Users whose counters were not read for this long are dropped instead.
+UNREAD_IDLE_SECONDS = float(os.getenv("UNREAD_IDLE_SECONDS", "3600"))
+UNREAD_RECONCILE_CONCURRENCY = int(os.getenv("UNREAD_RECONCILE_CONCURRENCY", "4"))
+
+database = get_database()
+
+
+class UnreadCounters:
+    """
+    Unread message counts per (user, match), kept up to date in memory.
+
+    A user's counters are counted from the database the first time they are
+    read; after that, inserts increment the recipient's counter and read
+    receipts take the messages they marked read off the reader's, so reads
+    are dictionary lookups. Only
+    non-zero counters are stored. A background loop re-counts loaded users
+    every `reconcile_seconds` and drops the ones not read for `idle_seconds`.
+    """
+
+    def __init__(self, reconcile_seconds: float = UNREAD_RECONCILE_SECONDS,
+                 idle_seconds: float = UNREAD_IDLE_SECONDS, concurrency: int = UNREAD_RECONCILE_CONCURRENCY):
+        self.reconcile_seconds = reconcile_seconds
+        self.idle_seconds = idle_seconds
+        self.concurrency = concurrency
+        # user_id -> {match_id: unread count > 0}
+        self._counts: Dict[int, Dict[int, int]] = {}
+        self._last_read: Dict[int, float] = {}
+        # user_id -> changes seen while a load of the user is running
+        self._loading: Dict[int, int] = {}
+        # user_id -> the running load, shared by concurrent callers
+        self._loads: Dict[int, asyncio.Task] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.loads = 0
+        self.corrections = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _count_from_database(self, user_id: int) -> Dict[int, int]:
+        matches = await fetch_paged(
+            lambda: database.table("matches")
+            .select("match_id, user1_id, user2_id")
+            .or_(f"user1_id.eq.{user_id},user2_id.eq.{user_id}"),
+            TABLE_KEYS["matches"]
+        )
+        match_cache.remember(matches)
+
+        unread = await fetch_rows_in(
+            "messages", "match_id", "match_id", [row["match_id"] for row in matches],
+            refine=lambda query: query.neq("sender_id", user_id).is_("read_at", None)
+        )
+        counts = {}
+        for row in unread:
+            counts[row["match_id"]] = counts.get(row["match_id"], 0) + 1
+        return counts
+
+    async def _load(self, user_id: int):
+        """Load the user's counters, joining the load already running for them if any."""
+        task = self._loads.get(user_id)
+        if task is None:
+            task = self._loads[user_id] = asyncio.create_task(self._load_counts(user_id))
+
+            def forget(done: asyncio.Task):
+                if self._loads.get(user_id) is done:
+                    del self._loads[user_id]
+            task.add_done_callback(forget)
+        # A cancelled caller must not cancel the load the others wait for.
+        await asyncio.shield(task)
+
+    async def _load_counts(self, user_id: int):
+        try:
+            for _ in range(3):
+                self._loading[user_id] = 0
+                counts = await self._count_from_database(user_id)
+                if not self._loading[user_id]:
+                    break
+        finally:
+            self._loading.pop(user_id, None)
+        self.loads += 1
+        if user_id in self._counts and self._counts[user_id] != counts:
+            self.corrections += 1
+        self._counts[user_id] = counts
+
+    async def counts_for(self, user_id: int) -> Dict[int, int]:
+        """match_id -> unread count for every match of the user with unread messages."""
+        self._last_read[user_id] = time.monotonic()
+        if user_id not in self._counts:
+            await self._load(user_id)
+        return dict(self._counts.get(user_id, {}))
+
+    def increment(self, recipient_id: int, match_id: int):
+        if recipient_id in self._loading:
+            self._loading[recipient_id] += 1
+        counts = self._counts.get(recipient_id)
+        if counts is not None:
+            counts[match_id] = counts.get(match_id, 0) + 1
+
+    def decrement(self, reader_id: int, match_id: int, count: int):
+        """`count` messages of the match were marked read by `reader_id`."""
+        if reader_id in self._loading:
+            self._loading[reader_id] += 1
+        counts = self._counts.get(reader_id)
+        if counts is not None and match_id in counts:
+            remaining = counts[match_id] - count
+            if remaining > 0:
+                counts[match_id] = remaining
+            else:
+                del counts[match_id]
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.reconcile_seconds)
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logging.error(f"Unread counter reconciliation failed: {e}")
+
+    async def reconcile(self):
+        now = time.monotonic()
+        for user_id in [user_id for user_id, read_at in self._last_read.items() if now - read_at > self.idle_seconds]:
+            self._last_read.pop(user_id, None)
+            self._counts.pop(user_id, None)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def reload(user_id: int):
+            async with semaphore:
+                try:
+                    await self._load(user_id)
+                except Exception as e:
+                    logging.error(f"Could not re-count unread messages of user {user_id}: {e}")
+
+        await asyncio.gather(*(reload(user_id) for user_id in list(self._counts)))
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._counts),
+            "counters": sum(len(counts) for counts in self._counts.values()),
+            "loads": self.loads,
+            "corrections": self.corrections
+        }
+
+
+unread_counters = UnreadCounters()
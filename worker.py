@@ -0,0 +1,18 @@
+import asyncio
+import logging
+
+from db import database
+from jobs import job_queue, JOB_WORKERS
+import spotify_service  # registers the job handlers
+
+
+async def main():
+    """Run background jobs outside the API process (JOBS_MODE=external, JOB_BACKEND=sqlite)."""
+    await database.connect()
+    logging.info(f"Starting {JOB_WORKERS} job workers")
+    await job_queue.run_forever(JOB_WORKERS)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())